@@ -101,6 +101,41 @@ resource "google_bigquery_table" "raw_statuses" {
   schema     = file("${path.module}/schemas/raw_statuses.json")
 }
 
+# Per-entity fingerprint of every captured run; tests/results skip runs whose fingerprint is unchanged
+resource "google_bigquery_table" "run_fingerprints" {
+  dataset_id = google_bigquery_dataset.testrail_data.dataset_id
+  table_id   = "run_fingerprints"
+  schema     = file("${path.module}/schemas/run_fingerprints.json")
+
+  clustering = ["entity", "run_id"]
+}
+
+# Content hash of the last written version of each projects/users/statuses/suites row;
+# snapshot syncs append only rows whose hash changed
+resource "google_bigquery_table" "content_hashes" {
+  dataset_id = google_bigquery_dataset.testrail_data.dataset_id
+  table_id   = "content_hashes"
+  schema     = file("${path.module}/schemas/content_hashes.json")
+
+  clustering = ["table_name"]
+}
+
+# Concurrency and page sizes learned by each API client (SYNC_AUTOTUNE), restored on startup
+resource "google_bigquery_table" "api_tuning" {
+  dataset_id = google_bigquery_dataset.testrail_data.dataset_id
+  table_id   = "api_tuning"
+  schema     = file("${path.module}/schemas/api_tuning.json")
+}
+
+# Work-unit leases for sharded tests/results syncs (see service/sharding.py)
+resource "google_bigquery_table" "sync_leases" {
+  dataset_id = google_bigquery_dataset.testrail_data.dataset_id
+  table_id   = "sync_leases"
+  schema     = file("${path.module}/schemas/sync_leases.json")
+
+  clustering = ["cycle", "entity"]
+}
+
 resource "google_bigquery_table" "sync_state" {
   dataset_id = google_bigquery_dataset.testrail_data.dataset_id
   table_id   = "sync_state"
@@ -206,6 +241,12 @@ resource "google_cloud_run_service" "default" {
   location = var.region
 
   template {
+    metadata {
+      annotations = {
+        # Sync jobs keep running in the background after POST /jobs/sync returns
+        "run.googleapis.com/cpu-throttling" = "false"
+      }
+    }
     spec {
       service_account_name = google_service_account.service_runner.email
       containers {
@@ -0,0 +1,128 @@
+import json
+import logging
+from datetime import datetime, timezone
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet staging is optional; the writer falls back to NDJSON
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+
+def arrow_available():
+    return pa is not None
+
+
+def _arrow_type(bq_type):
+    if bq_type in ("INT64", "INTEGER"):
+        return pa.int64()
+    if bq_type in ("FLOAT64", "FLOAT"):
+        return pa.float64()
+    if bq_type in ("BOOL", "BOOLEAN"):
+        return pa.bool_()
+    if bq_type == "TIMESTAMP":
+        # isAdjustedToUTC=true in Parquet, which BigQuery loads as TIMESTAMP
+        return pa.timestamp("us", tz="UTC")
+    # STRING, JSON (staged as text) and anything exotic
+    return pa.string()
+
+
+def _to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _to_int(value):
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_iso(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.utcfromtimestamp(value).isoformat()
+    return value
+
+
+def _parse_ts(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+class ArrowBatchWriter:
+    """
+    Columnar staging file for one table.
+    append() turns a batch of cleaned row dicts into one Arrow record batch,
+    column by column, typed from the BigQuery schema, and streams it into a
+    compressed Parquet file. Only schema columns are written, so the file is
+    a fraction of the NDJSON size; fields outside the schema are the
+    caller's drift to report.
+    JSON columns are staged as text and parsed back in the MERGE.
+    """
+    def __init__(self, path, fields, compression="zstd"):
+        self.path = path
+        self.fields = fields
+        self.schema = pa.schema([pa.field(name, _arrow_type(bq_type)) for name, bq_type in fields])
+        self.writer = pq.ParquetWriter(path, self.schema, compression=compression)
+        self.rows = 0
+
+    def _column(self, arrow_type, values):
+        if pa.types.is_timestamp(arrow_type):
+            text = [_to_iso(v) for v in values]
+            try:
+                naive = pa.array(text, pa.string()).cast(pa.timestamp("us"))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                naive = pa.array([_parse_ts(v) for v in text], pa.timestamp("us"))
+            return naive.cast(arrow_type)
+        try:
+            return pa.array(values, arrow_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            pass
+        # Mixed Python types in the column: coerce value by value
+        if pa.types.is_integer(arrow_type):
+            return pa.array([_to_int(v) for v in values], arrow_type)
+        if pa.types.is_floating(arrow_type):
+            return pa.array([_to_float(v) for v in values], arrow_type)
+        if pa.types.is_boolean(arrow_type):
+            return pa.array([None if v is None else bool(v) for v in values], arrow_type)
+        return pa.array([_to_text(v) for v in values], arrow_type)
+
+    def append(self, rows):
+        if not rows:
+            return
+        arrays = []
+        for field in self.schema:
+            values = [row.get(field.name) for row in rows]
+            arrays.append(self._column(field.type, values))
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.rows += len(rows)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
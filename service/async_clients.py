@@ -0,0 +1,407 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+import httpx
+from datetime import datetime
+from urllib.parse import urlencode
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type, retry_if_exception
+from http_session import TokenBucket, EndpointStats, RateLimitError, parse_retry_after, wait_retry_after
+from autotune import AdaptiveController, autotune_enabled
+from jira_client import JiraClient, _raise_exhausted
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopThread:
+    """
+    One asyncio loop running in a daemon thread. The async clients' pools
+    belong to it, so every sync shares them instead of opening new ones
+    on a fresh loop per call.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="sync-event-loop", daemon=True)
+        self.thread.start()
+
+    def run(self, coro):
+        """
+        Runs coro on the loop and blocks the calling thread until it returns.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+class AsyncRateLimitedSession:
+    """
+    asyncio counterpart of RateLimitedSession: one httpx.AsyncClient pool of
+    max_connections shared by every coroutine, EndpointStats, and the tuner's
+    in-flight limit. Pass the threaded client's `bucket` so both draw from
+    one process-wide rate limit. Waiting for a slot or a token costs a
+    suspended coroutine, not a thread.
+    """
+    def __init__(self, rate_per_sec=0, burst=1, max_connections=100, auth=None, headers=None, name="http",
+                 tuner=None, bucket=None):
+        self.client = httpx.AsyncClient(
+            auth=auth,
+            headers=headers,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=float(os.environ.get("SYNC_ASYNC_TIMEOUT", "60")),
+        )
+        self.bucket = bucket or TokenBucket(rate_per_sec, max(1, burst))
+        self.stats = EndpointStats(name)
+        self.tuner = tuner
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def request(self, method, url, endpoint, **kwargs):
+        """
+        Sends one throttled request. Raises RateLimitError on 429 after
+        pausing the shared bucket for the server's Retry-After.
+        """
+        if self.tuner:
+            async with self.condition:
+                await self.condition.wait_for(lambda: self.in_flight < int(self.tuner.limit))
+                self.in_flight += 1
+        latency, status_code = 0.0, None
+        try:
+            while True:
+                # Never waits on the bucket's thread lock: that would stall the loop
+                delay = self.bucket.reserve(blocking=False)
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+            start = time.monotonic()
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except httpx.HTTPError:
+                latency = time.monotonic() - start
+                self.stats.record_call(endpoint, latency, None)
+                raise
+            latency, status_code = time.monotonic() - start, response.status_code
+            self.stats.record_call(endpoint, latency, status_code, len(response.content))
+        finally:
+            if self.tuner:
+                self.tuner.observe(self.stats.endpoint_key(endpoint), latency, status_code)
+                async with self.condition:
+                    self.in_flight -= 1
+                    self.condition.notify_all()
+
+        if response.status_code == 429:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                self.bucket.pause(retry_after)
+            logger.warning(f"Rate limit hit on {self.stats.endpoint_key(endpoint)} (Retry-After={retry_after})")
+            raise RateLimitError("Rate limit hit", retry_after=retry_after)
+
+        return response
+
+    async def get(self, url, endpoint, **kwargs):
+        return await self.request("GET", url, endpoint, **kwargs)
+
+    async def post(self, url, endpoint, **kwargs):
+        return await self.request("POST", url, endpoint, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def _unwrap(data, key):
+    # Newer TestRail versions wrap lists as {"offset", "limit", "size", "_links", key: [...]}
+    if isinstance(data, dict) and key in data:
+        return data[key]
+    return data
+
+
+def _count_testrail_retry(retry_state):
+    client, endpoint = retry_state.args[0], retry_state.args[1]
+    client.session.stats.record_retry(endpoint)
+
+
+def _count_jira_retry(retry_state):
+    retry_state.args[0].session.stats.record_retry("search/jql")
+
+
+class AsyncTestRailClient:
+    """
+    asyncio TestRailClient with the same method surface; the paginated
+    iter_*_pages methods are async generators. Must be used from a single
+    event loop (see EventLoopThread).
+    """
+    PAGED_ENDPOINTS = ("get_cases", "get_tests", "get_results_for_run")
+
+    def __init__(self, base_url, user, api_key, bucket=None):
+        self.base_url = base_url.rstrip('/') + '/index.php?/api/v2'
+        self.auth = (user, api_key)
+        max_connections = int(os.environ.get("TESTRAIL_ASYNC_MAX_CONNECTIONS", "100"))
+        self.page_limit = int(os.environ.get("TESTRAIL_PAGE_SIZE", "250"))
+        self.tuner = None
+        if autotune_enabled():
+            self.tuner = AdaptiveController(
+                "testrail_async",
+                max_concurrency=max_connections,
+                initial_concurrency=16,
+                page_sizes={endpoint: (self.page_limit, self.page_limit) for endpoint in self.PAGED_ENDPOINTS},
+            )
+        self.session = AsyncRateLimitedSession(
+            rate_per_sec=float(os.environ.get("TESTRAIL_MAX_RPS", "3")),
+            burst=int(os.environ.get("TESTRAIL_BURST", "10")),
+            max_connections=max_connections,
+            auth=self.auth,
+            headers={'Content-Type': 'application/json'},
+            name="testrail",
+            tuner=self.tuner,
+            bucket=bucket,
+        )
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_retry_after(wait_random_exponential(multiplier=1, min=4, max=60)),
+        retry=retry_if_exception_type((httpx.HTTPError, RateLimitError)),
+        before_sleep=_count_testrail_retry
+    )
+    async def _request(self, endpoint, params=None):
+        # The API path is itself the query string (index.php?/api/v2/...), which httpx
+        # would re-encode if it merged params into it, so they are appended as text
+        url = f"{self.base_url}/{endpoint}"
+        if params:
+            url += "&" + urlencode(params)
+        response = await self.session.get(url, endpoint)
+        response.raise_for_status()
+        return response
+
+    async def _get(self, endpoint, params=None):
+        return (await self._request(endpoint, params=params)).json()
+
+    def get_stats(self):
+        return self.session.stats.snapshot()
+
+    async def aclose(self):
+        await self.session.aclose()
+
+    async def get_projects(self):
+        return _unwrap(await self._get("get_projects"), 'projects')
+
+    async def get_runs(self, project_id=None, created_after=None, updated_after=None):
+        params = {}
+        if created_after:
+            params['created_after'] = created_after
+        if updated_after:
+            params['updated_after'] = updated_after
+        return _unwrap(await self._get(f"get_runs/{project_id}" if project_id else "get_runs", params=params), 'runs')
+
+    async def get_plans(self, project_id, created_after=None, updated_after=None):
+        params = {}
+        if created_after:
+            params['created_after'] = created_after
+        if updated_after:
+            params['updated_after'] = updated_after
+        return _unwrap(await self._get(f"get_plans/{project_id}", params=params), 'plans')
+
+    async def _iter_pages(self, endpoint, key, params=None, limit=None):
+        """
+        Async version of TestRailClient._iter_pages.
+        """
+        key_endpoint = self.session.stats.endpoint_key(endpoint)
+        tuned = limit is None and self.tuner is not None and key_endpoint in self.tuner.page_bounds
+        offset = 0
+        while True:
+            page_limit = self.tuner.page_size(key_endpoint) if tuned else limit or self.page_limit
+            page_params = dict(params or {})
+            page_params['offset'] = offset
+            page_params['limit'] = page_limit
+            response = await self._request(endpoint, params=page_params)
+            data = response.json()
+
+            batch = []
+            if isinstance(data, dict):
+                batch = data.get(key) or []
+            elif isinstance(data, list):
+                batch = data
+
+            if tuned:
+                self.tuner.record_page(key_endpoint, page_limit, len(batch),
+                                       response.elapsed.total_seconds(), len(response.content))
+            if not batch:
+                break
+
+            yield batch
+
+            # A bare list longer than the page size means the server ignored offset/limit
+            if len(batch) < page_limit or (isinstance(data, list) and len(batch) > page_limit):
+                break
+            offset += page_limit
+
+    def iter_result_pages(self, run_id, created_after=None):
+        params = {}
+        if created_after:
+            params['created_after'] = created_after
+        return self._iter_pages(f"get_results_for_run/{run_id}", 'results', params)
+
+    async def get_results(self, run_id, created_after=None):
+        return [result async for page in self.iter_result_pages(run_id, created_after=created_after)
+                for result in page]
+
+    def iter_case_pages(self, project_id, suite_id=None, updated_after=None):
+        params = {}
+        if suite_id:
+            params['suite_id'] = suite_id
+        if updated_after:
+            params['updated_after'] = updated_after
+        return self._iter_pages(f"get_cases/{project_id}", 'cases', params)
+
+    async def get_cases(self, project_id, suite_id=None, updated_after=None):
+        return [case async for page in self.iter_case_pages(project_id, suite_id=suite_id, updated_after=updated_after)
+                for case in page]
+
+    def iter_test_pages(self, run_id):
+        return self._iter_pages(f"get_tests/{run_id}", 'tests')
+
+    async def get_tests(self, run_id):
+        return [test async for page in self.iter_test_pages(run_id) for test in page]
+
+    async def get_milestones(self, project_id):
+        return _unwrap(await self._get(f"get_milestones/{project_id}"), 'milestones')
+
+    async def get_suites(self, project_id):
+        return _unwrap(await self._get(f"get_suites/{project_id}"), 'suites')
+
+    async def get_statuses(self):
+        return await self._get("get_statuses")
+
+    async def get_plan(self, plan_id):
+        return await self._get(f"get_plan/{plan_id}")
+
+    async def get_milestone(self, milestone_id):
+        return await self._get(f"get_milestone/{milestone_id}")
+
+    async def get_users(self):
+        return _unwrap(await self._get("get_users"), 'users')
+
+
+def _is_retryable(exc):
+    # Same policy as JiraClient: throttling, connection problems and 5xx
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (httpx.HTTPError, RateLimitError))
+
+
+class AsyncJiraClient:
+    """
+    asyncio JiraClient; iter_issue_pages and get_all_issues are async
+    generators. Must be used from a single event loop (see EventLoopThread).
+    """
+    # Issues are flattened exactly as the sync client does
+    _transform_issue = JiraClient._transform_issue
+
+    def __init__(self, bucket=None):
+        self.base_url = os.getenv('JIRA_BASE_URL', "https://surapanama.atlassian.net")
+        self.email = os.getenv('JIRA_EMAIL')
+        self.token = os.getenv('JIRA_TOKEN')
+        self.local_tz = datetime.utcnow().astimezone().tzinfo
+        max_connections = int(os.getenv('JIRA_ASYNC_MAX_CONNECTIONS', '20'))
+        self.page_size = int(os.getenv('JIRA_PAGE_SIZE', '100'))
+        self.tuner = None
+        if autotune_enabled():
+            self.tuner = AdaptiveController(
+                "jira_async",
+                max_concurrency=max_connections,
+                page_sizes={"search/jql": (self.page_size, max(self.page_size, int(os.getenv('JIRA_MAX_PAGE_SIZE', '500'))))},
+            )
+        self.session = AsyncRateLimitedSession(
+            rate_per_sec=float(os.getenv('JIRA_MAX_RPS', '0')),
+            burst=10,
+            max_connections=max_connections,
+            auth=httpx.BasicAuth(self.email or "", self.token or ""),
+            headers={
+                "Accept": "application/json",
+                "Content-Type": "application/json"
+            },
+            name="jira",
+            tuner=self.tuner,
+            bucket=bucket,
+        )
+
+    async def aclose(self):
+        await self.session.aclose()
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_retry_after(wait_random_exponential(multiplier=1, min=2, max=60)),
+        retry=retry_if_exception(_is_retryable),
+        before_sleep=_count_jira_retry,
+        retry_error_callback=_raise_exhausted
+    )
+    async def get_issues(self, jql, next_page_token=None, max_results=50):
+        payload = {
+            "jql": jql,
+            "maxResults": max_results,
+            "fields": ["id", "key", "summary", "status", "priority", "created", "updated", "assignee", "reporter", "resolution"]
+        }
+        if next_page_token:
+            payload["nextPageToken"] = next_page_token
+
+        try:
+            response = await self.session.post(f"{self.base_url}/rest/api/3/search/jql", "search/jql", json=payload)
+            response.raise_for_status()
+            data = response.json()
+        except httpx.HTTPStatusError as e:
+            # 429/5xx are retried, and logged as errors only once retries run out
+            logger.log(logging.WARNING if _is_retryable(e) else logging.ERROR, f"Jira API Error: {e.response.text}")
+            raise
+        except Exception as e:
+            logger.log(logging.WARNING if _is_retryable(e) else logging.ERROR, f"Jira Connection Error: {str(e)}")
+            raise
+
+        if self.tuner:
+            returned = len(data.get('issues') or [])
+            if data.get('nextPageToken') and returned < max_results:
+                self.tuner.cap_page_size("search/jql", returned)
+            self.tuner.record_page("search/jql", max_results, returned,
+                                   response.elapsed.total_seconds(), len(response.content))
+        return data
+
+    async def iter_issue_pages(self, jql, max_results=None):
+        next_token = None
+        while True:
+            page_size = max_results or (self.tuner.page_size("search/jql") if self.tuner else self.page_size)
+            data = await self.get_issues(jql, next_token, page_size)
+            issues = data.get('issues', [])
+            if not issues:
+                break
+            yield [self._transform_issue(issue) for issue in issues]
+            next_token = data.get('nextPageToken')
+            if not next_token:
+                break
+
+    async def get_all_issues(self, jql):
+        async for page in self.iter_issue_pages(jql):
+            for issue in page:
+                yield issue
+
+
+class AsyncClients:
+    """
+    The event loop and the async TestRail/Jira clients bound to it.
+    tr_bucket/jira_bucket are the threaded clients' TokenBuckets, so async
+    and threaded syncs share TESTRAIL_MAX_RPS / JIRA_MAX_RPS.
+    """
+    def __init__(self, tr_base_url, tr_user, tr_api_key, tr_bucket=None, jira_bucket=None):
+        self.loop = EventLoopThread()
+        # Syncs currently fetching with these clients (kept by SyncEngine)
+        self.users = 0
+        # Built on the loop: their asyncio primitives and pools belong to it
+        self.testrail, self.jira = self.loop.run(
+            self._build(tr_base_url, tr_user, tr_api_key, tr_bucket, jira_bucket))
+
+    @staticmethod
+    async def _build(tr_base_url, tr_user, tr_api_key, tr_bucket, jira_bucket):
+        return (AsyncTestRailClient(tr_base_url, tr_user, tr_api_key, bucket=tr_bucket),
+                AsyncJiraClient(bucket=jira_bucket))
+
+    def close(self):
+        async def close_all():
+            await self.testrail.aclose()
+            await self.jira.aclose()
+        self.loop.run(close_all())
+        self.loop.loop.call_soon_threadsafe(self.loop.loop.stop)
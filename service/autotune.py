@@ -0,0 +1,173 @@
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A response this many times slower than the fastest seen on its endpoint counts as congestion
+LATENCY_TOLERANCE = 2.0
+# Share of the distance to a slower latency the per-endpoint baseline moves per response,
+# so it follows the server when it gets slower for good
+BASELINE_DRIFT = 0.01
+
+
+def autotune_enabled():
+    return os.environ.get("SYNC_AUTOTUNE", "true").lower() in ('1', 'true', 'yes')
+
+
+class AdaptiveController:
+    """
+    AIMD tuning of one API client's in-flight requests and page sizes.
+
+    Concurrency: at most `limit` requests are in flight. Every healthy
+    response raises the limit by 1/limit (about one per round trip of the
+    whole window); a 429 halves it, and a failed request or one
+    LATENCY_TOLERANCE times slower than the endpoint's baseline trims it
+    by 10%. Decreases happen at most once per window, so a burst of 429s
+    from requests that were already in flight counts once.
+
+    Page size (per endpoint): grows by a tenth of the maximum after a full
+    page that came back well under target_latency and max_page_bytes,
+    halves after a page over either. 429s leave it alone: bigger pages
+    mean fewer requests.
+
+    state()/load() carry the learned values between runs (see
+    SyncEngine._save_tuning, which keeps them in api_tuning).
+    """
+    def __init__(self, name, max_concurrency, initial_concurrency=4, page_sizes=None,
+                 target_latency=None, max_page_bytes=None):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(min(initial_concurrency, self.max_concurrency))
+        # endpoint -> (initial, maximum)
+        self.page_bounds = dict(page_sizes or {})
+        self.pages = {endpoint: float(initial) for endpoint, (initial, _) in self.page_bounds.items()}
+        self.page_caps = {}
+        self.target_latency = target_latency or float(os.environ.get("AUTOTUNE_TARGET_LATENCY", "5"))
+        self.max_page_bytes = max_page_bytes or int(float(os.environ.get("AUTOTUNE_MAX_PAGE_MB", "5")) * 1024 * 1024)
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.completed = 0
+        self.last_decrease = -self.max_concurrency
+        self.baselines = {}
+        self.saved = {}
+
+    # --- concurrency ---
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, endpoint, latency, status_code):
+        with self.condition:
+            self.in_flight -= 1
+            self._observe(endpoint, latency, status_code)
+            self.condition.notify_all()
+
+    def observe(self, endpoint, latency, status_code):
+        """
+        Feeds back one response without the in-flight accounting of
+        acquire()/release() (the asyncio session keeps its own).
+        """
+        with self.condition:
+            self._observe(endpoint, latency, status_code)
+
+    def _observe(self, endpoint, latency, status_code):
+        # Caller holds self.condition
+        self.completed += 1
+        baseline = self.baselines.get(endpoint)
+        if status_code is not None and status_code < 400:
+            if baseline is None or latency < baseline:
+                self.baselines[endpoint] = latency
+            else:
+                self.baselines[endpoint] = baseline + (latency - baseline) * BASELINE_DRIFT
+
+        if status_code == 429:
+            self._decrease(0.5, f"rate limited on {endpoint}")
+        elif status_code is None or status_code >= 500:
+            self._decrease(0.9, f"request to {endpoint} failed")
+        elif baseline is not None and latency > baseline * LATENCY_TOLERANCE:
+            self._decrease(0.9, f"{endpoint} slowed to {latency:.2f}s (baseline {baseline:.2f}s)")
+        elif status_code < 400:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def _decrease(self, factor, reason):
+        # Caller holds self.condition
+        if self.completed - self.last_decrease < self.limit:
+            return
+        previous = self.limit
+        self.limit = max(1.0, self.limit * factor)
+        self.last_decrease = self.completed
+        if int(self.limit) < int(previous):
+            logger.info(f"{self.name}: concurrency {int(previous)} -> {int(self.limit)} ({reason})")
+
+    # --- page size ---
+
+    def page_size(self, endpoint):
+        with self.condition:
+            return int(self.pages[endpoint])
+
+    def record_page(self, endpoint, requested, returned, latency, size):
+        """
+        Feeds back one page fetched with page_size(endpoint) == requested.
+        """
+        maximum = self.page_caps.get(endpoint, self.page_bounds[endpoint][1])
+        minimum = max(1, maximum // 10)
+        with self.condition:
+            previous = int(self.pages[endpoint])
+            if latency > self.target_latency or size > self.max_page_bytes:
+                self.pages[endpoint] = max(minimum, self.pages[endpoint] / 2)
+            elif returned >= requested and latency < self.target_latency / 2 and size < self.max_page_bytes / 2:
+                self.pages[endpoint] = min(maximum, self.pages[endpoint] + max(1, maximum // 10))
+            current = int(self.pages[endpoint])
+        if current != previous:
+            logger.info(f"{self.name}: {endpoint} page size {previous} -> {current} "
+                        f"({latency:.2f}s, {size} bytes for {returned} rows)")
+
+    def cap_page_size(self, endpoint, size):
+        """
+        The server returned fewer rows than asked for while more were left:
+        never ask for more than that again (until the process restarts).
+        """
+        if size <= 0 or size >= self.page_caps.get(endpoint, self.page_bounds[endpoint][1]):
+            return
+        with self.condition:
+            self.page_caps[endpoint] = size
+            self.pages[endpoint] = min(self.pages[endpoint], size)
+        logger.info(f"{self.name}: {endpoint} serves at most {size} rows per page")
+
+    # --- persistence ---
+
+    def state(self):
+        with self.condition:
+            state = {"concurrency": int(self.limit)}
+            state.update({f"page_size:{endpoint}": int(size) for endpoint, size in self.pages.items()})
+            return state
+
+    def load(self, state):
+        """
+        Restores values from state() (e.g. from the previous run), clamped
+        to the current bounds.
+        """
+        with self.condition:
+            for key, value in state.items():
+                if key == "concurrency":
+                    self.limit = float(min(max(1, value), self.max_concurrency))
+                elif key.startswith("page_size:") and key[len("page_size:"):] in self.page_bounds:
+                    endpoint = key[len("page_size:"):]
+                    maximum = self.page_bounds[endpoint][1]
+                    self.pages[endpoint] = float(min(max(max(1, maximum // 10), value), maximum))
+            self.condition.notify_all()
+        self.saved = self.state()
+        logger.info(f"{self.name}: restored tuning {self.saved}")
+
+    def changes(self):
+        """
+        Values that differ from the last load() or mark_saved().
+        """
+        return {key: value for key, value in self.state().items() if self.saved.get(key) != value}
+
+    def mark_saved(self, values):
+        self.saved.update(values)
@@ -0,0 +1,216 @@
+"""
+Sync throughput benchmark against local stand-ins for TestRail, Jira and BigQuery.
+
+    python benchmark.py --results 100000 --latency-ms 20 --rate-429 0.01
+    python benchmark.py --results 1000000 --entity results --repeat 2 --output bench.json
+
+A fake TestRail v2 / Jira search/jql server runs in a child process; the
+SyncEngine runs in this one with the real clients, normalizers and
+pipeline, writing to an in-memory BigQueryClient double. Each repetition
+reports wall time, rows and rows/sec, API calls per entity, 429s served,
+client retries and the peak RSS of the sync process. Repetitions after the
+first show the incremental sync cost.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import resource
+import multiprocessing
+import requests
+
+logger = logging.getLogger(__name__)
+
+# TestRail endpoint / Jira route -> entity it is called for
+ENDPOINT_ENTITIES = {
+    "get_projects": "projects",
+    "get_users": "users",
+    "get_statuses": "statuses",
+    "get_milestones": "milestones",
+    "get_milestone": "milestones",
+    "get_plans": "plans",
+    "get_plan": "plans",
+    "get_runs": "runs",
+    "get_suites": "suites",
+    "get_cases": "cases",
+    "get_tests": "tests",
+    "get_results_for_run": "results",
+    "search/jql": "jira_issues",
+}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _by_entity(counts):
+    entities = {}
+    for endpoint, count in counts.items():
+        entity = ENDPOINT_ENTITIES.get(endpoint, endpoint)
+        entities[entity] = entities.get(entity, 0) + count
+    return entities
+
+
+def _client_stats(engine):
+    # TestRail endpoint stats of the threaded client and, once built, the asyncio one
+    stats = {f"sync:{k}": v for k, v in engine.tr_client.get_stats().items()}
+    if engine.async_clients:
+        stats.update({f"async:{k}": v for k, v in engine.async_clients.testrail.get_stats().items()})
+    return stats
+
+
+def _delta(after, before):
+    return {k: v - before.get(k, 0) for k, v in after.items() if v - before.get(k, 0)}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--results", type=int, default=10000, help="Total synthetic results (10k-1M)")
+    parser.add_argument("--projects", type=int, default=2)
+    parser.add_argument("--results-per-run", type=int, default=250)
+    parser.add_argument("--cases-per-project", type=int, default=500)
+    parser.add_argument("--jira-issues", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every API response")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of API calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--page-size", type=int, default=250, help="TestRail page size (TESTRAIL_PAGE_SIZE)")
+    parser.add_argument("--max-rps", type=float, default=0, help="TESTRAIL_MAX_RPS for the client (0 = unthrottled)")
+    parser.add_argument("--workers", type=int, default=None, help="SYNC_MAX_WORKERS")
+    parser.add_argument("--async-fetch", action="store_true", help="SYNC_ASYNC_FETCH: fetch runs with the asyncio clients")
+    parser.add_argument("--async-concurrency", type=int, default=None, help="SYNC_ASYNC_CONCURRENCY")
+    parser.add_argument("--entity", default="all", help="Entity to sync (default all)")
+    parser.add_argument("--repeat", type=int, default=1, help="Syncs to run; later ones are incremental")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    return parser.parse_args(argv)
+
+
+def run_benchmark(args):
+    from fake_services import FakeDataset, serve, InMemoryBigQueryClient
+
+    dataset = FakeDataset(
+        projects=args.projects,
+        results_total=args.results,
+        results_per_run=args.results_per_run,
+        cases_per_project=args.cases_per_project,
+        jira_issues=args.jira_issues,
+    )
+    port = _free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve,
+        args=(port, dataset),
+        kwargs={"latency_ms": args.latency_ms, "rate_429": args.rate_429,
+                "retry_after": args.retry_after, "ready": ready},
+        daemon=True,
+    )
+    server.start()
+    ready.wait(10)
+    base_url = f"http://127.0.0.1:{port}"
+
+    os.environ.update({
+        "TESTRAIL_MAX_RPS": str(args.max_rps),
+        "TESTRAIL_PAGE_SIZE": str(args.page_size),
+        "JIRA_BASE_URL": base_url,
+        "JIRA_EMAIL": "bench@example.com",
+        "JIRA_TOKEN": "bench",
+        "JIRA_PROJECTS": "CM",
+        # The in-memory BigQuery double cannot run the sql/ models
+        "SYNC_MATERIALIZE": "false",
+    })
+    if args.workers:
+        os.environ["SYNC_MAX_WORKERS"] = str(args.workers)
+    if args.async_fetch:
+        os.environ["SYNC_ASYNC_FETCH"] = "true"
+    if args.async_concurrency:
+        os.environ["SYNC_ASYNC_CONCURRENCY"] = str(args.async_concurrency)
+
+    # Imported after the env is set: the clients read it on construction
+    from sync_engine import SyncEngine
+    from testrail_client import TestRailClient
+    from jira_client import JiraClient
+
+    bq = InMemoryBigQueryClient()
+    engine = SyncEngine(
+        tr_client=TestRailClient(base_url, "bench", "bench"),
+        bq_client=bq,
+        jira_client=JiraClient(),
+    )
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "dataset": {"runs": dataset.runs_per_project * dataset.projects, "results": args.results},
+        "iterations": [],
+    }
+    try:
+        for iteration in range(1, args.repeat + 1):
+            calls_before = requests.get(f"{base_url}/__stats").json()
+            rows_before = dict(bq.rows_written)
+            bytes_before = bq.bytes_written
+            client_before = _client_stats(engine)
+
+            start = time.monotonic()
+            result = engine.run_sync(args.entity)
+            wall = time.monotonic() - start
+
+            calls_after = requests.get(f"{base_url}/__stats").json()
+            rows = _delta(bq.rows_written, rows_before)
+            client_after = _client_stats(engine)
+            retries = sum(s.get("retries", 0) for s in client_after.values()) - \
+                sum(s.get("retries", 0) for s in client_before.values())
+            total_rows = sum(rows.values())
+            api_calls = _delta(calls_after["calls"], calls_before["calls"])
+
+            report["iterations"].append({
+                "iteration": iteration,
+                "status": result.get("status"),
+                "wall_time_s": round(wall, 3),
+                "rows": total_rows,
+                "rows_per_sec": round(total_rows / wall, 1) if wall else None,
+                "rows_by_table": rows,
+                "bytes_serialized": bq.bytes_written - bytes_before,
+                "api_calls": sum(api_calls.values()),
+                "api_calls_by_entity": _by_entity(api_calls),
+                "rate_limited": sum(_delta(calls_after["throttled"], calls_before["throttled"]).values()),
+                "client_retries": retries,
+                "peak_rss_mb": _peak_rss_mb(),
+                "entity_timings": result.get("timings"),
+                # Learned concurrency/page sizes at the end of the iteration (SYNC_AUTOTUNE)
+                "tuning": {client.tuner.name: client.tuner.state()
+                           for client in (engine.tr_client, engine.jira_client) + (
+                               (engine.async_clients.testrail, engine.async_clients.jira)
+                               if engine.async_clients else ()) if client.tuner},
+                "entity_metrics": {entity: entity_result.get("metrics") for entity, entity_result
+                                   in result.get("detailed_results", {args.entity: result}).items()},
+            })
+            logger.info(f"Iteration {iteration}: {total_rows} rows in {wall:.1f}s "
+                        f"({total_rows / wall if wall else 0:.0f} rows/s), {sum(api_calls.values())} API calls")
+    finally:
+        server.terminate()
+        server.join()
+    return report
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+    args = parse_args(argv)
+    report = run_benchmark(args)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,7 +1,12 @@
 import os
+import threading
 import logging
+import metrics
 from google.cloud import bigquery
 from datetime import datetime
+from bq_writer import StreamingWriter, LoadJobWriter, PARQUET, NDJSON
+from arrow_batch import arrow_available
+from normalizer import TableNormalizer, load_schema_file
 
 logger = logging.getLogger(__name__)
 
@@ -10,6 +15,28 @@ class BigQueryClient:
         self.client = bigquery.Client(project=project_id)
         self.dataset_id = dataset_id
         self.dataset_ref = f"{project_id}.{dataset_id}"
+        
+        # "load" buffers rows locally and commits one load job per table on flush().
+        # "stream" keeps the old per-batch insert_rows_json behaviour.
+        self.write_mode = os.environ.get("BQ_WRITE_MODE", "load")
+        if self.write_mode == "stream":
+            self.writer = StreamingWriter(self.client)
+        else:
+            # Parquet when pyarrow is installed, NDJSON otherwise
+            staging_format = os.environ.get("BQ_STAGING_FORMAT", PARQUET if arrow_available() else NDJSON)
+            self.writer = LoadJobWriter(
+                self.client,
+                staging_dir=os.environ.get("BQ_STAGING_DIR"),
+                staging_format=staging_format.lower(),
+                compression=os.environ.get("BQ_PARQUET_COMPRESSION", "zstd"),
+            )
+        
+        # Row normalizers compiled per table on first use
+        self._normalizers = {}
+        
+        # Watermarks waiting for their table's buffered rows to be loaded
+        self._pending_watermarks = []
+        self._watermark_lock = threading.Lock()
 
     def get_watermark(self, entity_type, scope_id=None):
         """
@@ -38,16 +65,30 @@ class BigQueryClient:
             return row.last_updated_at_watermark
         return 0
 
-    def update_watermark(self, entity_type, watermark, scope_id=None, status="SUCCESS"):
+    def update_watermark(self, entity_type, watermark, scope_id=None, status="SUCCESS", after_table=None, synced_at=None):
         """
         Updates the sync state table.
+        If after_table still has rows buffered for a load job, or being
+        loaded by a flush() on any thread, the update is held back until they
+        are committed, and dropped if that load fails, so a failed load never
+        leaves the watermark ahead of the data.
+        synced_at (epoch seconds) is stored as last_sync_ts instead of the
+        current time.
         """
+        if after_table:
+            with self._watermark_lock:
+                pending, failures = self.writer.load_state(f"{self.dataset_ref}.{after_table}")
+                if pending:
+                    self._pending_watermarks.append(
+                        (after_table, failures, entity_type, watermark, scope_id, status, synced_at))
+                    return
+        
         table_id = f"{self.dataset_ref}.sync_state"
         
         # We use MERGE to upsert the state
         query = f"""
             MERGE `{table_id}` T
-            USING (SELECT @entity_type as entity_type, @scope_id as scope_id, @watermark as watermark, CURRENT_TIMESTAMP() as now, @status as status) S
+            USING (SELECT @entity_type as entity_type, @scope_id as scope_id, @watermark as watermark, COALESCE(TIMESTAMP_SECONDS(@synced_at), CURRENT_TIMESTAMP()) as now, @status as status) S
             ON T.entity_type = S.entity_type AND (T.scope_id = S.scope_id OR (T.scope_id IS NULL AND S.scope_id IS NULL))
             WHEN MATCHED THEN
                 UPDATE SET last_updated_at_watermark = S.watermark, last_sync_ts = S.now, status = S.status
@@ -60,89 +101,268 @@ class BigQueryClient:
             bigquery.ScalarQueryParameter("entity_type", "STRING", entity_type),
             bigquery.ScalarQueryParameter("scope_id", "STRING", str(scope_id) if scope_id else None),
             bigquery.ScalarQueryParameter("watermark", "INT64", watermark),
-            bigquery.ScalarQueryParameter("status", "STRING", status)
+            bigquery.ScalarQueryParameter("status", "STRING", status),
+            bigquery.ScalarQueryParameter("synced_at", "INT64", synced_at),
         ]
         
         job_config = bigquery.QueryJobConfig(query_parameters=query_params)
         self.client.query(query, job_config=job_config).result()
 
-    def insert_rows(self, table_name, rows):
+    def get_checkpoints(self, entity_type):
+        """
+        Returns {scope_id: (value, last_sync_ts epoch)} for every open
+        checkpoint (non-zero value) of entity_type.
+        """
+        query = f"""
+            SELECT scope_id, last_updated_at_watermark AS value, UNIX_SECONDS(last_sync_ts) AS synced_at
+            FROM `{self.dataset_ref}.sync_state`
+            WHERE entity_type = @entity_type AND last_updated_at_watermark > 0
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("entity_type", "STRING", entity_type),
+        ])
+        results = self.client.query(query, job_config=job_config).result()
+        return {row.scope_id: (row.value, row.synced_at) for row in results}
+
+    # Run fields that change whenever a run's tests or results can have changed
+    RUN_FINGERPRINT_FIELDS = [
+        "is_completed", "completed_on", "updated_on", "passed_count", "blocked_count",
+        "untested_count", "retest_count", "failed_count", "custom_status_count",
+    ]
+
+    def get_changed_runs(self, entity, project_id, include_unchanged=False):
+        """
+        Returns the project's runs whose tests/results (entity) need fetching,
+        ordered by ID, as dicts with id, updated_ts (epoch), fingerprint,
+        is_completed, captured_at (epoch of the last capture, or None) and
+        captured_fingerprint (the fingerprint at that capture).
+        A run is skipped when its fingerprint in run_fingerprints still
+        matches the latest raw_runs row, or when it was already completed
+        when it was captured. include_unchanged returns every run.
+        """
+        fingerprint = ", ".join(self.RUN_FINGERPRINT_FIELDS)
+        query = f"""
+            SELECT r.id, r.updated_ts, r.fingerprint, r.is_completed, UNIX_SECONDS(f.captured_at) AS captured_at,
+                f.fingerprint AS captured_fingerprint
+            FROM (
+                SELECT id, is_completed,
+                    UNIX_SECONDS(COALESCE(updated_on, created_on)) AS updated_ts,
+                    TO_HEX(MD5(TO_JSON_STRING(STRUCT({fingerprint})))) AS fingerprint
+                FROM `{self.dataset_ref}.raw_runs`
+                WHERE project_id = @project_id
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY id ORDER BY _extracted_at DESC) = 1
+            ) r
+            LEFT JOIN `{self.dataset_ref}.run_fingerprints` f
+                ON f.entity = @entity AND f.run_id = r.id
+            WHERE @include_unchanged
+                OR f.fingerprint IS NULL
+                OR (f.fingerprint != r.fingerprint AND NOT IFNULL(f.is_completed, FALSE))
+            ORDER BY r.id
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("entity", "STRING", entity),
+            bigquery.ScalarQueryParameter("project_id", "INT64", project_id),
+            bigquery.ScalarQueryParameter("include_unchanged", "BOOL", include_unchanged),
+        ])
+        results = self.client.query(query, job_config=job_config).result()
+        return [dict(row.items()) for row in results]
+
+    def record_run_fingerprints(self, entity, project_id, runs):
+        """
+        Upserts the fingerprint of each captured run for entity. runs are
+        dicts from get_changed_runs with captured_at set to the epoch the
+        run was fetched. Only call once the runs' rows are committed, then
+        flush(["run_fingerprints"]).
+        """
+        rows = [{
+            "key": f"{entity}:{run['id']}",
+            "entity": entity,
+            "run_id": run["id"],
+            "project_id": project_id,
+            "fingerprint": run["fingerprint"],
+            "is_completed": run["is_completed"],
+            "captured_at": datetime.utcfromtimestamp(run["captured_at"]).isoformat(),
+        } for run in runs]
+        self.upsert_rows("run_fingerprints", rows, key_field="key", newer_wins="captured_at", cleaned=True)
+
+    def get_content_hashes(self, table_name):
+        """
+        Returns {row_key: content_hash} of the last version written to
+        table_name for every row in the content-hash index.
+        """
+        query = f"""
+            SELECT row_key, content_hash
+            FROM `{self.dataset_ref}.content_hashes`
+            WHERE table_name = @table_name
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("table_name", "STRING", table_name),
+        ])
+        results = self.client.query(query, job_config=job_config).result()
+        return {row.row_key: row.content_hash for row in results}
+
+    def record_content_hashes(self, table_name, hashes):
         """
-        Inserts rows into BigQuery.
-        Uses streaming insert for simplicity in this phase.
-        For production with high volume, consider load jobs from JSON/Parquet.
+        Upserts {row_key: content_hash} into the content-hash index. Only call
+        once the rows themselves are committed, then flush(["content_hashes"]).
+        """
+        now = datetime.utcnow().isoformat()
+        rows = [{
+            "key": f"{table_name}:{row_key}",
+            "table_name": table_name,
+            "row_key": row_key,
+            "content_hash": content_hash,
+            "updated_at": now,
+        } for row_key, content_hash in hashes.items()]
+        self.upsert_rows("content_hashes", rows, key_field="key", newer_wins="updated_at", cleaned=True)
+
+    def get_tuning(self, client_name):
+        """
+        Returns the learned {setting: value} of an API client's tuner
+        (autotune.AdaptiveController.state()) from api_tuning.
+        """
+        query = f"""
+            SELECT setting, value
+            FROM `{self.dataset_ref}.api_tuning`
+            WHERE client = @client
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("client", "STRING", client_name),
+        ])
+        results = self.client.query(query, job_config=job_config).result()
+        return {row.setting: row.value for row in results}
+
+    def save_tuning(self, client_name, values):
+        """
+        Upserts {setting: value} of an API client's tuner into api_tuning,
+        then flush(["api_tuning"]).
+        """
+        now = datetime.utcnow().isoformat()
+        rows = [{
+            "key": f"{client_name}:{setting}",
+            "client": client_name,
+            "setting": setting,
+            "value": value,
+            "updated_at": now,
+        } for setting, value in values.items()]
+        self.upsert_rows("api_tuning", rows, key_field="key", newer_wins="updated_at", cleaned=True)
+
+    def insert_rows(self, table_name, rows, cleaned=False):
+        """
+        Inserts rows into BigQuery through the configured writer.
+        In "load" mode rows are only buffered; call flush() to commit them.
+        Pass cleaned=True for rows that already went through clean_rows().
         """
         if not rows:
             return
             
         table_id = f"{self.dataset_ref}.{table_name}"
+        self.writer.write(table_id, rows if cleaned else self.clean_rows(table_name, rows))
+        metrics.record_bq_rows(table_name, len(rows))
         
-        # Add extraction metadata
-        import json
+        if self.write_mode == "stream":
+            logger.info(f"Inserted {len(rows)} rows into {table_name}")
+        else:
+            logger.info(f"Buffered {len(rows)} rows for {table_name}")
+
+    def clean_rows(self, table_name, rows):
+        """
+        Returns copies of rows with extraction metadata added, custom_* fields
+        collected into custom_fields, and TestRail epoch timestamps / nested
+        values converted for BigQuery, using the table's compiled normalizer.
+        """
         now = datetime.utcnow().isoformat()
-        
-        # Helper to convert timestamp
-        def convert_ts(ts):
-            if isinstance(ts, int):
-                return datetime.utcfromtimestamp(ts).isoformat()
-            return ts
-
-        cleaned_rows = []
-        for row in rows:
-            # Create a copy to avoid modifying original if needed
-            item = row.copy()
-            item['_extracted_at'] = now
-            item['_source'] = 'testrail'
-            
-            # Convert known timestamp fields
-            for field in ['created_on', 'completed_on', 'updated_on', 'due_on']:
-                if field in item and item[field] is not None:
-                    item[field] = convert_ts(item[field])
-            
-            # Convert known JSON fields
-            if 'custom_status_count' in item and isinstance(item['custom_status_count'], (dict, list)):
-                item['custom_status_count'] = json.dumps(item['custom_status_count'])
-            
-            # entries in raw_plans is JSON type in BQ, so dict is fine, but let's ensure it's compatible
-            # If BQ schema is JSON, we pass dict. If STRING, we dump.
-            # Schema for raw_plans says "entries": "JSON". So dict is okay.
-            
-            cleaned_rows.append(item)
-            
-        errors = self.client.insert_rows_json(table_id, cleaned_rows, ignore_unknown_values=True)
-        if errors:
-            logger.error(f"Encountered errors while inserting rows: {errors}")
-            # Print to stdout/stderr as well for immediate visibility in scripts
-            print(f"BQ INSERT ERRORS: {errors}")
-            raise Exception(f"BigQuery insert failed: {errors}")
-        
-        logger.info(f"Inserted {len(rows)} rows into {table_name}")
+        return self._normalizer(table_name).normalize(rows, now)
 
-    def upsert_rows(self, table_name, rows, key_field="id"):
+    def has_column(self, table_name, column):
         """
-        Performs an upsert (MERGE) operation.
-        Since BQ streaming buffer has a delay, immediate MERGE might miss streamed data.
-        Strategy: Insert into a temporary table or use streaming insert and then run a deduplication query periodically.
-        
-        For this implementation, we will use streaming insert into the main table, 
-        and rely on the 'Bronze' layer being raw (duplicates allowed technically, but we try to avoid).
-        
-        However, the requirement says "Upserts en BigQuery con MERGE".
-        To do this efficiently:
-        1. Load data into a temp table.
-        2. Run MERGE statement.
-        
-        Simplified approach for now: Stream insert, but we will add a 'deduplication' step in the Silver layer transformation.
-        OR: We can use `insert_rows_json` which is streaming.
+        Whether the schema of table_name (as found by _normalizer) has column.
+        False when the schema is unknown.
+        """
+        columns = self._normalizer(table_name).columns
+        return columns is not None and column in columns
+
+    def _normalizer(self, table_name):
+        """
+        TableNormalizer compiled once per table from infra/schemas/<table>.json,
+        falling back to the live BigQuery table schema (the service image does
+        not ship infra/), then to the legacy field list.
+        """
+        normalizer = self._normalizers.get(table_name)
+        if normalizer is None:
+            fields = load_schema_file(table_name)
+            if fields is None:
+                try:
+                    table = self.client.get_table(f"{self.dataset_ref}.{table_name}")
+                    fields = [(field.name, field.field_type) for field in table.schema]
+                except Exception as e:
+                    logger.warning(f"No schema for {table_name}, using legacy row cleaning: {e}")
+            normalizer = TableNormalizer(table_name, fields)
+            self._normalizers[table_name] = normalizer
+        return normalizer
+
+    def schema_drift(self):
+        """
+        {table_name: [fields]} seen in synced rows but missing from the table
+        schema (and therefore not stored), since this client was created.
+        """
+        prefix = f"{self.dataset_ref}."
+        return {table_id[len(prefix):]: columns for table_id, columns in self.writer.schema_drift().items()}
+
+    def flush(self, table_names=None):
+        """
+        Commits buffered rows (one load job per table) and then applies the
+        watermarks that were waiting on those tables. A watermark whose table
+        had a failed load since it was held back is dropped instead.
+        Returns {table_name: rows_loaded}.
+        """
+        table_ids = None
+        if table_names is not None:
+            table_ids = [f"{self.dataset_ref}.{name}" for name in table_names]
         
-        Let's stick to: Insert Raw. Deduplicate downstream.
-        BUT, if we want to update the *same* record in Raw (e.g. run status changed), we need to handle it.
+        # On failure the watermarks behind it are discarded by the next flush()
+        loaded = self.writer.flush(table_ids)
+        ready = self._settle_watermarks()
         
-        Alternative:
-        Use `MERGE` directly if we construct the query with data. (Limit on query size).
+        for table_name, _, entity_type, watermark, scope_id, status, synced_at in ready:
+            self.update_watermark(entity_type, watermark, scope_id=scope_id, status=status, synced_at=synced_at)
         
-        Let's stick to streaming insert for Bronze. Bronze is usually Append-Only.
-        We can have a view `v_raw_runs` that does `QUALIFY ROW_NUMBER() OVER(PARTITION BY id ORDER BY _extracted_at DESC) = 1`.
+        prefix = f"{self.dataset_ref}."
+        return {table_id[len(prefix):]: count for table_id, count in loaded.items()}
+
+    def _settle_watermarks(self):
+        """
+        Removes and returns the held-back watermarks whose rows are committed.
+        Those whose table had a failed load meanwhile are discarded: their
+        rows may be lost, so the next sync must re-fetch them.
+        """
+        ready, waiting = [], []
+        with self._watermark_lock:
+            for w in self._pending_watermarks:
+                pending, failures = self.writer.load_state(f"{self.dataset_ref}.{w[0]}")
+                if failures != w[1]:
+                    logger.warning(f"Dropped the {w[2]} watermark: a load of {w[0]} failed before it was committed")
+                elif pending:
+                    waiting.append(w)
+                else:
+                    ready.append(w)
+            self._pending_watermarks = waiting
+        return ready
+
+    def upsert_rows(self, table_name, rows, key_field="id", newer_wins="_extracted_at", cleaned=False):
+        """
+        Upserts rows keyed on key_field with a staged MERGE:
+        the batch is loaded into a temporary staging table and merged in one
+        statement, so re-synced records replace their previous version instead
+        of piling up as duplicates.
+        newer_wins names the column that decides which version survives
+        (e.g. updated_on); a row is never replaced by an older one.
+        In "load" mode the batch is buffered and merged once per table on flush().
         """
-        # For now, just insert.
-        self.insert_rows(table_name, rows)
+        if not rows:
+            return
+        
+        table_id = f"{self.dataset_ref}.{table_name}"
+        self.writer.write(table_id, rows if cleaned else self.clean_rows(table_name, rows), merge=(key_field, newer_wins))
+        metrics.record_bq_rows(table_name, len(rows))
+        logger.info(f"Upserted {len(rows)} rows into {table_name} on {key_field}")
@@ -0,0 +1,346 @@
+import os
+import json
+import uuid
+import tempfile
+import time
+import threading
+import logging
+import metrics
+from datetime import datetime, timedelta, timezone
+from google.cloud import bigquery
+from arrow_batch import ArrowBatchWriter, arrow_available
+
+logger = logging.getLogger(__name__)
+
+# How long an orphaned staging table survives if the process dies mid-merge
+STAGING_TABLE_TTL = timedelta(hours=1)
+
+
+PARQUET = "parquet"
+NDJSON = "ndjson"
+
+
+def load_file(client, path, table_id, schema=None, source_format=NDJSON):
+    """
+    Appends a newline-delimited JSON (or Parquet) file to table_id with one
+    load job. Returns the finished job.
+    """
+    if source_format == PARQUET:
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+    else:
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            ignore_unknown_values=True,
+        )
+    if schema is not None:
+        job_config.schema = schema
+    with open(path, "rb") as source:
+        job = client.load_table_from_file(source, table_id, job_config=job_config)
+    job.result()
+    return job
+
+
+def staged_merge(client, table_id, path, key_field, newer_wins=None, source_format=NDJSON):
+    """
+    Upserts a newline-delimited JSON (or Parquet) file into table_id:
+    1. Loads the file into a short-lived staging table with the target schema.
+       Parquet files carry JSON columns as text, so those are staged as
+       STRING and parsed back in the MERGE.
+    2. Runs one MERGE keyed on key_field. If the same key appears several
+       times in the batch the newest row (by newer_wins) is used, and an
+       existing row is only overwritten when the incoming one is not older.
+    3. Drops the staging table.
+
+    Note: MERGE cannot update rows that are still in the streaming buffer, so
+    tables that are upserted should not also receive streaming inserts.
+    """
+    target = client.get_table(table_id)
+    columns = [field.name for field in target.schema]
+    if key_field not in columns:
+        raise ValueError(f"Key field {key_field} not in schema of {table_id}")
+    if newer_wins not in columns:
+        newer_wins = None
+
+    staging_id = f"{table_id}__staging_{uuid.uuid4().hex[:12]}"
+    staging_schema = target.schema
+    json_columns = []
+    if source_format == PARQUET:
+        json_columns = [f.name for f in target.schema if f.field_type == "JSON"]
+        staging_schema = [
+            bigquery.SchemaField(f.name, "STRING", mode=f.mode) if f.field_type == "JSON" else f
+            for f in target.schema
+        ]
+    staging = bigquery.Table(staging_id, schema=staging_schema)
+    staging.expires = datetime.now(timezone.utc) + STAGING_TABLE_TTL
+    client.create_table(staging)
+
+    try:
+        load_file(client, path, staging_id, schema=staging_schema, source_format=source_format)
+
+        order_by = f"S.`{newer_wins}` DESC" if newer_wins else "1"
+        match_condition = ""
+        if newer_wins:
+            match_condition = f" AND (T.`{newer_wins}` IS NULL OR S.`{newer_wins}` >= T.`{newer_wins}`)"
+        updates = ", ".join(f"`{c}` = S.`{c}`" for c in columns if c != key_field)
+        # Same column order as the target, so INSERT ROW still lines up
+        select = "*"
+        if json_columns:
+            select = ", ".join(
+                f"SAFE.PARSE_JSON(S.`{c}`) AS `{c}`" if c in json_columns else f"S.`{c}`" for c in columns
+            )
+
+        query = f"""
+            MERGE `{table_id}` T
+            USING (
+                SELECT {select} FROM `{staging_id}` S
+                WHERE S.`{key_field}` IS NOT NULL
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY S.`{key_field}` ORDER BY {order_by}) = 1
+            ) S
+            ON T.`{key_field}` = S.`{key_field}`
+            WHEN MATCHED{match_condition} THEN
+                UPDATE SET {updates}
+            WHEN NOT MATCHED THEN
+                INSERT ROW
+        """
+        job = client.query(query)
+        job.result()
+        return job.num_dml_affected_rows
+    finally:
+        client.delete_table(staging_id, not_found_ok=True)
+
+
+class _BaseWriter:
+    def __init__(self, client, staging_dir=None):
+        self.client = client
+        self.staging_dir = staging_dir or tempfile.gettempdir()
+        self.schemas = {}
+        # table_id -> fields seen in rows but missing from the table schema
+        self.drift = {}
+        self.drift_lock = threading.Lock()
+
+    def _schema(self, table_id):
+        """
+        [(name, type)] of the target table, read once. Empty if unavailable.
+        """
+        if table_id not in self.schemas:
+            try:
+                table = self.client.get_table(table_id)
+                self.schemas[table_id] = [(f.name, f.field_type) for f in table.schema]
+            except Exception as e:
+                logger.warning(f"Could not read schema for {table_id}: {e}")
+                self.schemas[table_id] = []
+        return self.schemas[table_id]
+
+    def _json_columns(self, table_id):
+        """
+        Columns of type JSON. Streaming inserts parse JSON-encoded strings for
+        these, a load job would store them as JSON strings instead, so they are
+        decoded back before writing to a file.
+        """
+        return [name for name, field_type in self._schema(table_id) if field_type == "JSON"]
+
+    def _track_drift(self, table_id, rows):
+        """
+        Records (and warns once about) row fields the table has no column for.
+        They are dropped on write, so a new TestRail field shows up here first.
+        """
+        fields = self._schema(table_id)
+        if not fields or not rows:
+            return
+        keys = set()
+        for row in rows:
+            keys.update(row)
+        unknown = keys.difference(name for name, _ in fields)
+        if not unknown:
+            return
+        with self.drift_lock:
+            seen = self.drift.setdefault(table_id, set())
+            new = unknown - seen
+            seen.update(new)
+        if new:
+            logger.warning(f"Schema drift on {table_id}: fields not in table schema {sorted(new)}")
+
+    def schema_drift(self):
+        with self.drift_lock:
+            return {table_id: sorted(columns) for table_id, columns in self.drift.items()}
+
+    def _open_file(self):
+        return tempfile.NamedTemporaryFile(
+            mode="w", suffix=".ndjson", prefix="bq_", dir=self.staging_dir, delete=False
+        )
+
+    def _write_lines(self, handle, table_id, rows):
+        json_columns = self._json_columns(table_id)
+        for row in rows:
+            for column in json_columns:
+                value = row.get(column)
+                if isinstance(value, str):
+                    try:
+                        row[column] = json.loads(value)
+                    except ValueError:
+                        pass
+            handle.write(json.dumps(row, default=str))
+            handle.write("\n")
+
+
+class StreamingWriter(_BaseWriter):
+    """
+    Writes every batch immediately with the streaming API (insert_rows_json).
+    Rows are billed per row and sit in the streaming buffer for a while,
+    where DML (MERGE/UPDATE/DELETE) cannot touch them.
+    Upserts still go through a staged MERGE, one per batch.
+    """
+    def write(self, table_id, rows, merge=None):
+        self._track_drift(table_id, rows)
+        table_name = table_id.split(".")[-1]
+        start = time.monotonic()
+        if merge:
+            handle = self._open_file()
+            try:
+                self._write_lines(handle, table_id, rows)
+                handle.close()
+                staged_merge(self.client, table_id, handle.name, *merge)
+            finally:
+                handle.close()
+                os.remove(handle.name)
+            metrics.record_bq_write(table_name, "merge", time.monotonic() - start)
+            return
+
+        errors = self.client.insert_rows_json(table_id, rows, ignore_unknown_values=True)
+        metrics.record_bq_write(table_name, "stream", time.monotonic() - start)
+        if errors:
+            logger.error(f"Encountered errors while inserting rows: {errors}")
+            # Print to stdout/stderr as well for immediate visibility in scripts
+            print(f"BQ INSERT ERRORS: {errors}")
+            raise Exception(f"BigQuery insert failed: {errors}")
+
+    def has_pending(self, table_id):
+        return False
+
+    def load_state(self, table_id):
+        return False, 0
+
+    def flush(self, table_ids=None):
+        return {}
+
+
+class LoadJobWriter(_BaseWriter):
+    """
+    Buffers rows to a local staging file per table and commits each file with
+    a single load job (or one staged MERGE for upserts) on flush().
+    Load jobs are free, have no per-request size limit and land directly in
+    table storage, so the data is immediately visible to MERGE.
+
+    staging_format "parquet" (needs pyarrow) writes typed, compressed columnar
+    files built from the table schema; "ndjson" writes one JSON line per row.
+    Appends to tables with JSON columns stay on NDJSON, since a Parquet load
+    cannot fill a JSON column from text without the MERGE step.
+    Safe to call write() from several threads.
+    """
+    def __init__(self, client, staging_dir=None, staging_format=NDJSON, compression="zstd"):
+        super().__init__(client, staging_dir)
+        if staging_format == PARQUET and not arrow_available():
+            logger.warning("pyarrow is not installed, staging load jobs as NDJSON")
+            staging_format = NDJSON
+        self.staging_format = staging_format
+        self.compression = compression
+        self.lock = threading.Lock()
+        # (table_id, merge spec or None) -> buffer
+        self.buffers = {}
+        # table_id -> flushes whose load/MERGE of it has not finished yet
+        self.in_flight = {}
+        # table_id -> failed loads/MERGEs since startup
+        self.failures = {}
+
+    def _buffer_format(self, table_id, merge):
+        if self.staging_format != PARQUET or not self._schema(table_id):
+            return NDJSON
+        if not merge and self._json_columns(table_id):
+            return NDJSON
+        return PARQUET
+
+    def _open_buffer(self, table_id, merge):
+        if self._buffer_format(table_id, merge) == PARQUET:
+            handle = tempfile.NamedTemporaryFile(suffix=".parquet", prefix="bq_", dir=self.staging_dir, delete=False)
+            handle.close()
+            batch = ArrowBatchWriter(handle.name, self._schema(table_id), compression=self.compression)
+            return {"path": handle.name, "file": batch, "rows": 0, "format": PARQUET}
+        handle = self._open_file()
+        return {"path": handle.name, "file": handle, "rows": 0, "format": NDJSON}
+
+    def write(self, table_id, rows, merge=None):
+        key = (table_id, tuple(merge) if merge else None)
+        self._track_drift(table_id, rows)
+        with self.lock:
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                buffer = self.buffers[key] = self._open_buffer(table_id, merge)
+
+            if buffer["format"] == PARQUET:
+                buffer["file"].append(rows)
+            else:
+                self._write_lines(buffer["file"], table_id, rows)
+            buffer["rows"] += len(rows)
+
+    def has_pending(self, table_id):
+        """
+        Whether table_id has rows that are not committed yet: buffered, or
+        being loaded by a flush() on another thread.
+        """
+        return self.load_state(table_id)[0]
+
+    def load_state(self, table_id):
+        """
+        (has_pending(table_id), failed loads of table_id so far), read together.
+        """
+        with self.lock:
+            pending = table_id in self.in_flight or any(key[0] == table_id for key in self.buffers)
+            return pending, self.failures.get(table_id, 0)
+
+    def flush(self, table_ids=None):
+        """
+        Commits every buffered table (or only `table_ids`): plain appends with
+        one load job, upserts with one staged MERGE. The tables stay pending
+        until their load has finished; a failed load counts against every
+        table this flush took (see load_state()).
+        Returns {table_id: rows_written}.
+        """
+        with self.lock:
+            selected = [key for key in self.buffers if table_ids is None or key[0] in table_ids]
+            pending = {key: self.buffers.pop(key) for key in selected}
+            # Still pending for has_pending() until the load below has finished
+            for table_id, _ in pending:
+                self.in_flight[table_id] = self.in_flight.get(table_id, 0) + 1
+
+        loaded = {}
+        failed = True
+        try:
+            for (table_id, merge), buffer in pending.items():
+                buffer["file"].close()
+                start = time.monotonic()
+                if merge:
+                    staged_merge(self.client, table_id, buffer["path"], *merge, source_format=buffer["format"])
+                    logger.info(f"Merged {buffer['rows']} rows into {table_id} on {merge[0]}")
+                else:
+                    job = load_file(self.client, buffer["path"], table_id, source_format=buffer["format"])
+                    logger.info(f"Loaded {buffer['rows']} rows into {table_id} (job {job.job_id})")
+                metrics.record_bq_write(table_id.split(".")[-1], "merge" if merge else "load", time.monotonic() - start)
+                loaded[table_id] = loaded.get(table_id, 0) + buffer["rows"]
+            failed = False
+        finally:
+            for buffer in pending.values():
+                buffer["file"].close()
+                if os.path.exists(buffer["path"]):
+                    os.remove(buffer["path"])
+            with self.lock:
+                for table_id, _ in pending:
+                    if failed:
+                        self.failures[table_id] = self.failures.get(table_id, 0) + 1
+                    self.in_flight[table_id] -= 1
+                    if not self.in_flight[table_id]:
+                        del self.in_flight[table_id]
+        return loaded
@@ -0,0 +1,57 @@
+import os
+import time
+import threading
+import logging
+from secret_cache import SecretCache
+from sync_engine import SyncEngine
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_engine = None
+_secrets = None
+_sync_listeners = []
+
+
+def on_sync(listener):
+    """
+    Registers listener(entity, result) to be called after every run_sync
+    or shard worker run of the process-wide engine (e.g. to drop caches of
+    synced data).
+    """
+    with _lock:
+        _sync_listeners.append(listener)
+        if _engine is not None:
+            _engine.sync_listeners.append(listener)
+
+
+def get_secrets():
+    """
+    The process-wide SecretCache.
+    """
+    global _secrets
+    with _lock:
+        if _secrets is None:
+            _secrets = SecretCache(os.environ.get("GCP_PROJECT_ID"))
+        return _secrets
+
+
+def get_engine():
+    """
+    Returns the process-wide SyncEngine, built on first use and reused by
+    every later request, so the Secret Manager, BigQuery and TestRail
+    clients (with their connection pools and caches) stay warm.
+    Credentials are re-checked against the secret cache on each call.
+    """
+    global _engine
+    secrets = get_secrets()
+    with _lock:
+        if _engine is None:
+            start = time.monotonic()
+            _engine = SyncEngine(secrets=secrets)
+            _engine.sync_listeners.extend(_sync_listeners)
+            logger.info(f"Sync engine initialized in {time.monotonic() - start:.3f}s")
+        else:
+            _engine.refresh_credentials()
+        return _engine
+
@@ -0,0 +1,330 @@
+import re
+import json
+import time
+import random
+import threading
+import logging
+import metrics
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from bigquery_client import BigQueryClient
+
+logger = logging.getLogger(__name__)
+
+# Synthetic data starts here (epoch seconds)
+BASE_TS = 1700000000
+
+
+class FakeDataset:
+    """
+    Deterministic synthetic TestRail/Jira data, generated page by page so
+    a million results never sit in memory.
+    results_total results are spread over runs of results_per_run results
+    (one test per result) across `projects` projects.
+    """
+    def __init__(self, projects=2, results_total=10000, results_per_run=250, cases_per_project=500,
+                 jira_issues=1000):
+        self.projects = projects
+        self.results_per_run = results_per_run
+        self.runs_per_project = max(1, -(-results_total // results_per_run // projects))
+        self.cases_per_project = cases_per_project
+        self.jira_issues = jira_issues
+
+    def project_ids(self):
+        return list(range(1, self.projects + 1))
+
+    def run_ids(self, project_id):
+        return [project_id * 100000 + i for i in range(1, self.runs_per_project + 1)]
+
+    def run(self, run_id):
+        project_id, i = divmod(run_id, 100000)
+        created = BASE_TS + i * 3600
+        return {
+            "id": run_id, "project_id": project_id, "suite_id": project_id * 10, "milestone_id": None,
+            "plan_id": None, "name": f"Run {run_id}", "description": None, "config": None,
+            "is_completed": True, "completed_on": created + 1800,
+            "passed_count": self.results_per_run - 3, "blocked_count": 1, "untested_count": 0,
+            "retest_count": 1, "failed_count": 1,
+            "custom_status1_count": 0, "custom_status2_count": 0,
+            "created_on": created, "created_by": 1, "updated_on": created + 1800,
+            "url": f"http://testrail.local/index.php?/runs/view/{run_id}",
+        }
+
+    def test(self, run_id, j):
+        return {
+            "id": run_id * 1000 + j, "case_id": j, "run_id": run_id, "status_id": 1,
+            "assignedto_id": 1, "title": f"Test case {j}", "template_id": 1, "type_id": 6,
+            "priority_id": 2, "estimate": None, "estimate_forecast": None, "refs": "CM-1",
+            "milestone_id": None, "custom_automation_type": 0, "custom_preconds": None,
+        }
+
+    def result(self, run_id, j):
+        return {
+            "id": run_id * 1000 + j, "test_id": run_id * 1000 + j, "status_id": 1 + j % 5,
+            "created_on": BASE_TS + (run_id % 100000) * 3600 + j, "created_by": 1, "assignedto_id": None,
+            "comment": "Executed by the nightly job", "version": "1.0.0", "elapsed": "1m 5s",
+            "defects": "CM-42" if j % 50 == 0 else None, "attachment_ids": [],
+            "custom_step_results": [{"content": "step", "expected": "ok", "actual": "ok", "status_id": 1}],
+        }
+
+    def case(self, project_id, j):
+        return {
+            "id": project_id * 100000 + j, "title": f"Case {j}", "section_id": 1, "template_id": 1,
+            "type_id": 6, "priority_id": 2, "milestone_id": None, "refs": None, "created_by": 1,
+            "created_on": BASE_TS + j, "updated_by": 1, "updated_on": BASE_TS + j, "estimate": None,
+            "suite_id": project_id * 10, "custom_automation_type": 0, "custom_steps": "Do it",
+        }
+
+    def issue(self, i, now):
+        updated = datetime.fromtimestamp(now - i * 3600, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000+0000")
+        return {
+            "id": str(10000 + i), "key": f"CM-{i}",
+            "fields": {
+                "summary": f"Issue {i}", "status": {"name": "Done"}, "priority": {"name": "Medium"},
+                "created": updated, "updated": updated, "assignee": {"displayName": "QA"},
+                "reporter": {"displayName": "Dev"}, "resolution": {"name": "Fixed"},
+            },
+        }
+
+
+def _page(items, key, offset, limit):
+    page = items[offset:offset + limit]
+    return {"offset": offset, "limit": limit, "size": len(page), "_links": {}, key: page}
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """
+    Serves the TestRail v2 endpoints the sync uses (index.php?/api/v2/...)
+    and Jira's POST /rest/api/3/search/jql from a FakeDataset.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _count(self, endpoint, status):
+        server = self.server
+        with server.lock:
+            server.calls[endpoint] = server.calls.get(endpoint, 0) + 1
+            if status == 429:
+                server.throttled[endpoint] = server.throttled.get(endpoint, 0) + 1
+
+    def _throttle(self, endpoint):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            limited = server.rate_429 and server.random.random() < server.rate_429
+        if limited:
+            self._count(endpoint, 429)
+            self._send(429, {"error": "Too many requests"}, {"Retry-After": str(server.retry_after)})
+            return True
+        self._count(endpoint, 200)
+        return False
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path == "/__stats":
+            with self.server.lock:
+                return self._send(200, {"calls": dict(self.server.calls), "throttled": dict(self.server.throttled)})
+        # index.php?/api/v2/get_runs/1&offset=0&limit=250
+        route, _, query = parts.query.partition("&")
+        params = {k: v[0] for k, v in parse_qs(query).items()}
+        segments = route.strip("/").split("/")[2:]
+        if not segments:
+            return self._send(404, {"error": "Unknown route"})
+        endpoint = segments[0]
+        arg = int(segments[1]) if len(segments) > 1 else None
+        if self._throttle(endpoint):
+            return
+        self._send(200, self._testrail(endpoint, arg, params))
+
+    def _testrail(self, endpoint, arg, params):
+        data = self.server.dataset
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 250))
+        if endpoint == "get_projects":
+            projects = [{"id": p, "name": f"Project {p}", "suite_mode": 1, "is_completed": False}
+                        for p in data.project_ids()]
+            return _page(projects, "projects", 0, len(projects))
+        if endpoint == "get_runs":
+            after = int(params.get("updated_after", 0))
+            runs = [data.run(run_id) for run_id in data.run_ids(arg)]
+            runs = [run for run in runs if run["updated_on"] > after]
+            return _page(runs, "runs", 0, len(runs))
+        if endpoint == "get_tests":
+            stop = min(offset + limit, data.results_per_run)
+            return _page([data.test(arg, j) for j in range(offset + 1, stop + 1)], "tests", 0, limit)
+        if endpoint == "get_results_for_run":
+            after = int(params.get("created_after", 0))
+            results = [data.result(arg, j) for j in range(1, data.results_per_run + 1)]
+            results = [r for r in results if r["created_on"] > after]
+            return _page(results, "results", offset, limit)
+        if endpoint == "get_cases":
+            after = int(params.get("updated_after", 0))
+            stop = min(offset + limit, data.cases_per_project)
+            cases = [data.case(arg, j) for j in range(offset + 1, stop + 1)]
+            return _page([c for c in cases if c["updated_on"] > after], "cases", 0, limit)
+        if endpoint == "get_plans":
+            return _page([], "plans", 0, 0)
+        if endpoint == "get_milestones":
+            milestone = {"id": arg * 10, "project_id": arg, "name": "Release", "is_completed": True,
+                         "completed_on": BASE_TS, "due_on": BASE_TS}
+            return _page([milestone], "milestones", 0, 1)
+        if endpoint == "get_milestone":
+            return {"id": arg, "name": "Release", "is_completed": True, "completed_on": BASE_TS, "due_on": BASE_TS}
+        if endpoint == "get_suites":
+            return [{"id": arg * 10, "name": "Master", "project_id": arg}]
+        if endpoint == "get_statuses":
+            return [{"id": i, "name": name, "label": name.title(), "is_final": True}
+                    for i, name in enumerate(["passed", "blocked", "untested", "retest", "failed"], 1)]
+        if endpoint == "get_users":
+            return [{"id": 1, "name": "QA", "email": "qa@example.com", "is_active": True}]
+        return {"error": f"Unknown endpoint {endpoint}"}
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.startswith("/rest/api/3/search/jql"):
+            return self._send(404, {"error": "Unknown route"})
+        if self._throttle("search/jql"):
+            return
+        # Only the relative "updated" bounds the sync generates are understood
+        jql = body.get("jql", "")
+        now = self.server.started_at
+        newest = [int(m) for m in re.findall(r"updated >= -(\d+)m", jql)]
+        oldest = [int(m) for m in re.findall(r"updated < -(\d+)m", jql)]
+        matching = [
+            i for i in range(self.server.dataset.jira_issues)
+            if (not newest or i * 60 <= newest[0]) and (not oldest or i * 60 > oldest[0])
+        ]
+        offset = int(body.get("nextPageToken") or 0)
+        limit = int(body.get("maxResults", 50))
+        page = matching[offset:offset + limit]
+        response = {"issues": [self.server.dataset.issue(i, now) for i in page]}
+        if offset + limit < len(matching):
+            response["nextPageToken"] = str(offset + limit)
+        self._send(200, response)
+
+
+def serve(port, dataset, latency_ms=0, rate_429=0.0, retry_after=1, seed=42, ready=None):
+    """
+    Runs the fake TestRail/Jira server on 127.0.0.1:port until killed.
+    Meant to run in its own process, so serving does not compete with the
+    sync for the GIL. GET /__stats returns request counts per endpoint.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeApiHandler)
+    server.daemon_threads = True
+    server.dataset = dataset
+    server.latency = latency_ms / 1000.0
+    server.rate_429 = rate_429
+    server.retry_after = retry_after
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    server.calls = {}
+    server.throttled = {}
+    server.started_at = int(time.time())
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
+
+
+class InMemoryBigQueryClient(BigQueryClient):
+    """
+    BigQueryClient double for benchmarks. Rows go through the real
+    normalizers and are serialized like a load job would, but are only
+    counted; raw_runs, run_fingerprints, content_hashes, api_tuning and
+    sync_state are kept so incremental syncs behave as they would against
+    BigQuery.
+    """
+    RETAINED_TABLES = ("raw_runs", "run_fingerprints", "content_hashes", "api_tuning")
+
+    def __init__(self, dataset_ref="bench.testrail_kpis"):
+        self.dataset_ref = dataset_ref
+        self.dataset_id = dataset_ref.split(".")[-1]
+        self.client = None
+        self._normalizers = {}
+        self.lock = threading.Lock()
+        self.tables = {name: {} for name in self.RETAINED_TABLES}
+        self.state = {}
+        self.rows_written = {}
+        self.bytes_written = 0
+
+    def _store(self, table_name, rows, key_field=None):
+        # What a load job would have to serialize
+        size = sum(len(json.dumps(row, default=str)) for row in rows)
+        metrics.record_bq_rows(table_name, len(rows))
+        with self.lock:
+            self.rows_written[table_name] = self.rows_written.get(table_name, 0) + len(rows)
+            self.bytes_written += size
+            if table_name in self.tables and key_field:
+                for row in rows:
+                    self.tables[table_name][row[key_field]] = row
+
+    def insert_rows(self, table_name, rows, cleaned=False):
+        if rows:
+            self._store(table_name, rows if cleaned else self.clean_rows(table_name, rows))
+
+    def upsert_rows(self, table_name, rows, key_field="id", newer_wins="_extracted_at", cleaned=False):
+        if rows:
+            self._store(table_name, rows if cleaned else self.clean_rows(table_name, rows), key_field)
+
+    def flush(self, table_names=None):
+        return {}
+
+    def schema_drift(self):
+        return {}
+
+    def get_watermark(self, entity_type, scope_id=None):
+        return self.state.get((entity_type, str(scope_id) if scope_id else None), (0, None))[0]
+
+    def update_watermark(self, entity_type, watermark, scope_id=None, status="SUCCESS", after_table=None,
+                         synced_at=None):
+        with self.lock:
+            self.state[(entity_type, str(scope_id) if scope_id else None)] = (watermark, synced_at or int(time.time()))
+
+    def get_content_hashes(self, table_name):
+        with self.lock:
+            return {row["row_key"]: row["content_hash"] for row in self.tables["content_hashes"].values()
+                    if row["table_name"] == table_name}
+
+    def get_tuning(self, client_name):
+        with self.lock:
+            return {row["setting"]: row["value"] for row in self.tables["api_tuning"].values()
+                    if row["client"] == client_name}
+
+    def get_checkpoints(self, entity_type):
+        return {scope: value for (entity, scope), value in self.state.items() if entity == entity_type and value[0]}
+
+    def get_changed_runs(self, entity, project_id, include_unchanged=False):
+        with self.lock:
+            runs = [run for run in self.tables["raw_runs"].values() if run.get("project_id") == project_id]
+            captured = dict(self.tables["run_fingerprints"])
+        changed = []
+        for run in sorted(runs, key=lambda r: r["id"]):
+            fingerprint = json.dumps([run.get(f) for f in self.RUN_FINGERPRINT_FIELDS], default=str)
+            previous = captured.get(f"{entity}:{run['id']}")
+            if (include_unchanged or previous is None
+                    or (previous["fingerprint"] != fingerprint and not previous["is_completed"])):
+                updated = run.get("updated_on") or run.get("created_on")
+                changed.append({
+                    "id": run["id"],
+                    "updated_ts": int(datetime.fromisoformat(updated).replace(tzinfo=timezone.utc).timestamp())
+                    if updated else None,
+                    "fingerprint": fingerprint,
+                    "is_completed": run.get("is_completed"),
+                    "captured_at": int(datetime.fromisoformat(previous["captured_at"])
+                                       .replace(tzinfo=timezone.utc).timestamp()) if previous else None,
+                    "captured_fingerprint": previous["fingerprint"] if previous else None,
+                })
+        return changed
@@ -0,0 +1,213 @@
+import time
+import threading
+import logging
+import requests
+import metrics
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitError(requests.exceptions.RequestException):
+    """
+    Raised on HTTP 429. Carries the server's Retry-After (seconds) when given.
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    Retry-After is either a number of seconds or an HTTP date.
+    Returns seconds to wait, or None if the header is missing/unparseable.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Every request takes one token; tokens refill at
+    `rate` per second up to `capacity`. A 429 pauses the whole bucket so all
+    threads back off together instead of each hammering the server.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, blocking=True):
+        """
+        Takes a token and returns 0, or returns the seconds to wait before
+        trying again. With blocking=False (coroutines) a lock held by
+        another thread is not waited for either; the caller just retries.
+        """
+        if self.rate <= 0:
+            return 0
+        if not self.lock.acquire(blocking=blocking):
+            return 0.001
+        try:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+        finally:
+            self.lock.release()
+
+    def acquire(self):
+        while True:
+            delay = self.reserve()
+            if not delay:
+                return
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+class EndpointStats:
+    """
+    Per-endpoint call, latency and retry counters.
+    Endpoints are keyed without their ID suffix (get_results_for_run/42 -> get_results_for_run).
+    Every call and retry is also exported to the process metrics under `client`.
+    """
+    def __init__(self, client="http"):
+        self.client = client
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    @staticmethod
+    def endpoint_key(endpoint):
+        """
+        The endpoint without its ID segments ("get_tests/42" -> "get_tests",
+        "search/jql" as is). Stats, metrics and tuning all key on it.
+        """
+        return "/".join(part for part in endpoint.split('/') if not part.isdigit())
+
+    def _entry(self, endpoint):
+        key = self.endpoint_key(endpoint)
+        if key not in self.endpoints:
+            self.endpoints[key] = {
+                "calls": 0, "errors": 0, "retries": 0, "rate_limited": 0,
+                "total_latency_s": 0.0, "max_latency_s": 0.0,
+            }
+        return self.endpoints[key]
+
+    def record_call(self, endpoint, latency, status_code, size=0):
+        metrics.record_api_call(self.client, self.endpoint_key(endpoint), latency, status_code, size)
+        with self.lock:
+            entry = self._entry(endpoint)
+            entry["calls"] += 1
+            entry["total_latency_s"] += latency
+            entry["max_latency_s"] = max(entry["max_latency_s"], latency)
+            if status_code == 429:
+                entry["rate_limited"] += 1
+            elif status_code is None or status_code >= 400:
+                entry["errors"] += 1
+
+    def record_retry(self, endpoint):
+        metrics.record_api_retry(self.client, self.endpoint_key(endpoint))
+        with self.lock:
+            self._entry(endpoint)["retries"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            result = {}
+            for key, entry in self.endpoints.items():
+                item = dict(entry)
+                item["avg_latency_s"] = entry["total_latency_s"] / entry["calls"] if entry["calls"] else 0.0
+                result[key] = item
+            return result
+
+
+class RateLimitedSession:
+    """
+    A pooled keep-alive requests.Session shared by all threads of a client,
+    throttled by a TokenBucket and instrumented with EndpointStats.
+    With a tuner (autotune.AdaptiveController) the number of requests in
+    flight is also capped by the tuner's current limit.
+    """
+    def __init__(self, rate_per_sec=0, burst=1, pool_size=10, auth=None, headers=None, name="http", tuner=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if auth:
+            self.session.auth = auth
+        if headers:
+            self.session.headers.update(headers)
+
+        self.bucket = TokenBucket(rate_per_sec, max(1, burst))
+        self.stats = EndpointStats(name)
+        self.tuner = tuner
+
+    def request(self, method, url, endpoint, **kwargs):
+        """
+        Sends one throttled request. Raises RateLimitError on 429 after
+        pausing the shared bucket for the server's Retry-After.
+        """
+        if self.tuner:
+            self.tuner.acquire()
+        latency, status_code = 0.0, None
+        try:
+            self.bucket.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                latency = time.monotonic() - start
+                self.stats.record_call(endpoint, latency, None)
+                raise
+            latency, status_code = time.monotonic() - start, response.status_code
+            self.stats.record_call(endpoint, latency, status_code, len(response.content))
+        finally:
+            if self.tuner:
+                self.tuner.release(self.stats.endpoint_key(endpoint), latency, status_code)
+
+        if response.status_code == 429:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                self.bucket.pause(retry_after)
+            logger.warning(f"Rate limit hit on {self.stats.endpoint_key(endpoint)} (Retry-After={retry_after})")
+            raise RateLimitError("Rate limit hit", retry_after=retry_after)
+
+        return response
+
+    def get(self, url, endpoint, **kwargs):
+        return self.request("GET", url, endpoint, **kwargs)
+
+    def post(self, url, endpoint, **kwargs):
+        return self.request("POST", url, endpoint, **kwargs)
+
+
+def wait_retry_after(fallback):
+    """
+    Tenacity wait strategy: honour RateLimitError.retry_after when the server
+    sent one, otherwise defer to the `fallback` wait (e.g. wait_exponential).
+    """
+    def _wait(retry_state):
+        exc = retry_state.outcome.exception() if retry_state.outcome else None
+        if isinstance(exc, RateLimitError) and exc.retry_after is not None:
+            return exc.retry_after
+        return fallback(retry_state)
+    return _wait
@@ -1,18 +1,76 @@
 import os
 import requests
 import logging
+from datetime import datetime
 from requests.auth import HTTPBasicAuth
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception
+from http_session import RateLimitedSession, wait_retry_after
+from autotune import AdaptiveController, autotune_enabled
+
+
+def _is_retryable(exc):
+    # Retry throttling, connection problems and 5xx; 4xx (bad JQL, auth) fail fast
+    if isinstance(exc, requests.exceptions.HTTPError):
+        return exc.response is not None and exc.response.status_code >= 500
+    return isinstance(exc, requests.exceptions.RequestException)
+
+
+def _count_retry(retry_state):
+    retry_state.args[0].session.stats.record_retry("search/jql")
+
+
+def _raise_exhausted(retry_state):
+    # Out of retries: the last error (only warned about so far) is final
+    logging.getLogger(__name__).error(
+        f"Jira request failed after {retry_state.attempt_number} attempts: {retry_state.outcome.exception()}")
+    return retry_state.outcome.result()
+
 
 class JiraClient:
     def __init__(self):
-        self.base_url = "https://surapanama.atlassian.net"
+        self.base_url = os.getenv('JIRA_BASE_URL', "https://surapanama.atlassian.net")
         self.email = os.getenv('JIRA_EMAIL')
         self.token = os.getenv('JIRA_TOKEN')
         self.logger = logging.getLogger(__name__)
+        # Timestamps are written in the container's zone (UTC on Cloud Run)
+        self.local_tz = datetime.utcnow().astimezone().tzinfo
 
         if not self.email or not self.token:
             self.logger.warning("JIRA_EMAIL or JIRA_TOKEN not set. Jira sync will fail.")
 
+        pool_size = int(os.getenv('JIRA_POOL_SIZE', '8'))
+        self.page_size = int(os.getenv('JIRA_PAGE_SIZE', '100'))
+        self.tuner = None
+        if autotune_enabled():
+            # Jira may serve fewer issues per page than asked for; the first short page caps the size
+            self.tuner = AdaptiveController(
+                "jira",
+                max_concurrency=int(os.getenv('JIRA_MAX_CONCURRENCY', str(pool_size))),
+                page_sizes={"search/jql": (self.page_size, max(self.page_size, int(os.getenv('JIRA_MAX_PAGE_SIZE', '500'))))},
+            )
+
+        # One pooled keep-alive session (auth and headers set once) shared by all page fetchers
+        self.session = RateLimitedSession(
+            rate_per_sec=float(os.getenv('JIRA_MAX_RPS', '0')),
+            burst=10,
+            pool_size=pool_size,
+            auth=HTTPBasicAuth(self.email, self.token),
+            headers={
+                "Accept": "application/json",
+                "Content-Type": "application/json"
+            },
+            name="jira",
+            tuner=self.tuner,
+        )
+
+    @retry(
+        stop=stop_after_attempt(5),
+        # Jittered so threads rate-limited together do not retry together
+        wait=wait_retry_after(wait_random_exponential(multiplier=1, min=2, max=60)),
+        retry=retry_if_exception(_is_retryable),
+        before_sleep=_count_retry,
+        retry_error_callback=_raise_exhausted
+    )
     def get_issues(self, jql, next_page_token=None, max_results=50):
         """
         Fetch issues using JQL with pagination support via POST /search/jql endpoint.
@@ -20,14 +78,6 @@ class JiraClient:
         """
         url = f"{self.base_url}/rest/api/3/search/jql"
         
-        # Use Basic Auth with email and token
-        auth = HTTPBasicAuth(self.email, self.token)
-        
-        headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json"
-        }
-        
         # POST body for search/jql
         # Note: This endpoint uses 'nextPageToken' for pagination, NOT 'startAt'
         payload = {
@@ -40,38 +90,55 @@ class JiraClient:
             payload["nextPageToken"] = next_page_token
 
         try:
-            response = requests.post(url, headers=headers, json=payload, auth=auth)
+            response = self.session.post(url, "search/jql", json=payload)
             response.raise_for_status()
-            return response.json()
+            data = response.json()
         except requests.exceptions.HTTPError as e:
-            self.logger.error(f"Jira API Error: {e.response.text}")
+            # 429/5xx are retried, and logged as errors only once retries run out
+            self.logger.log(logging.WARNING if _is_retryable(e) else logging.ERROR, f"Jira API Error: {e.response.text}")
             raise
         except Exception as e:
-            self.logger.error(f"Jira Connection Error: {str(e)}")
+            self.logger.log(logging.WARNING if _is_retryable(e) else logging.ERROR, f"Jira Connection Error: {str(e)}")
             raise
 
-    def get_all_issues(self, jql):
+        if self.tuner:
+            returned = len(data.get('issues') or [])
+            if data.get('nextPageToken') and returned < max_results:
+                self.tuner.cap_page_size("search/jql", returned)
+            self.tuner.record_page("search/jql", max_results, returned,
+                                   response.elapsed.total_seconds(), len(response.content))
+        return data
+
+    def iter_issue_pages(self, jql, max_results=None):
         """
-        Generator to fetch all issues for a given JQL query.
+        Generator yielding one page of transformed issues at a time.
+        Pages are sized by the tuner unless max_results is given.
         """
         next_token = None
-        max_results = 100
         
         while True:
             self.logger.info(f"Fetching Jira issues (token={next_token or 'initial'})...")
-            data = self.get_issues(jql, next_token, max_results)
+            page_size = max_results or (self.tuner.page_size("search/jql") if self.tuner else self.page_size)
+            data = self.get_issues(jql, next_token, page_size)
             issues = data.get('issues', [])
             
             if not issues:
                 break
                 
-            for issue in issues:
-                yield self._transform_issue(issue)
+            yield [self._transform_issue(issue) for issue in issues]
             
             next_token = data.get('nextPageToken')
             if not next_token:
                 break
 
+    def get_all_issues(self, jql):
+        """
+        Generator to fetch all issues for a given JQL query.
+        """
+        for page in self.iter_issue_pages(jql):
+            for issue in page:
+                yield issue
+
     def _transform_issue(self, issue):
         """
         Flatten the nested Jira issue structure for BigQuery.
@@ -84,12 +151,11 @@ class JiraClient:
                 return None
             try:
                 # Jira format: 2023-01-16T10:39:19.462-0500
-                from datetime import datetime
-                # Handle %z in python 3.7+
-                dt = datetime.strptime(ts_str, "%Y-%m-%dT%H:%M:%S.%f%z")
+                # fromisoformat parses this natively and is much cheaper than strptime
+                dt = datetime.fromisoformat(ts_str)
                 # Convert to UTC and remove tzinfo for BQ strictness or keep it ISO
                 # BQ recommends 'YYYY-MM-DD HH:MM:SS.SSSSSS' UTC
-                return dt.astimezone(datetime.utcnow().astimezone().tzinfo).strftime("%Y-%m-%d %H:%M:%S.%f")
+                return dt.astimezone(self.local_tz).strftime("%Y-%m-%d %H:%M:%S.%f")
             except Exception:
                 # Fallback or return original if parsing fails (might be different format)
                 return ts_str
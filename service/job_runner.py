@@ -0,0 +1,131 @@
+import os
+import uuid
+import threading
+import logging
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class JobRejected(Exception):
+    """
+    Raised by submit() when the job cannot be queued. `job` is the
+    conflicting job, if any.
+    """
+    def __init__(self, message, job=None):
+        super().__init__(message)
+        self.job = job
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class JobRunner:
+    """
+    In-process background queue for sync jobs.
+    A small thread pool runs the jobs; at most max_pending jobs may be queued
+    or running at once, and an entity that is already queued or running
+    (directly or as part of "all") is not accepted a second time.
+    Job state lives in memory, so it is per instance/process and only the
+    last `history` finished jobs are kept.
+    """
+    def __init__(self, max_workers=None, max_pending=None, history=None):
+        self.max_workers = max_workers or int(os.environ.get("SYNC_JOB_WORKERS", "2"))
+        self.max_pending = max_pending or int(os.environ.get("SYNC_JOB_MAX_PENDING", "10"))
+        self.history = history or int(os.environ.get("SYNC_JOB_HISTORY", "100"))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="sync-job")
+        self.lock = threading.Lock()
+        self.jobs = {}
+        # entity -> job_id for every queued/running job
+        self.active = {}
+
+    def submit(self, entity, covers, fn):
+        """
+        Queues fn(progress) as a job for `entity`. covers lists every entity
+        the job syncs. progress(name, result) records one finished entity.
+        Returns the job dict; raises JobRejected on a duplicate or full queue.
+        """
+        with self.lock:
+            for name in covers:
+                if name in self.active:
+                    job = self.jobs[self.active[name]]
+                    raise JobRejected(f"A sync including {name} is already {job['status']}", job)
+            if len(set(self.active.values())) >= self.max_pending:
+                raise JobRejected(f"Too many sync jobs pending ({self.max_pending})")
+
+            job_id = uuid.uuid4().hex
+            job = {
+                "job_id": job_id,
+                "entity": entity,
+                "status": "queued",
+                "submitted_at": _now(),
+                "started_at": None,
+                "finished_at": None,
+                "progress": {"completed": 0, "total": len(covers)},
+                "entities": {},
+                "error": None,
+                "result": None,
+            }
+            self.jobs[job_id] = job
+            for name in covers:
+                self.active[name] = job_id
+            self._prune()
+
+        self.executor.submit(self._run, job_id, covers, fn)
+        logger.info(f"Queued sync job {job_id} for {entity}")
+        return self.get(job_id)
+
+    def _run(self, job_id, covers, fn):
+        with self.lock:
+            job = self.jobs[job_id]
+            job["status"] = "running"
+            job["started_at"] = _now()
+
+        def progress(name, result):
+            with self.lock:
+                job["entities"][name] = result
+                job["progress"]["completed"] = len(job["entities"])
+
+        try:
+            result = fn(progress)
+            if isinstance(result, dict):
+                # Entities skipped because a dependency failed are only in the final report
+                for name, entity_result in result.get("detailed_results", {}).items():
+                    if name not in job["entities"]:
+                        progress(name, entity_result)
+            status = result.get("status", "success") if isinstance(result, dict) else "success"
+            error = result.get("error") if isinstance(result, dict) else None
+        except Exception as e:
+            logger.exception(f"Sync job {job_id} failed")
+            result, status, error = None, "error", str(e)
+
+        with self.lock:
+            job["status"] = status
+            job["error"] = error
+            if isinstance(result, dict):
+                # Timings, critical path, API stats... (per-entity results are under "entities")
+                job["result"] = {k: v for k, v in result.items() if k != "detailed_results"}
+            job["finished_at"] = _now()
+            for name in covers:
+                if self.active.get(name) == job_id:
+                    del self.active[name]
+        logger.info(f"Sync job {job_id} for {job['entity']} finished with status {status}")
+
+    def _prune(self):
+        finished = [j for j in self.jobs.values() if j["finished_at"]]
+        if len(finished) > self.history:
+            finished.sort(key=lambda j: j["finished_at"])
+            for job in finished[:len(finished) - self.history]:
+                del self.jobs[job["job_id"]]
+
+    def get(self, job_id):
+        """
+        Returns a copy of the job, or None.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job, progress=dict(job["progress"]), entities=dict(job["entities"]))
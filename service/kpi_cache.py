@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
+
+# Tables served by GET /kpis/<table>
+KPI_TABLES = [
+    "dashboard_mart",
+    "dashboard_pruebas",
+    "dashboard_mart_projects",
+    "workload_by_analyst",
+    "project_analyst_demand",
+    "jira_defects_summary",
+    "KPIs_Plan",
+    "KPIs_Mes",
+    "kpi_monthly_performance",
+    "kpi_by_plan",
+    "kpi_uat_certification",
+]
+
+# Query parameter -> column it filters on
+FILTERS = {"project_id": "project_id", "month": "month_key"}
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+class KpiCache:
+    """
+    In-process LRU cache of whole KPI tables, bounded by the approximate
+    JSON size of the cached rows (KPI_CACHE_MAX_MB). Each table is read from
+    BigQuery once (concurrent misses wait for the same load) and then
+    filtered and paginated in memory. invalidate() drops everything; it is
+    called when a sync finishes, and entries also expire after
+    KPI_CACHE_TTL seconds so syncs run on other instances are picked up.
+    """
+    def __init__(self, dataset_ref=None, max_bytes=None, ttl_seconds=None, loader=None):
+        self.dataset_ref = dataset_ref or f"{os.environ.get('GCP_PROJECT_ID')}.{os.environ.get('BQ_DATASET', 'testrail_kpis')}"
+        self.max_bytes = max_bytes if max_bytes is not None else int(float(os.environ.get("KPI_CACHE_MAX_MB", "64")) * 1024 * 1024)
+        self.ttl = ttl_seconds if ttl_seconds is not None else int(os.environ.get("KPI_CACHE_TTL", "3600"))
+        self.loader = loader or self._query_table
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()     # table -> {"rows", "etag", "size", "loaded", "loaded_at", "generation"}
+        self.loading = {}                # table -> Lock held while it loads
+        self.generation = 0
+        self.size = 0
+        self.client = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _query_table(self, table):
+        if self.client is None:
+            # Imported here: google.cloud.bigquery is slow to import
+            from google.cloud import bigquery
+            self.client = bigquery.Client(project=self.dataset_ref.split(".")[0])
+        return [dict(row) for row in self.client.query(f"SELECT * FROM `{self.dataset_ref}.{table}`").result()]
+
+    def _fresh(self, entry):
+        return entry["generation"] == self.generation and time.monotonic() - entry["loaded"] < self.ttl
+
+    def _store(self, table, entry):
+        # Caller holds self.lock
+        old = self.entries.pop(table, None)
+        if old:
+            self.size -= old["size"]
+        if entry["size"] > self.max_bytes:
+            logger.warning(f"KPI table {table} ({entry['size']} bytes) is larger than the cache, not cached")
+            return
+        self.entries[table] = entry
+        self.size += entry["size"]
+        while self.size > self.max_bytes:
+            evicted, evicted_entry = self.entries.popitem(last=False)
+            self.size -= evicted_entry["size"]
+            self.stats["evictions"] += 1
+            logger.info(f"Evicted KPI table {evicted} from the cache")
+
+    def get(self, table):
+        """
+        Returns the cache entry for table, loading it on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(table)
+            if entry and self._fresh(entry):
+                self.entries.move_to_end(table)
+                self.stats["hits"] += 1
+                return entry
+            load_lock = self.loading.setdefault(table, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                # Another request may have loaded it while we waited
+                entry = self.entries.get(table)
+                if entry and self._fresh(entry):
+                    self.entries.move_to_end(table)
+                    self.stats["hits"] += 1
+                    return entry
+                self.stats["misses"] += 1
+                generation = self.generation
+
+            start = time.monotonic()
+            rows = [{k: _json_value(v) for k, v in row.items()} for row in self.loader(table)]
+            payload = json.dumps(rows, sort_keys=True, default=str)
+            entry = {
+                "rows": rows,
+                "columns": set(rows[0]) if rows else set(),
+                "etag": hashlib.md5(payload.encode()).hexdigest(),
+                "size": len(payload),
+                "loaded": time.monotonic(),
+                "loaded_at": datetime.utcnow().isoformat(),
+                "generation": generation,
+            }
+            logger.info(f"Loaded KPI table {table}: {len(rows)} rows in {time.monotonic() - start:.2f}s")
+            with self.lock:
+                # A sync that finished during the load keeps the entry out of the cache
+                if generation == self.generation:
+                    self._store(table, entry)
+            return entry
+
+    def invalidate(self, *args):
+        """
+        Drops every cached table (usable directly as a sync listener).
+        """
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+            self.stats["invalidations"] += 1
+        logger.info("KPI cache invalidated")
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, tables=list(self.entries), size_bytes=self.size, max_bytes=self.max_bytes)
+
+    def query(self, table, filters=None, page=1, page_size=500):
+        """
+        Rows of table matching filters ({param: [values]}, see FILTERS),
+        one page at a time. Returns (result dict, etag). Raises ValueError
+        for a filter the table has no column for.
+        """
+        entry = self.get(table)
+        rows = entry["rows"]
+        selected = {}
+        for param, values in (filters or {}).items():
+            column = FILTERS[param]
+            if rows and column not in entry["columns"]:
+                raise ValueError(f"{table} cannot be filtered by {param}")
+            selected[column] = {str(v) for v in values}
+        if selected:
+            rows = [row for row in rows
+                    if all(str(row.get(column)) in values for column, values in selected.items())]
+
+        offset = (page - 1) * page_size
+        result = {
+            "table": table,
+            "data": rows[offset:offset + page_size],
+            "total": len(rows),
+            "page": page,
+            "page_size": page_size,
+            "loaded_at": entry["loaded_at"],
+        }
+        request_key = json.dumps([sorted((k, sorted(v)) for k, v in selected.items()), page, page_size])
+        etag = hashlib.md5(f"{entry['etag']}:{request_key}".encode()).hexdigest()
+        return result, etag
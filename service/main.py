@@ -1,7 +1,13 @@
 import os
+import time
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+import metrics
 from sync_engine import SyncEngine
+from job_runner import JobRunner, JobRejected
+from engine_registry import get_engine, on_sync
+from kpi_cache import KpiCache, KPI_TABLES, FILTERS
+from sharding import ShardWorker, make_lease_store
 
 app = Flask(__name__)
 
@@ -9,6 +15,21 @@ app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Background sync jobs for this process
+jobs = JobRunner()
+
+# Mart tables served by GET /kpis/<table>, dropped whenever a sync finishes
+kpis = KpiCache()
+on_sync(kpis.invalidate)
+
+def authorized():
+    expected_token = os.environ.get('SYNC_TOKEN')
+    token = request.args.get('token')
+    if expected_token and token != expected_token:
+        logger.warning(f"Unauthorized request to {request.path} with token: {token}")
+        return False
+    return True
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "healthy"}), 200
@@ -16,27 +37,125 @@ def health_check():
 @app.route('/jobs/sync', methods=['POST'])
 def trigger_sync():
     entity = request.args.get('entity')
-    token = request.args.get('token')
-    
-    expected_token = os.environ.get('SYNC_TOKEN')
+    full_refresh = request.args.get('full_refresh', '').lower() in ('1', 'true', 'yes')
+    wait = request.args.get('wait', '').lower() in ('1', 'true', 'yes')
+    shard = request.args.get('shard', '').lower() in ('1', 'true', 'yes')
     
     # Security Check
-    if expected_token and token != expected_token:
-        logger.warning(f"Unauthorized sync attempt with token: {token}")
+    if not authorized():
         return jsonify({"error": "Unauthorized"}), 401
 
     if not entity:
         return jsonify({"error": "Missing 'entity' parameter"}), 400
+    if entity not in ("all", SyncEngine.MATERIALIZE) and entity not in SyncEngine.ENTITY_DEPENDENCIES:
+        return jsonify({"error": f"Unknown entity: {entity}"}), 400
+    
+    if shard and entity not in SyncEngine.SHARDED_ENTITIES:
+        return jsonify({"error": f"Sharding is supported for {SyncEngine.SHARDED_ENTITIES}"}), 400
     
     logger.info(f"Received sync request for entity: {entity}")
     
+    if wait:
+        # Old behaviour: run inside the request and return the full result
+        try:
+            engine = get_engine()
+            result = engine.run_sync(entity, full_refresh=full_refresh)
+            return jsonify(result), 200
+        except Exception as e:
+            logger.exception(f"Sync failed for {entity}")
+            return jsonify({"error": str(e)}), 500
+    
+    covers = SyncEngine.ALL_ENTITIES + [SyncEngine.MATERIALIZE] if entity == "all" else [entity]
+    request_cycle = request.args.get('cycle')
+    
+    def run(progress):
+        engine = get_engine()
+        if shard:
+            # One cooperative worker; other instances triggered for the same cycle share the units
+            deadline = time.monotonic() + engine.time_budget if engine.time_budget > 0 else None
+            worker = ShardWorker(engine, make_lease_store(engine))
+            result = worker.run(entity, cycle=request_cycle, full_refresh=full_refresh, deadline=deadline)
+            progress(entity, result)
+            return result
+        return engine.run_sync(entity, full_refresh=full_refresh, progress=progress)
+    
     try:
-        engine = SyncEngine()
-        result = engine.run_sync(entity)
-        return jsonify(result), 200
+        job = jobs.submit(entity, covers, run)
+    except JobRejected as e:
+        body = {"error": str(e)}
+        if e.job:
+            # Same entity already queued/running: point the caller at that job
+            body["job_id"] = e.job["job_id"]
+            return jsonify(body), 409
+        return jsonify(body), 429
+    return jsonify(job), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    if not authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+@app.route('/kpis/<table>', methods=['GET'])
+def get_kpis(table):
+    """
+    Rows of a mart table from the in-process cache.
+    Filters: project_id and month (month_key), comma-separated or repeated.
+    Pagination: page (from 1) and page_size (default 500, max 5000).
+    Answers 304 when If-None-Match matches the ETag.
+    """
+    if not authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    if table not in KPI_TABLES:
+        return jsonify({"error": f"Unknown table: {table}"}), 404
+    
+    filters = {}
+    for param in FILTERS:
+        values = [v.strip() for value in request.args.getlist(param) for v in value.split(',') if v.strip()]
+        if values:
+            filters[param] = values
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        page_size = min(5000, max(1, int(request.args.get('page_size', 500))))
+    except ValueError:
+        return jsonify({"error": "page and page_size must be integers"}), 400
+    
+    try:
+        result, etag = kpis.query(table, filters, page, page_size)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logger.exception(f"Sync failed for {entity}")
+        logger.exception(f"Failed to load KPI table {table}")
         return jsonify({"error": str(e)}), 500
+    
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(result)
+    response.set_etag(etag)
+    # Clients must revalidate, which is a cheap 304 until the next sync
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route('/kpis', methods=['GET'])
+def kpi_cache_stats():
+    if not authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({"tables": KPI_TABLES, "cache": kpis.snapshot()}), 200
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Sync metrics of this instance (API calls, 429s, retries, bytes, BigQuery
+    rows and write latency, entity durations) in the Prometheus text format.
+    """
+    if not authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
@@ -0,0 +1,308 @@
+import os
+import re
+import copy
+import time
+import logging
+from datetime import datetime, timezone
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+from scheduler import DagScheduler
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# sql/ in a repo checkout; set SQL_DIR when the service is built on its own
+DEFAULT_SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sql")
+
+# Dataset the sql/ files are written against
+SQL_DATASET = "testrail_kpis"
+
+# Integer-range partitions for tables keyed by run/plan ID
+ID_PARTITIONS = "GENERATE_ARRAY(0, 500000, 1000)"
+
+
+class Model:
+    """
+    One SQL model materialized as a table.
+    key/scope: output column and what the sync touched that it is keyed by
+    ("run", "plan" or "project"); keyed models are refreshed incrementally,
+    the rest are rebuilt (they only read small, already materialized tables).
+    """
+    def __init__(self, name, sql_file, key=None, scope=None, partition_by=None, cluster_by=None):
+        self.name = name
+        self.sql_file = sql_file
+        self.key = key
+        self.scope = scope
+        self.partition_by = partition_by
+        self.cluster_by = cluster_by or []
+        self.select = None
+        self.deps = []
+
+
+MODELS = [
+    Model("dedup_runs", "kpi_replication.sql", key="id", scope="run",
+          partition_by="DATE(created_on)", cluster_by=["project_id", "id"]),
+    Model("dedup_plans", "kpi_replication.sql", cluster_by=["id"]),
+    Model("dedup_milestones", "kpi_replication.sql", cluster_by=["id"]),
+    Model("dedup_tests", "kpi_replication.sql", key="run_id", scope="run",
+          partition_by=f"RANGE_BUCKET(run_id, {ID_PARTITIONS})", cluster_by=["run_id", "id"]),
+    Model("stg_Runs", "kpi_replication.sql", key="run_id", scope="run",
+          partition_by="DATE(created_on_run)", cluster_by=["project_id", "run_id"]),
+    Model("KPIs_Plan", "kpi_replication.sql"),
+    Model("KPIs_Mes", "kpi_replication.sql"),
+    Model("dashboard_mart", "dashboard_mart.sql", key="plan_id", scope="plan",
+          partition_by=f"RANGE_BUCKET(plan_id, {ID_PARTITIONS})", cluster_by=["project_id", "plan_id"]),
+    Model("dashboard_pruebas", "dashboard_pruebas.sql", key="plan_id", scope="plan",
+          partition_by=f"RANGE_BUCKET(plan_id, {ID_PARTITIONS})", cluster_by=["project_id", "plan_id"]),
+    Model("dashboard_mart_projects", "dashboard_mart_projects.sql"),
+    Model("workload_by_analyst", "workload_by_analyst.sql", key="project_id", scope="project",
+          cluster_by=["project_id"]),
+    Model("project_analyst_demand", "project_analyst_demand.sql", key="project_id", scope="project",
+          cluster_by=["project_id"]),
+    Model("jira_defects_summary", "jira_defects_summary.sql", cluster_by=["key"]),
+    Model("fact_cycle", "bronze_to_silver.sql", key="cycle_id", scope="run",
+          partition_by="DATE(created_on)", cluster_by=["project_id", "cycle_id"]),
+    Model("kpi_monthly_performance", "silver_to_gold.sql"),
+    Model("kpi_by_plan", "silver_to_gold.sql"),
+    Model("kpi_uat_certification", "silver_to_gold.sql"),
+]
+
+_CREATE = re.compile(
+    r"CREATE\s+OR\s+REPLACE\s+(?:VIEW|TABLE)\s+`?" + SQL_DATASET + r"\.(\w+)`?"
+    r"(?:\s+PARTITION\s+BY\s+[^\n]+?)?\s+AS\s+(.*)",
+    re.S | re.I,
+)
+_REFERENCE = re.compile(r"\b" + SQL_DATASET + r"\.(\w+)")
+
+
+def load_statements(path):
+    """
+    {name: select} for every CREATE OR REPLACE VIEW/TABLE in a sql/ file.
+    A file holding a single bare query is returned under its file name.
+    """
+    with open(path) as f:
+        statements = [s.strip() for s in re.split(r";\s*$", f.read(), flags=re.M) if s.strip()]
+    selects = {}
+    for statement in statements:
+        match = _CREATE.search(statement)
+        if match:
+            selects[match.group(1)] = match.group(2).strip()
+    if not selects and len(statements) == 1:
+        selects[os.path.splitext(os.path.basename(path))[0]] = statements[0]
+    return selects
+
+
+class Materializer:
+    """
+    Post-sync transformation stage: materializes the sql/ models as tables
+    in dependency order (independent models run in parallel).
+
+    Keyed models only refresh the run, plan or project IDs touched since the
+    last materialization: raw rows extracted since then (runs, tests,
+    results, plans, milestones, and results linked to changed Jira issues),
+    widened to every run of a touched plan. The old rows for those keys are
+    deleted and re-inserted in one transaction. Everything is rebuilt on the
+    first run, on full_refresh and every MATERIALIZE_FULL_EVERY_HOURS, which
+    also picks up project/user renames that touch no run.
+    """
+    def __init__(self, bq_client, sql_dir=None):
+        self.bq = bq_client
+        self.client = bq_client.client
+        self.dataset_ref = bq_client.dataset_ref
+        self.sql_dir = sql_dir or os.environ.get("SQL_DIR", DEFAULT_SQL_DIR)
+        self.max_parallel = int(os.environ.get("MATERIALIZE_MAX_PARALLEL", "4"))
+        self.max_keys = int(os.environ.get("MATERIALIZE_MAX_KEYS", "50000"))
+        self.full_every = float(os.environ.get("MATERIALIZE_FULL_EVERY_HOURS", "24")) * 3600
+        # Rows cleaned just before the last run may have been loaded just after it
+        self.overlap = int(os.environ.get("MATERIALIZE_OVERLAP_SECONDS", "3600"))
+        self.models = None
+
+    def _load_models(self):
+        if self.models is not None:
+            return self.models
+        selects = {}
+        for sql_file in {model.sql_file for model in MODELS}:
+            selects[sql_file] = load_statements(os.path.join(self.sql_dir, sql_file))
+
+        names = {model.name for model in MODELS}
+        models = {}
+        for model in MODELS:
+            model = copy.copy(model)
+            select = selects[model.sql_file].get(model.name)
+            if select is None:
+                raise ValueError(f"Model {model.name} not found in {model.sql_file}")
+            if SQL_DATASET != self.bq.dataset_id:
+                select = _REFERENCE.sub(lambda m: f"{self.bq.dataset_id}.{m.group(1)}", select)
+            model.select = select
+            model.deps = sorted({ref for ref in _REFERENCE.findall(selects[model.sql_file][model.name])
+                                 if ref in names and ref != model.name})
+            models[model.name] = model
+        self.models = models
+        return models
+
+    def _query(self, sql, params=None):
+        job_config = bigquery.QueryJobConfig(query_parameters=params or [])
+        return self.client.query(sql, job_config=job_config).result()
+
+    def _touched(self, since):
+        """
+        {"run": [...], "plan": [...], "project": [...]} touched since `since` (epoch).
+        """
+        ds = self.dataset_ref
+        query = f"""
+            WITH runs AS (
+                SELECT id, plan_id, project_id FROM `{ds}.raw_runs`
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY id ORDER BY _extracted_at DESC) = 1
+            ),
+            touched AS (
+                SELECT id AS run_id FROM `{ds}.raw_runs` WHERE _extracted_at > @since
+                UNION DISTINCT
+                SELECT run_id FROM `{ds}.raw_tests` WHERE _extracted_at > @since
+                UNION DISTINCT
+                SELECT t.run_id FROM `{ds}.raw_results` r JOIN `{ds}.raw_tests` t ON r.test_id = t.id
+                WHERE r._extracted_at > @since
+                UNION DISTINCT
+                SELECT r.id FROM runs r JOIN `{ds}.raw_plans` p ON r.plan_id = p.id
+                WHERE p._extracted_at > @since
+                UNION DISTINCT
+                SELECT r.id FROM `{ds}.raw_runs` r JOIN `{ds}.raw_milestones` m ON r.milestone_id = m.id
+                WHERE m._extracted_at > @since
+                UNION DISTINCT
+                SELECT t.run_id FROM `{ds}.raw_results` r
+                JOIN `{ds}.raw_tests` t ON r.test_id = t.id,
+                UNNEST(REGEXP_EXTRACT_ALL(r.defects, r'(CM-\\d+)')) AS defect_key
+                JOIN `{ds}.raw_jira_issues` j ON j.key = defect_key
+                WHERE j._extracted_at > @since AND r.defects LIKE '%CM-%'
+            ),
+            touched_plans AS (
+                SELECT DISTINCT plan_id FROM runs WHERE id IN (SELECT run_id FROM touched) AND plan_id IS NOT NULL
+            )
+            SELECT id AS run_id, COALESCE(plan_id, id) AS plan_key, project_id
+            FROM runs
+            WHERE id IN (SELECT run_id FROM touched) OR plan_id IN (SELECT plan_id FROM touched_plans)
+        """
+        since = datetime.fromtimestamp(max(0, since), tz=timezone.utc)
+        rows = self._query(query, [bigquery.ScalarQueryParameter("since", "TIMESTAMP", since)])
+        scope = {"run": set(), "plan": set(), "project": set()}
+        for row in rows:
+            scope["run"].add(row.run_id)
+            scope["plan"].add(row.plan_key)
+            if row.project_id is not None:
+                scope["project"].add(row.project_id)
+        return {name: sorted(keys) for name, keys in scope.items()}
+
+    def _drop_view(self, table_id):
+        # The models used to be views; a view cannot be replaced by a table
+        try:
+            table = self.client.get_table(table_id)
+        except NotFound:
+            return False
+        if table.table_type == "VIEW":
+            logger.info(f"Replacing view {table_id} with a table")
+            self.client.delete_table(table_id)
+            return False
+        return True
+
+    def _build(self, model):
+        table_id = f"{self.dataset_ref}.{model.name}"
+        self._drop_view(table_id)
+        options = ""
+        if model.partition_by:
+            options += f"\nPARTITION BY {model.partition_by}"
+        if model.cluster_by:
+            options += f"\nCLUSTER BY {', '.join(model.cluster_by)}"
+        self._query(f"CREATE OR REPLACE TABLE `{table_id}`{options}\nAS\n{model.select}")
+
+    def _refresh(self, model, keys):
+        table_id = f"{self.dataset_ref}.{model.name}"
+        script = f"""
+            BEGIN TRANSACTION;
+            DELETE FROM `{table_id}` WHERE {model.key} IN UNNEST(@keys);
+            INSERT INTO `{table_id}`
+            SELECT * FROM (
+            {model.select}
+            ) WHERE {model.key} IN UNNEST(@keys);
+            COMMIT TRANSACTION;
+        """
+        self._query(script, [bigquery.ArrayQueryParameter("keys", "INT64", keys)])
+
+    def _materialize(self, model, scope):
+        """
+        Builds or refreshes one model. Returns its result dict.
+        """
+        start = time.monotonic()
+        table_id = f"{self.dataset_ref}.{model.name}"
+        keys = scope.get(model.scope) if scope is not None and model.key else None
+        if keys is not None and len(keys) > self.max_keys:
+            logger.info(f"{model.name}: {len(keys)} touched keys, rebuilding instead")
+            keys = None
+        if keys is not None and not self._drop_view(table_id):
+            keys = None
+
+        if keys is None:
+            mode = "full"
+            self._build(model)
+        elif not keys:
+            mode = "unchanged"
+        else:
+            mode = "incremental"
+            self._refresh(model, keys)
+
+        duration = time.monotonic() - start
+        if mode != "unchanged":
+            metrics.record_bq_write(model.name, "materialize", duration)
+        logger.info(f"Materialized {model.name} ({mode}{f', {len(keys)} keys' if keys else ''}) in {duration:.1f}s")
+        result = {"status": "success", "mode": mode, "duration_s": round(duration, 3)}
+        if mode == "incremental":
+            result["keys"] = len(keys)
+        return result
+
+    def run(self, full_refresh=False):
+        """
+        Materializes every model. Returns {"status", "mode", "models",
+        "timings", "wall_time_s"}; status is "error" if any model failed,
+        in which case the next run covers the same touched keys again, and
+        "skipped" (with a "reason") when the sql/ directory is missing.
+        """
+        if not os.path.isdir(self.sql_dir):
+            # The service image is built from service/ only; sql/ has to be added to it
+            reason = f"SQL directory {self.sql_dir} not found (set SQL_DIR)"
+            logger.warning(f"Skipping materialization: {reason}")
+            return {"status": "skipped", "reason": reason, "models": {}, "timings": {}, "wall_time_s": 0.0}
+
+        started_at = int(time.time())
+        models = self._load_models()
+
+        since = self.bq.get_watermark("materialize") or 0
+        last_full = self.bq.get_watermark("materialize_full") or 0
+        full = full_refresh or not since or started_at - last_full >= self.full_every
+        scope = None if full else self._touched(since - self.overlap)
+        if scope is not None:
+            logger.info(f"Materializing {len(scope['run'])} touched runs, {len(scope['plan'])} plans, "
+                        f"{len(scope['project'])} projects")
+
+        if scope is not None and not scope["run"]:
+            logger.info("Nothing touched since the last materialization")
+            self.bq.update_watermark("materialize", started_at)
+            return {"status": "success", "mode": "unchanged", "models": {}, "timings": {}, "wall_time_s": 0.0}
+
+        tasks = {
+            name: (lambda model=model: self._materialize(model, scope), model.deps)
+            for name, model in models.items()
+        }
+        report = DagScheduler(tasks, max_parallel=self.max_parallel).run()
+        failed = [name for name, result in report["results"].items() if result.get("status") != "success"]
+        if failed:
+            logger.error(f"Materialization failed for {failed}")
+        else:
+            self.bq.update_watermark("materialize", started_at)
+            if full:
+                self.bq.update_watermark("materialize_full", started_at)
+
+        return {
+            "status": "error" if failed else "success",
+            "mode": "full" if full else "incremental",
+            "models": report["results"],
+            "timings": report["timings"],
+            "wall_time_s": report["wall_time_s"],
+        }
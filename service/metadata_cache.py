@@ -0,0 +1,61 @@
+import time
+import threading
+
+
+class MetadataCache:
+    """
+    Thread-safe TTL cache for lookups that every entity sync repeats
+    (project list, suites per project).
+    Concurrent callers asking for the same missing key wait for a single
+    load instead of all hitting TestRail at once.
+    """
+    def __init__(self, ttl_seconds=900):
+        self.ttl = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.key_locks = {}
+
+    def _key_lock(self, key):
+        with self.lock:
+            if key not in self.key_locks:
+                self.key_locks[key] = threading.Lock()
+            return self.key_locks[key]
+
+    def peek(self, key):
+        """
+        Returns the cached value or None if missing/expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+
+    def get(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() once to fill it.
+        """
+        value = self.peek(key)
+        if value is not None:
+            return value
+        with self._key_lock(key):
+            value = self.peek(key)
+            if value is None:
+                value = loader()
+                self.set(key, value)
+            return value
+
+    def invalidate(self, prefix=None):
+        """
+        Drops every entry, or only keys whose first element equals prefix.
+        """
+        with self.lock:
+            if prefix is None:
+                self.entries.clear()
+            else:
+                for key in [k for k in self.entries if k[0] == prefix]:
+                    del self.entries[key]
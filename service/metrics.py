@@ -0,0 +1,216 @@
+import time
+import threading
+import contextvars
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+# name -> (type, help)
+METRICS = {
+    "sync_api_requests_total": ("counter", "HTTP requests sent to TestRail/Jira."),
+    "sync_api_errors_total": ("counter", "Requests that failed or returned a 4xx/5xx other than 429."),
+    "sync_api_rate_limited_total": ("counter", "Requests answered with 429."),
+    "sync_api_retries_total": ("counter", "Requests retried by the client."),
+    "sync_api_response_bytes_total": ("counter", "Response body bytes received."),
+    "sync_api_request_seconds": ("histogram", "HTTP request latency."),
+    "sync_bq_rows_total": ("counter", "Rows handed to the BigQuery writer."),
+    "sync_bq_write_seconds": ("histogram", "BigQuery write latency (load job, MERGE or streaming insert)."),
+    "sync_entity_runs_total": ("counter", "Entity syncs finished, by status."),
+    "sync_entity_duration_seconds": ("histogram", "Entity sync wall time."),
+    "sync_entity_last_success_timestamp_seconds": ("gauge", "Unix time the entity last synced successfully."),
+}
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters, gauges and histograms for the process, rendered in
+    the Prometheus text format by GET /metrics.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}        # (name, label key) -> float
+        self.histograms = {}    # (name, label key) -> [bucket counts..., sum, count]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: list(entry) for key, entry in self.histograms.items()}
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            series = sorted((k, v) for k, v in values.items() if k[0] == name)
+            hist = sorted((k, v) for k, v in histograms.items() if k[0] == name)
+            if not series and not hist:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (_, key), value in series:
+                lines.append(f"{name}{_format_labels(key)} {value}")
+            for (_, key), entry in hist:
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', str(bound))])} {entry[i]}")
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {entry[-1]}")
+                lines.append(f"{name}_sum{_format_labels(key)} {round(entry[-2], 6)}")
+                lines.append(f"{name}_count{_format_labels(key)} {entry[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+_current_span = contextvars.ContextVar("sync_span", default=None)
+
+
+def current_entity():
+    span = _current_span.get()
+    return span.entity if span else "none"
+
+
+def in_context(fn):
+    """
+    Wraps fn to run in a copy of the caller's context, so work handed to
+    other threads is still counted against the caller's span. Each call
+    gets its own copy, so the wrapper can run in several threads at once.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def in_context_async(fn):
+    """
+    in_context for coroutine functions run on another thread's event loop:
+    the coroutine (and the tasks it starts) count against the caller's span.
+    """
+    span = _current_span.get()
+
+    async def run(*args, **kwargs):
+        _current_span.set(span)
+        return await fn(*args, **kwargs)
+    return run
+
+
+class SyncSpan:
+    """
+    Per-entity counters for one sync: API calls, pages, bytes, retries, 429s,
+    API time, and rows and write time on the BigQuery side.
+    Active for the `with` block and for threads started through in_context().
+    """
+    FIELDS = ("api_calls", "pages", "bytes", "retries", "rate_limited", "api_errors", "api_time_s",
+              "bq_rows", "bq_writes", "bq_write_s")
+
+    def __init__(self, entity):
+        self.entity = entity
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.FIELDS, 0)
+        self.rows_by_table = {}
+        self.status = None
+        self.started = None
+        self.duration_s = None
+        self.token = None
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self.token)
+        self.duration_s = time.monotonic() - self.started
+        if self.status is None:
+            self.status = "error" if exc_type else "success"
+        REGISTRY.inc("sync_entity_runs_total", entity=self.entity, status=self.status)
+        REGISTRY.observe("sync_entity_duration_seconds", self.duration_s, entity=self.entity)
+        if self.status == "success":
+            REGISTRY.set("sync_entity_last_success_timestamp_seconds", time.time(), entity=self.entity)
+        return False
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counters[name] += value
+
+    def to_dict(self):
+        with self.lock:
+            report = {name: round(value, 3) if isinstance(value, float) else value
+                      for name, value in self.counters.items()}
+            report["rows_by_table"] = dict(self.rows_by_table)
+        report["status"] = self.status
+        report["duration_s"] = round(self.duration_s, 3) if self.duration_s is not None else None
+        return report
+
+
+def record_api_call(client, endpoint, latency, status_code, size=0):
+    entity = current_entity()
+    REGISTRY.inc("sync_api_requests_total", client=client, endpoint=endpoint, entity=entity)
+    REGISTRY.observe("sync_api_request_seconds", latency, client=client, endpoint=endpoint)
+    rate_limited = status_code == 429
+    failed = not rate_limited and (status_code is None or status_code >= 400)
+    if rate_limited:
+        REGISTRY.inc("sync_api_rate_limited_total", client=client, endpoint=endpoint, entity=entity)
+    if failed:
+        REGISTRY.inc("sync_api_errors_total", client=client, endpoint=endpoint, entity=entity)
+    if size:
+        REGISTRY.inc("sync_api_response_bytes_total", size, client=client, endpoint=endpoint, entity=entity)
+
+    span = _current_span.get()
+    if span:
+        span.add(api_calls=1, api_time_s=latency, bytes=size, rate_limited=int(rate_limited),
+                 api_errors=int(failed), pages=int(not rate_limited and not failed))
+
+
+def record_api_retry(client, endpoint):
+    REGISTRY.inc("sync_api_retries_total", client=client, endpoint=endpoint, entity=current_entity())
+    span = _current_span.get()
+    if span:
+        span.add(retries=1)
+
+
+def record_bq_rows(table, rows):
+    REGISTRY.inc("sync_bq_rows_total", rows, table=table, entity=current_entity())
+    span = _current_span.get()
+    if span:
+        span.add(bq_rows=rows)
+        with span.lock:
+            span.rows_by_table[table] = span.rows_by_table.get(table, 0) + rows
+
+
+def record_bq_write(table, operation, seconds):
+    REGISTRY.observe("sync_bq_write_seconds", seconds, table=table, operation=operation)
+    span = _current_span.get()
+    if span:
+        span.add(bq_writes=1, bq_write_s=seconds)
@@ -0,0 +1,96 @@
+import os
+import json
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# infra/schemas in a repo checkout; set SCHEMA_DIR when the service is built on its own
+DEFAULT_SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "infra", "schemas")
+
+# Used when a table has no known schema (same fields the sync always converted)
+LEGACY_TIMESTAMP_FIELDS = ['created_on', 'completed_on', 'updated_on', 'due_on']
+
+
+def load_schema_file(table_name, schema_dir=None):
+    """
+    Returns [(name, type)] from <schema_dir>/<table_name>.json, or None.
+    """
+    path = os.path.join(schema_dir or os.environ.get("SCHEMA_DIR", DEFAULT_SCHEMA_DIR), f"{table_name}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return [(field["name"], field["type"]) for field in json.load(f)]
+
+
+def _epoch_to_iso(ts):
+    return datetime.utcfromtimestamp(ts).isoformat()
+
+
+class TableNormalizer:
+    """
+    Row cleaner for one table, compiled once from its column types.
+    normalize() converts a whole batch column by column: one pass copies
+    the rows (collecting custom_* fields into custom_fields when the table
+    has that column), then each typed column is converted in a tight loop,
+    instead of re-checking every field name on every row.
+    """
+    def __init__(self, table_name, fields=None):
+        self.table_name = table_name
+        # None when the table's schema is unknown
+        self.columns = None if fields is None else {name for name, _ in fields}
+        if fields is None:
+            self.timestamp_columns = LEGACY_TIMESTAMP_FIELDS
+            self.encode_columns = ['custom_status_count']
+            self.collect_custom_fields = True
+        else:
+            types = dict(fields)
+            self.timestamp_columns = [name for name, t in fields if t in ("TIMESTAMP", "DATETIME")]
+            # Nested values must reach BigQuery as JSON text for STRING and JSON columns
+            self.encode_columns = [name for name, t in fields if t in ("STRING", "JSON")]
+            self.collect_custom_fields = types.get("custom_fields") == "JSON"
+
+    def normalize(self, rows, extracted_at, source='testrail'):
+        """
+        Returns converted copies of rows with _extracted_at/_source set.
+        """
+        # Rows of one page share (almost) the same keys, so work out once per
+        # batch which columns are present and which keys are custom_*
+        present = set()
+        for row in rows:
+            present.update(row)
+        custom_keys = sorted(k for k in present if k.startswith('custom_')) if self.collect_custom_fields else []
+
+        dumps = json.dumps
+        items = []
+        for row in rows:
+            item = dict(row)
+            item['_extracted_at'] = extracted_at
+            item['_source'] = source
+            if custom_keys and 'custom_fields' not in row:
+                custom_fields = {k: row[k] for k in custom_keys if k in row}
+                if custom_fields:
+                    item['custom_fields'] = dumps(custom_fields)
+            items.append(item)
+
+        for column in self.timestamp_columns:
+            if column not in present:
+                continue
+            cache = {}
+            for item in items:
+                value = item.get(column)
+                if isinstance(value, int):
+                    converted = cache.get(value)
+                    if converted is None:
+                        converted = cache[value] = _epoch_to_iso(value)
+                    item[column] = converted
+
+        for column in self.encode_columns:
+            if column not in present:
+                continue
+            for item in items:
+                value = item.get(column)
+                if isinstance(value, (dict, list)):
+                    item[column] = dumps(value)
+
+        return items
@@ -0,0 +1,183 @@
+import os
+import queue
+import asyncio
+import threading
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of one item's pages / of the whole stream
+_ITEM_DONE = object()
+_STREAM_DONE = object()
+
+
+class Pipeline:
+    """
+    Runs fetch -> transform -> write as concurrent stages joined by bounded queues.
+
+    - fetch: up to `workers` threads, each calling fetch_pages(item) for one
+      item at a time and pushing every page it yields.
+    - transform: one thread applying transform(item, page) -> page.
+    - write: the calling thread, applying write(item, page).
+
+    With `loop` (async_clients.EventLoopThread) fetch_pages(item) returns an
+    async iterator instead, and the fetch stage is `workers` coroutines on
+    that loop, so hundreds of items can be in flight without a thread each.
+
+    While one page is being written the next one is already downloading.
+    A full queue blocks the stage in front of it, so at most
+    2 x queue_size pages are held in memory regardless of how much is fetched.
+    Any stage failing stops the others and the error is re-raised from run().
+    """
+    def __init__(self, write, transform=None, on_item_done=None, queue_size=None):
+        self.write = write
+        self.transform = transform
+        self.on_item_done = on_item_done
+        self.queue_size = queue_size or int(os.environ.get("SYNC_PIPELINE_QUEUE", "8"))
+
+    def run(self, fetch_pages, items=(None,), workers=1, loop=None):
+        """
+        Streams every page of every item through the stages.
+        Returns the number of rows written.
+        """
+        fetch_q = queue.Queue(maxsize=self.queue_size)
+        write_q = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+        items = iter(items)
+        items_lock = threading.Lock()
+
+        def put(q, value):
+            # Blocks while the queue is full, but gives up once another stage failed
+            while not stop.is_set():
+                try:
+                    q.put(value, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+            return _STREAM_DONE
+
+        def fail(e):
+            errors.append(e)
+            stop.set()
+
+        def fetch_worker():
+            try:
+                while not stop.is_set():
+                    with items_lock:
+                        item = next(items, _STREAM_DONE)
+                    if item is _STREAM_DONE:
+                        return
+                    for page in fetch_pages(item):
+                        if page and not put(fetch_q, (item, page)):
+                            return
+                    if not put(fetch_q, (item, _ITEM_DONE)):
+                        return
+            except Exception as e:
+                logger.error(f"Pipeline fetch failed: {e}")
+                fail(e)
+
+        async def async_put(q, value):
+            # Waits for room without holding up the other coroutines on the loop
+            while not stop.is_set():
+                try:
+                    q.put_nowait(value)
+                    return True
+                except queue.Full:
+                    await asyncio.sleep(0.05)
+            return False
+
+        async def fetch_task():
+            while not stop.is_set():
+                with items_lock:
+                    item = next(items, _STREAM_DONE)
+                if item is _STREAM_DONE:
+                    return
+                async for page in fetch_pages(item):
+                    if page and not await async_put(fetch_q, (item, page)):
+                        return
+                if not await async_put(fetch_q, (item, _ITEM_DONE)):
+                    return
+
+        async def fetch_all():
+            tasks = [asyncio.ensure_future(fetch_task()) for _ in range(max(1, workers))]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        def async_fetch_worker():
+            try:
+                loop.run(metrics.in_context_async(fetch_all)())
+            except Exception as e:
+                logger.error(f"Pipeline fetch failed: {e}")
+                fail(e)
+
+        def transform_worker():
+            try:
+                while True:
+                    entry = get(fetch_q)
+                    if entry is _STREAM_DONE:
+                        put(write_q, _STREAM_DONE)
+                        return
+                    item, page = entry
+                    if page is not _ITEM_DONE and self.transform:
+                        page = self.transform(item, page)
+                    if not put(write_q, (item, page)):
+                        return
+            except Exception as e:
+                logger.error(f"Pipeline transform failed: {e}")
+                fail(e)
+
+        # Stage threads count their API calls and rows against the caller's metrics span
+        if loop:
+            fetchers = [threading.Thread(target=metrics.in_context(async_fetch_worker), daemon=True)]
+        else:
+            fetchers = [threading.Thread(target=metrics.in_context(fetch_worker), daemon=True)
+                        for _ in range(max(1, workers))]
+        transformer = threading.Thread(target=metrics.in_context(transform_worker), daemon=True)
+        for thread in fetchers:
+            thread.start()
+        transformer.start()
+
+        def close_fetch_queue():
+            for thread in fetchers:
+                thread.join()
+            put(fetch_q, _STREAM_DONE)
+
+        closer = threading.Thread(target=close_fetch_queue, daemon=True)
+        closer.start()
+
+        written = 0
+        try:
+            while True:
+                entry = get(write_q)
+                if entry is _STREAM_DONE:
+                    break
+                item, page = entry
+                if page is _ITEM_DONE:
+                    if self.on_item_done:
+                        self.on_item_done(item)
+                    continue
+                self.write(item, page)
+                written += len(page)
+        except Exception as e:
+            fail(e)
+        finally:
+            stop.set()
+            closer.join()
+            transformer.join()
+
+        if errors:
+            raise errors[0]
+        return written
@@ -1,13 +1,16 @@
 
 import os
+import sys
+import json
 import logging
 from sync_engine import SyncEngine
+from sharding import ShardWorker, make_lease_store
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def run_all_syncs():
+def setup_env():
     # Set necessary environment variables if not present
     if not os.environ.get("GCP_PROJECT_ID"):
         os.environ["GCP_PROJECT_ID"] = "testrail-480214"
@@ -18,29 +21,81 @@ def run_all_syncs():
     logger.info(f"Using Project ID: {os.environ['GCP_PROJECT_ID']}")
     logger.info(f"Using BQ Dataset: {os.environ['BQ_DATASET']}")
 
+def write_report(result, path):
+    """
+    Writes the JSON run report: per-entity status, timings and metrics span
+    (API calls, pages, bytes, retries, 429s, BigQuery rows and write time).
+    """
+    entities = {}
+    for entity, entity_result in result["detailed_results"].items():
+        entities[entity] = {
+            "status": entity_result.get("status"),
+            "timing": result["timings"].get(entity),
+            "metrics": entity_result.get("metrics"),
+            "error": entity_result.get("error"),
+        }
+    report = {
+        "status": result["status"],
+        "wall_time_s": result["wall_time_s"],
+        "critical_path": result["critical_path"],
+        "entities": entities,
+        "api_stats": result["api_stats"],
+        "schema_drift": result["schema_drift"],
+        "materialize": result.get("materialize"),
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    logger.info(f"Run report written to {path}")
+
+def run_all_syncs(full_refresh=False, report_path=None):
+    setup_env()
     try:
         engine = SyncEngine()
     except Exception as e:
         logger.error(f"Failed to initialize SyncEngine: {e}")
         return
 
-    entities = [
-        "projects", "users", "statuses", "milestones", # Metadata
-        "plans", "runs", "suites", "cases",   # Structure
-        "tests", "results",                   # Data
-        "jira_issues"                         # External
-    ]
-
-    for entity in entities:
-        try:
-            logger.info(f"----------------------------------------")
-            logger.info(f"Starting sync for: {entity}")
-            result = engine.run_sync(entity)
-            logger.info(f"Sync result for {entity}: {result}")
-        except Exception as e:
-            logger.exception(f"Failed to sync {entity}")
+    # Independent entities run concurrently; see SyncEngine.ENTITY_DEPENDENCIES
+    result = engine.run_sync("all", full_refresh=full_refresh)
+
+    logger.info(f"----------------------------------------")
+    for entity, entity_result in result["detailed_results"].items():
+        timing = result["timings"].get(entity, {})
+        span = entity_result.get("metrics") or {}
+        logger.info(f"{entity:<12} {timing.get('duration_s', 0):>8.1f}s  {entity_result.get('status')}  "
+                    f"api={span.get('api_calls', 0)} ({span.get('api_time_s', 0)}s, {span.get('rate_limited', 0)} x 429, "
+                    f"{span.get('retries', 0)} retries)  bq_rows={span.get('bq_rows', 0)} ({span.get('bq_write_s', 0)}s)")
+    critical = result["critical_path"]
+    logger.info(f"Wall time: {result['wall_time_s']}s")
+    logger.info(f"Critical path: {' -> '.join(critical['tasks'])} ({critical['duration_s']}s)")
+    materialized = result.get("materialize") or {}
+    logger.info(f"Materialization: {materialized.get('status')} ({materialized.get('mode', '-')}, "
+                f"{materialized.get('wall_time_s', 0)}s)")
+
+    if report_path:
+        write_report(result, report_path)
 
     logger.info("All sync jobs completed.")
 
+def run_shard_worker(entity, full_refresh=False):
+    """
+    Runs one shard worker for entity (tests or results). Start several of
+    these (with SYNC_LEASE_STORE=sqlite for a local lease file) to split a
+    cycle between processes.
+    """
+    setup_env()
+    engine = SyncEngine()
+    result = ShardWorker(engine, make_lease_store(engine)).run(entity, full_refresh=full_refresh)
+    logger.info(f"Shard worker finished: {result}")
+
 if __name__ == "__main__":
-    run_all_syncs()
+    # --full-refresh ignores stored watermarks and re-pulls full history
+    # --shard=<tests|results> runs one shard worker instead of the full sync
+    # --report=<path> sets where the JSON run report goes (default sync_report.json)
+    full_refresh = "--full-refresh" in sys.argv
+    shard = [arg.split("=", 1)[1] for arg in sys.argv if arg.startswith("--shard=")]
+    report = [arg.split("=", 1)[1] for arg in sys.argv if arg.startswith("--report=")]
+    if shard:
+        run_shard_worker(shard[0], full_refresh=full_refresh)
+    else:
+        run_all_syncs(full_refresh=full_refresh, report_path=report[0] if report else "sync_report.json")
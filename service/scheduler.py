@@ -0,0 +1,111 @@
+import time
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+
+class DagScheduler:
+    """
+    Runs named tasks as soon as all of their dependencies have finished,
+    up to max_parallel at a time.
+    tasks: {name: (fn, [dependency names])}. A failed task is reported with
+    status "error" and every task depending on it is skipped.
+    """
+    def __init__(self, tasks, max_parallel=4):
+        for name, (_, deps) in tasks.items():
+            for dep in deps:
+                if dep not in tasks:
+                    raise ValueError(f"Task {name} depends on unknown task {dep}")
+        self.tasks = tasks
+        self.max_parallel = max_parallel
+
+    def _ready(self, name, finished):
+        return all(dep in finished for dep in self.tasks[name][1])
+
+    def run(self):
+        """
+        Returns {"results", "timings", "critical_path", "wall_time_s"}.
+        timings has start/end offsets (seconds from scheduler start) and
+        duration per task.
+        """
+        started_at = time.monotonic()
+        results = {}
+        timings = {}
+        failed = set()
+        finished = set()
+        waiting = list(self.tasks)
+
+        def execute(name):
+            start = time.monotonic()
+            try:
+                return self.tasks[name][0]()
+            finally:
+                end = time.monotonic()
+                timings[name] = {
+                    "start_s": round(start - started_at, 3),
+                    "end_s": round(end - started_at, 3),
+                    "duration_s": round(end - start, 3),
+                }
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            running = {}
+            while waiting or running:
+                for name in list(waiting):
+                    deps = self.tasks[name][1]
+                    if any(dep in failed for dep in deps):
+                        waiting.remove(name)
+                        failed.add(name)
+                        finished.add(name)
+                        results[name] = {"status": "skipped", "error": "dependency failed"}
+                        logger.warning(f"Skipping {name}: a dependency failed")
+                    elif self._ready(name, finished):
+                        waiting.remove(name)
+                        # Tasks see the caller's context variables (e.g. the async fetch switch)
+                        running[executor.submit(contextvars.copy_context().run, execute, name)] = name
+
+                if not running:
+                    if waiting:
+                        # Only reachable with a dependency cycle
+                        raise ValueError(f"Dependency cycle among {waiting}")
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    finished.add(name)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        logger.exception(f"Task {name} failed")
+                        failed.add(name)
+                        results[name] = {"status": "error", "error": str(e)}
+
+        return {
+            "results": {name: results[name] for name in self.tasks},
+            "timings": timings,
+            "critical_path": self.critical_path(timings),
+            "wall_time_s": round(time.monotonic() - started_at, 3),
+        }
+
+    def critical_path(self, timings):
+        """
+        Longest chain of dependent tasks by measured duration:
+        {"tasks": [...], "duration_s": total}.
+        """
+        longest = {}
+
+        def path_to(name):
+            if name not in longest:
+                own = timings.get(name, {}).get("duration_s", 0.0)
+                best = ([], 0.0)
+                for dep in self.tasks[name][1]:
+                    candidate = path_to(dep)
+                    if candidate[1] > best[1]:
+                        best = candidate
+                longest[name] = (best[0] + [name], best[1] + own)
+            return longest[name]
+
+        tasks, duration = max((path_to(name) for name in self.tasks), key=lambda p: p[1], default=([], 0.0))
+        return {"tasks": tasks, "duration_s": round(duration, 3)}
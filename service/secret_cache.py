@@ -0,0 +1,54 @@
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SecretCache:
+    """
+    Process-wide cache for Secret Manager values.
+    Each secret is read once and re-read after ttl_seconds, through a single
+    lazily created SecretManagerServiceClient. If Secret Manager is
+    unreachable the env var of the same name (upper-cased) is used, and a
+    failed refresh keeps serving the previous value.
+    """
+    def __init__(self, project_id, ttl_seconds=None):
+        self.project_id = project_id
+        self.ttl = ttl_seconds if ttl_seconds is not None else int(os.environ.get("SECRET_CACHE_TTL", "3600"))
+        self.lock = threading.Lock()
+        self.client = None
+        self.values = {}
+
+    def _client(self):
+        if self.client is None:
+            # Imported here so that importing the service does not load the gRPC stack
+            from google.cloud import secretmanager
+            self.client = secretmanager.SecretManagerServiceClient()
+        return self.client
+
+    def _fetch(self, secret_id):
+        name = f"projects/{self.project_id}/secrets/{secret_id.upper()}/versions/latest"
+        response = self._client().access_secret_version(request={"name": name})
+        return response.payload.data.decode("UTF-8")
+
+    def get(self, secret_id):
+        with self.lock:
+            cached = self.values.get(secret_id)
+            if cached and time.monotonic() - cached[0] < self.ttl:
+                return cached[1]
+
+            start = time.monotonic()
+            try:
+                value = self._fetch(secret_id)
+            except Exception as e:
+                if cached:
+                    logger.warning(f"Could not refresh secret {secret_id}, keeping the cached value: {e}")
+                    value = cached[1]
+                else:
+                    # Fallback to env vars (local dev or if auth fails)
+                    value = os.environ.get(secret_id.upper())
+            self.values[secret_id] = (time.monotonic(), value)
+            logger.info(f"Loaded secret {secret_id} in {time.monotonic() - start:.3f}s")
+            return value
@@ -0,0 +1,363 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+import logging
+from contextlib import closing
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# A unit that failed (or whose lease expired) this many times is left as "failed" instead of retried
+MAX_ATTEMPTS = 3
+
+# Error recorded on a unit given up because its workers kept dying
+EXPIRED_ERROR = "lease expired on every attempt (worker died or stalled)"
+
+
+def plan_units(engine, entity, cycle, run_span, full_refresh=False):
+    """
+    Splits the changed runs of every project (every run on a full refresh)
+    into work units of at most run_span consecutive run IDs: {unit_id,
+    cycle, entity, project_id, run_from, run_to}. Buckets are aligned on
+    multiples of run_span, so workers planning the same cycle independently
+    produce the same IDs.
+    """
+    units = {}
+    for project in engine._get_projects():
+        project_id = project['id']
+        for run in engine.bq_client.get_changed_runs(entity, project_id, include_unchanged=full_refresh):
+            run_from = run['id'] // run_span * run_span
+            unit_id = f"{cycle}:{entity}:{project_id}:{run_from}"
+            units[unit_id] = {
+                "unit_id": unit_id,
+                "cycle": cycle,
+                "entity": entity,
+                "project_id": project_id,
+                "run_from": run_from,
+                "run_to": run_from + run_span - 1,
+            }
+    return list(units.values())
+
+
+class SqliteLeaseStore:
+    """
+    Lease table in a local SQLite file. Coordinates workers (processes)
+    on the same machine, or stands in for BigQuery when testing.
+    """
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_leases (
+                    unit_id TEXT PRIMARY KEY, cycle TEXT, entity TEXT, project_id INTEGER,
+                    run_from INTEGER, run_to INTEGER, status TEXT, worker_id TEXT, lease_token TEXT,
+                    lease_until REAL, attempts INTEGER DEFAULT 0, error TEXT, updated_at REAL
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def plan(self, units):
+        with closing(self._connect()) as conn:
+            conn.executemany("""
+                INSERT OR IGNORE INTO sync_leases
+                    (unit_id, cycle, entity, project_id, run_from, run_to, status, attempts, updated_at)
+                VALUES (:unit_id, :cycle, :entity, :project_id, :run_from, :run_to, 'pending', 0, :now)
+            """, [dict(unit, now=time.time()) for unit in units])
+
+    def claim(self, cycle, entity, worker_id, lease_seconds, max_attempts=MAX_ATTEMPTS):
+        token = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        try:
+            # Write lock for the whole check-and-set
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                UPDATE sync_leases SET status = 'failed', error = ?, lease_until = NULL, updated_at = ?
+                WHERE cycle = ? AND entity = ? AND status = 'leased' AND lease_until < ? AND attempts >= ?
+            """, (EXPIRED_ERROR, now, cycle, entity, now, max_attempts))
+            row = conn.execute("""
+                SELECT unit_id FROM sync_leases
+                WHERE cycle = ? AND entity = ?
+                  AND (status = 'pending' OR (status = 'leased' AND lease_until < ? AND attempts < ?))
+                ORDER BY unit_id LIMIT 1
+            """, (cycle, entity, now, max_attempts)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("""
+                UPDATE sync_leases
+                SET status = 'leased', worker_id = ?, lease_token = ?, lease_until = ?,
+                    attempts = attempts + 1, updated_at = ?
+                WHERE unit_id = ?
+            """, (worker_id, token, now + lease_seconds, now, row["unit_id"]))
+            unit = dict(conn.execute("SELECT * FROM sync_leases WHERE unit_id = ?", (row["unit_id"],)).fetchone())
+            conn.execute("COMMIT")
+            return unit
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def renew(self, unit, lease_seconds):
+        with closing(self._connect()) as conn:
+            cursor = conn.execute("""
+                UPDATE sync_leases SET lease_until = ?, updated_at = ?
+                WHERE unit_id = ? AND lease_token = ? AND status = 'leased'
+            """, (time.time() + lease_seconds, time.time(), unit["unit_id"], unit["lease_token"]))
+            return cursor.rowcount == 1
+
+    def finish(self, unit, status, error=None):
+        with closing(self._connect()) as conn:
+            cursor = conn.execute("""
+                UPDATE sync_leases SET status = ?, error = ?, lease_until = NULL, updated_at = ?
+                WHERE unit_id = ? AND lease_token = ?
+            """, (status, error, time.time(), unit["unit_id"], unit["lease_token"]))
+            return cursor.rowcount == 1
+
+    def summary(self, cycle, entity):
+        with closing(self._connect()) as conn:
+            rows = conn.execute("""
+                SELECT status, COUNT(*) AS units FROM sync_leases
+                WHERE cycle = ? AND entity = ? GROUP BY status
+            """, (cycle, entity)).fetchall()
+            return {row["status"]: row["units"] for row in rows}
+
+
+class BigQueryLeaseStore:
+    """
+    Lease table in BigQuery (sync_leases), shared by every Cloud Run
+    instance. A claim is one conditional UPDATE tagged with a random lease
+    token; BigQuery serializes concurrent DML on the table, so two workers
+    can never both win the same unit.
+    """
+    def __init__(self, bq_client):
+        # Imported here like the rest of the google.cloud usage on the request path
+        from google.cloud import bigquery
+        self.bigquery = bigquery
+        self.client = bq_client.client
+        self.table = f"{bq_client.dataset_ref}.sync_leases"
+
+    def _query(self, query, **params):
+        types = {str: "STRING", int: "INT64", float: "FLOAT64"}
+        job_config = self.bigquery.QueryJobConfig(query_parameters=[
+            self.bigquery.ScalarQueryParameter(name, types.get(type(value), "STRING"), value)
+            for name, value in params.items()
+        ])
+        for attempt in range(5):
+            try:
+                job = self.client.query(query, job_config=job_config)
+                return job, list(job.result())
+            except Exception as e:
+                # Concurrent DML on the same table can abort; back off and retry
+                if "concurrent update" not in str(e).lower() or attempt == 4:
+                    raise
+                time.sleep(1 + attempt)
+
+    def plan(self, units):
+        if not units:
+            return
+        structs = [
+            self.bigquery.StructQueryParameter(
+                None,
+                *[self.bigquery.ScalarQueryParameter(k, "INT64" if isinstance(unit[k], int) else "STRING", unit[k])
+                  for k in ("unit_id", "cycle", "entity", "project_id", "run_from", "run_to")]
+            )
+            for unit in units
+        ]
+        job_config = self.bigquery.QueryJobConfig(query_parameters=[
+            self.bigquery.ArrayQueryParameter("units", "STRUCT", structs)
+        ])
+        query = f"""
+            MERGE `{self.table}` T
+            USING UNNEST(@units) S
+            ON T.unit_id = S.unit_id
+            WHEN NOT MATCHED THEN
+                INSERT (unit_id, cycle, entity, project_id, run_from, run_to, status, attempts, updated_at)
+                VALUES (S.unit_id, S.cycle, S.entity, S.project_id, S.run_from, S.run_to, 'pending', 0, CURRENT_TIMESTAMP())
+        """
+        self.client.query(query, job_config=job_config).result()
+
+    def claim(self, cycle, entity, worker_id, lease_seconds, max_attempts=MAX_ATTEMPTS):
+        token = uuid.uuid4().hex
+        self._query(f"""
+            UPDATE `{self.table}`
+            SET status = 'failed', error = @error, lease_until = NULL, updated_at = CURRENT_TIMESTAMP()
+            WHERE cycle = @cycle AND entity = @entity AND status = 'leased'
+              AND lease_until < CURRENT_TIMESTAMP() AND attempts >= @max_attempts
+        """, error=EXPIRED_ERROR, cycle=cycle, entity=entity, max_attempts=max_attempts)
+        self._query(f"""
+            UPDATE `{self.table}`
+            SET status = 'leased', worker_id = @worker_id, lease_token = @token,
+                lease_until = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @lease_seconds SECOND),
+                attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP()
+            WHERE unit_id = (
+                SELECT unit_id FROM `{self.table}`
+                WHERE cycle = @cycle AND entity = @entity
+                  AND (status = 'pending'
+                       OR (status = 'leased' AND lease_until < CURRENT_TIMESTAMP() AND attempts < @max_attempts))
+                -- Spread concurrent workers over different units
+                ORDER BY FARM_FINGERPRINT(CONCAT(unit_id, @token))
+                LIMIT 1
+            )
+        """, worker_id=worker_id, token=token, lease_seconds=int(lease_seconds), cycle=cycle, entity=entity,
+            max_attempts=max_attempts)
+        _, rows = self._query(f"SELECT * FROM `{self.table}` WHERE lease_token = @token", token=token)
+        return dict(rows[0].items()) if rows else None
+
+    def renew(self, unit, lease_seconds):
+        job, _ = self._query(f"""
+            UPDATE `{self.table}`
+            SET lease_until = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @lease_seconds SECOND),
+                updated_at = CURRENT_TIMESTAMP()
+            WHERE unit_id = @unit_id AND lease_token = @token AND status = 'leased'
+        """, lease_seconds=int(lease_seconds), unit_id=unit["unit_id"], token=unit["lease_token"])
+        return job.num_dml_affected_rows == 1
+
+    def finish(self, unit, status, error=None):
+        job, _ = self._query(f"""
+            UPDATE `{self.table}`
+            SET status = @status, error = @error, lease_until = NULL, updated_at = CURRENT_TIMESTAMP()
+            WHERE unit_id = @unit_id AND lease_token = @token
+        """, status=status, error=error, unit_id=unit["unit_id"], token=unit["lease_token"])
+        return job.num_dml_affected_rows == 1
+
+    def summary(self, cycle, entity):
+        _, rows = self._query(f"""
+            SELECT status, COUNT(*) AS units FROM `{self.table}`
+            WHERE cycle = @cycle AND entity = @entity GROUP BY status
+        """, cycle=cycle, entity=entity)
+        return {row.status: row.units for row in rows}
+
+
+def make_lease_store(engine):
+    """
+    SYNC_LEASE_STORE: "bigquery" (default, shared across instances) or
+    "sqlite" (SYNC_LEASE_DB file, one machine).
+    """
+    if os.environ.get("SYNC_LEASE_STORE", "bigquery") == "sqlite":
+        return SqliteLeaseStore(os.environ.get("SYNC_LEASE_DB", "sync_leases.db"))
+    return BigQueryLeaseStore(engine.bq_client)
+
+
+class ShardWorker:
+    """
+    Cooperative worker for sharded tests/results syncs.
+    Every worker of a cycle plans the same units (idempotently), then claims
+    one unit at a time under a lease, keeps the lease alive while syncing it
+    and marks it done. A worker that dies stops renewing, its lease expires
+    and another worker picks the unit up again, resuming from the unit's
+    checkpoint. Start as many workers as needed (processes or Cloud Run
+    instances) with the same cycle.
+    """
+    def __init__(self, engine, store, worker_id=None, lease_seconds=None, run_span=None):
+        self.engine = engine
+        self.store = store
+        self.worker_id = worker_id or f"{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_seconds = lease_seconds or int(os.environ.get("SYNC_LEASE_SECONDS", "300"))
+        self.run_span = run_span or int(os.environ.get("SYNC_SHARD_RUN_SPAN", "500"))
+
+    @staticmethod
+    def current_cycle():
+        """
+        Default cycle ID: the current SYNC_SHARD_CYCLE_SECONDS window (UTC).
+        """
+        window = int(os.environ.get("SYNC_SHARD_CYCLE_SECONDS", "3600"))
+        start = int(time.time()) // window * window
+        return datetime.fromtimestamp(start, timezone.utc).strftime("%Y%m%dT%H%M")
+
+    def _keep_alive(self, unit, stop, lost):
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                renewed = self.store.renew(unit, self.lease_seconds)
+            except Exception as e:
+                # Try again on the next beat, the lease outlives two missed renewals
+                logger.warning(f"Worker {self.worker_id} could not renew {unit['unit_id']}: {e}")
+                continue
+            if not renewed:
+                logger.warning(f"Worker {self.worker_id} lost the lease on {unit['unit_id']}")
+                lost.set()
+                return
+
+    def _finish(self, unit, status, error=None):
+        """
+        Marks the unit, unless another worker took it over in the meantime.
+        """
+        if not self.store.finish(unit, status, error=error):
+            logger.warning(f"Worker {self.worker_id} no longer holds {unit['unit_id']}, "
+                           f"left it to its new owner instead of marking it {status}")
+            return False
+        return True
+
+    def run(self, entity, cycle=None, full_refresh=False, deadline=None):
+        """
+        Plans (if needed) and works through the cycle's units of entity until
+        none are left or the deadline passes, then calls the engine's sync
+        listeners like run_sync does.
+        Returns {"status", "cycle", "units", "count", "summary"}.
+        """
+        result = None
+        try:
+            result = self._run(entity, cycle, full_refresh, deadline)
+            return result
+        finally:
+            self.engine.sync_finished(entity, result)
+
+    def _run(self, entity, cycle, full_refresh, deadline):
+        cycle = cycle or self.current_cycle()
+        if not self.store.summary(cycle, entity):
+            units = plan_units(self.engine, entity, cycle, self.run_span, full_refresh=full_refresh)
+            self.store.plan(units)
+            logger.info(f"Planned {len(units)} {entity} units for cycle {cycle}")
+
+        done, total, status = [], 0, "success"
+        while True:
+            if deadline and time.monotonic() >= deadline:
+                status = "partial"
+                break
+            unit = self.store.claim(cycle, entity, self.worker_id, self.lease_seconds)
+            if unit is None:
+                break
+            logger.info(f"Worker {self.worker_id} claimed {unit['unit_id']} (attempt {unit['attempts']})")
+
+            stop, lost = threading.Event(), threading.Event()
+            heartbeat = threading.Thread(target=self._keep_alive, args=(unit, stop, lost), daemon=True)
+            heartbeat.start()
+            try:
+                result = self.engine.run_shard(entity, unit["project_id"], (unit["run_from"], unit["run_to"]),
+                                               full_refresh=full_refresh, deadline=deadline, lost_lease=lost)
+            except Exception as e:
+                logger.exception(f"Unit {unit['unit_id']} failed")
+                retry = unit["attempts"] < MAX_ATTEMPTS
+                self._finish(unit, "pending" if retry else "failed", error=str(e))
+                status = "error"
+                continue
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            total += result.get("count", 0)
+            if lost.is_set():
+                # Its new owner finishes (and checkpoints) the unit
+                continue
+            if result.get("status") == "partial":
+                # Out of time: hand the rest of the unit to the next worker
+                self._finish(unit, "pending")
+                status = "partial"
+                break
+            if self._finish(unit, "done"):
+                done.append(unit["unit_id"])
+
+        return {
+            "status": status,
+            "cycle": cycle,
+            "units": done,
+            "count": total,
+            "summary": self.store.summary(cycle, entity),
+        }
@@ -1,313 +1,930 @@
 import os
+import json
+import time
+import asyncio
+import threading
+import contextvars
+import hashlib
 import logging
-from google.cloud import secretmanager
+import itertools
+import contextlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from testrail_client import TestRailClient
-from bigquery_client import BigQueryClient
 from jira_client import JiraClient
+from metadata_cache import MetadataCache
+from pipeline import Pipeline
+from scheduler import DagScheduler
+from secret_cache import SecretCache
+import metrics
 
 logger = logging.getLogger(__name__)
 
+# Set by run_sync_async: fetch with the async clients whatever SYNC_ASYNC_FETCH says
+_force_async_fetch = contextvars.ContextVar("force_async_fetch", default=False)
+
+# Results created up to this long before a run's last capture are fetched again (clock skew)
+CAPTURE_OVERLAP_SECONDS = 300
+
 class SyncEngine:
-    def __init__(self):
+    # What each entity must wait for in an "all" sync. Everything else runs concurrently.
+    ENTITY_DEPENDENCIES = {
+        "projects": [], "users": [], "statuses": [],    # Metadata
+        "milestones": ["projects"],
+        "plans": ["projects"],                          # Structure
+        "runs": ["projects"],
+        "suites": ["projects"],
+        "cases": ["suites"],                            # reuses the cached suites
+        "tests": ["runs", "plans"],                     # Data: read run fingerprints from raw_runs
+        "results": ["runs", "plans"],
+        "jira_issues": [],                              # External
+    }
+    ALL_ENTITIES = list(ENTITY_DEPENDENCIES)
+
+    # Tables each entity writes, flushed when that entity finishes
+    ENTITY_TABLES = {
+        "projects": ["raw_projects"],
+        "users": ["raw_users"],
+        "statuses": ["raw_statuses"],
+        "milestones": ["raw_milestones"],
+        "plans": ["raw_plans", "raw_runs"],
+        "runs": ["raw_runs"],
+        "suites": ["raw_suites"],
+        "cases": ["raw_cases"],
+        "tests": ["raw_tests"],
+        "results": ["raw_results"],
+        "jira_issues": ["raw_jira_issues"],
+    }
+
+    def __init__(self, secrets=None, tr_client=None, bq_client=None, jira_client=None):
+        """
+        Clients are built from Secret Manager/env unless passed in
+        (the benchmark passes clients pointed at local stand-ins).
+        """
         self.project_id = os.environ.get("GCP_PROJECT_ID")
         self.bq_dataset = os.environ.get("BQ_DATASET")
+        # Number of runs fetched from TestRail in parallel by tests/results sync
+        self.max_workers = int(os.environ.get("SYNC_MAX_WORKERS", "8"))
+        # Projects and suites are looked up once per sync cycle
+        self.metadata = MetadataCache(ttl_seconds=int(os.environ.get("SYNC_METADATA_TTL", "900")))
+        # Number of entities synced at the same time by "all"
+        self.max_parallel_entities = int(os.environ.get("SYNC_MAX_PARALLEL_ENTITIES", "4"))
+        # tests/results stop starting new runs after this many seconds (0 = no limit)
+        # and resume from their checkpoint on the next sync
+        self.time_budget = int(os.environ.get("SYNC_TIME_BUDGET_SECONDS", "0"))
+        # Completed runs between two checkpoint commits
+        self.checkpoint_every = int(os.environ.get("SYNC_CHECKPOINT_EVERY", "50"))
+        # Refresh the sql/ models after every "all" sync (off by default: the image does not ship sql/)
+        self.materialize_after_sync = os.environ.get("SYNC_MATERIALIZE", "false").lower() in ('1', 'true', 'yes')
+        self.materializer = None
+        # Called as listener(entity, result) whenever run_sync or a shard worker finishes (result is None on failure)
+        self.sync_listeners = []
+        # Learned API concurrency/page sizes are read from api_tuning on the first sync
+        self.tuning_loaded = False
+        # tests/results/Jira page through runs and windows as coroutines on one event loop
+        # (async_clients.py) instead of SYNC_MAX_WORKERS / JIRA_MAX_WORKERS threads
+        self.async_fetch = os.environ.get("SYNC_ASYNC_FETCH", "false").lower() in ('1', 'true', 'yes')
+        # Runs fetched at the same time in async mode
+        self.async_concurrency = int(os.environ.get("SYNC_ASYNC_CONCURRENCY", "100"))
+        self.async_clients = None
+        self._async_lock = threading.Lock()
+        
+        # Secret Manager values, shared by every engine of the process when passed in
+        self.secrets = secrets or SecretCache(self.project_id)
+        
+        self.tr_credentials = None
+        self.tr_client = tr_client
+        if tr_client is None:
+            start = time.monotonic()
+            self.tr_credentials = self._testrail_credentials()
+            self.tr_client = TestRailClient(*self.tr_credentials)
+            logger.info(f"TestRail client ready in {time.monotonic() - start:.3f}s")
         
-        # Fetch secrets
-        self.tr_base_url = self._get_secret("testrail_url")
-        self.tr_user = self._get_secret("testrail_user")
-        self.tr_api_key = self._get_secret("testrail_api_key")
+        self.bq_client = bq_client
+        if bq_client is None:
+            start = time.monotonic()
+            # Imported here: google.cloud.bigquery is slow to import and not needed until a sync runs
+            from bigquery_client import BigQueryClient
+            self.bq_client = BigQueryClient(self.project_id, self.bq_dataset)
+            logger.info(f"BigQuery client ready in {time.monotonic() - start:.3f}s")
         
-        self.tr_client = TestRailClient(self.tr_base_url, self.tr_user, self.tr_api_key)
-        self.bq_client = BigQueryClient(self.project_id, self.bq_dataset)
-        self.jira_client = JiraClient()
+        self.jira_client = jira_client or JiraClient()
 
     def _get_secret(self, secret_id):
+        return self.secrets.get(secret_id)
+
+    def _testrail_credentials(self):
+        return (
+            self._get_secret("testrail_url"),
+            self._get_secret("testrail_user"),
+            self._get_secret("testrail_api_key"),
+        )
+
+    def refresh_credentials(self):
+        """
+        Rebuilds the TestRail client if its secrets changed since the last
+        check (a no-op while the cached secrets are fresh).
+        """
+        if self.tr_credentials is None:
+            # Injected client
+            return
+        credentials = self._testrail_credentials()
+        if credentials != self.tr_credentials:
+            logger.info("TestRail credentials changed, rebuilding the client")
+            self.tr_credentials = credentials
+            tuner = self.tr_client.tuner
+            self.tr_client = TestRailClient(*credentials)
+            if tuner and self.tr_client.tuner:
+                self.tr_client.tuner.load(tuner.state())
+                self.tr_client.tuner.saved = tuner.saved
+            with self._async_lock:
+                # Rebuilt with the new credentials on next use. Syncs still fetching
+                # with the old clients keep them; the last one to finish closes them.
+                retired, self.async_clients = self.async_clients, None
+                close_now = retired is not None and retired.users == 0
+            if close_now:
+                retired.close()
+
+    @contextlib.contextmanager
+    def _async_clients_in_use(self):
+        """
+        The event loop and async TestRail/Jira clients (built on first use),
+        held for one fetch so refresh_credentials cannot close them under it.
+        """
+        with self._async_lock:
+            if self.async_clients is None:
+                # Imported here: httpx is only needed in async mode
+                from async_clients import AsyncClients
+                base_url = self.tr_client.base_url.split('/index.php')[0]
+                # One rate limit per API for the whole process, threaded and async alike
+                self.async_clients = AsyncClients(base_url, *self.tr_client.auth,
+                                                  tr_bucket=self.tr_client.session.bucket,
+                                                  jira_bucket=self.jira_client.session.bucket)
+                if self.tuning_loaded:
+                    for tuner in (self.async_clients.testrail.tuner, self.async_clients.jira.tuner):
+                        if tuner:
+                            self._load_tuner(tuner)
+            clients = self.async_clients
+            clients.users += 1
         try:
-            client = secretmanager.SecretManagerServiceClient()
-            name = f"projects/{self.project_id}/secrets/{secret_id.upper()}/versions/latest"
-            response = client.access_secret_version(request={"name": name})
-            return response.payload.data.decode("UTF-8")
-        except Exception:
-            # Fallback to env vars (local dev or if auth fails)
-            return os.environ.get(secret_id.upper())
-
-    def run_sync(self, entity):
-        logger.info(f"Starting sync for {entity}")
+            yield clients
+        finally:
+            with self._async_lock:
+                clients.users -= 1
+                close_now = clients.users == 0 and clients is not self.async_clients
+            if close_now:
+                logger.info("Closing the async clients replaced by a credential change")
+                clients.close()
+
+    async def run_sync_async(self, entity, full_refresh=False, progress=None):
+        """
+        run_sync for asyncio callers, with tests/results/Jira fetched by the
+        async clients regardless of SYNC_ASYNC_FETCH. The sync runs in a
+        worker thread (BigQuery writes block), so the caller's loop stays free.
+        """
+        _force_async_fetch.set(True)
+        # to_thread runs it in a copy of this context
+        return await asyncio.to_thread(self.run_sync, entity, full_refresh, progress)
+
+    def _use_async_fetch(self):
+        return self.async_fetch or _force_async_fetch.get()
+
+    def _tuners(self):
+        clients = [self.tr_client, self.jira_client]
+        if self.async_clients:
+            clients += [self.async_clients.testrail, self.async_clients.jira]
+        return [client.tuner for client in clients if getattr(client, "tuner", None)]
+
+    def _load_tuning(self):
+        """
+        Restores each API client's learned concurrency and page sizes
+        (autotune.AdaptiveController) from api_tuning, once per engine.
+        """
+        if self.tuning_loaded:
+            return
+        self.tuning_loaded = True
+        for tuner in self._tuners():
+            self._load_tuner(tuner)
+
+    def _load_tuner(self, tuner):
+        try:
+            state = self.bq_client.get_tuning(tuner.name)
+        except Exception as e:
+            logger.warning(f"Could not read the {tuner.name} tuning: {e}")
+            return
+        if state:
+            tuner.load(state)
+
+    def _save_tuning(self):
+        """
+        Writes the tuning values that changed since they were last loaded or saved.
+        """
+        for tuner in self._tuners():
+            changes = tuner.changes()
+            try:
+                if changes:
+                    self.bq_client.save_tuning(tuner.name, changes)
+                    self.bq_client.flush(["api_tuning"])
+            except Exception as e:
+                logger.warning(f"Could not save the {tuner.name} tuning: {e}")
+                continue
+            tuner.mark_saved(changes)
+            if changes:
+                logger.info(f"Saved {tuner.name} tuning: {changes}")
+
+    def run_sync(self, entity, full_refresh=False, progress=None):
+        """
+        Syncs one entity, or every entity for "all".
+        full_refresh ignores stored watermarks and re-pulls full history.
+        progress(entity, result) is called as each entity finishes.
+        """
+        result = None
+        try:
+            self._load_tuning()
+            result = self._run_sync(entity, full_refresh, progress)
+            return result
+        finally:
+            self.sync_finished(entity, result)
+
+    def sync_finished(self, entity, result):
+        """
+        Saves the learned tuning and calls the sync listeners. run_sync does
+        this itself; sharded syncs (sharding.ShardWorker) call it once the
+        worker is done with its units.
+        """
+        self._save_tuning()
+        for listener in self.sync_listeners:
+            try:
+                listener(entity, result)
+            except Exception as e:
+                logger.warning(f"Sync listener failed: {e}")
+
+    def _run_sync(self, entity, full_refresh=False, progress=None):
+        logger.info(f"Starting sync for {entity} (full_refresh={full_refresh})")
+        deadline = time.monotonic() + self.time_budget if self.time_budget > 0 else None
         
-        if entity == "projects":
-            return self._sync_projects()
-        elif entity == "runs":
-            return self._sync_runs()
-        elif entity == "plans":
-            return self._sync_plans()
-        elif entity == "suites":
-            return self._sync_suites()
-        elif entity == "cases":
-            return self._sync_cases()
-        elif entity == "tests":
-            return self._sync_tests()
-        elif entity == "results":
-            return self._sync_results()
-        elif entity == "milestones":
-            return self._sync_milestones()
-        elif entity == "statuses":
-            return self._sync_statuses()
-        elif entity == "jira_issues":
-            return self.sync_jira()
-        elif entity == "users":
-            return self._sync_users()
-        elif entity == "all":
-            results = {}
-            # Metadata
-            results['projects'] = self._sync_projects()
-            results['users'] = self._sync_users()
-            results['statuses'] = self._sync_statuses()
-            results['milestones'] = self._sync_milestones()
-            
-            # Structure
-            results['plans'] = self._sync_plans()
-            results['runs'] = self._sync_runs()
-            # specific order might matter if dependencies exist, but raw tables are independent mostly
-            results['suites'] = self._sync_suites()
-            results['cases'] = self._sync_cases()
-            
-            # Data
-            results['tests'] = self._sync_tests()
-            results['results'] = self._sync_results()
+        if entity == self.MATERIALIZE:
+            return self.materialize(full_refresh=full_refresh)
+        
+        if entity == "all":
+            # A new cycle always starts from fresh metadata
+            self.metadata.invalidate()
+            # Each entity is flushed when it finishes, so tests/results
+            # (which wait for runs and plans) see the loaded raw_runs.
+            tasks = {
+                name: (lambda name=name: self._run_entity(name, full_refresh, progress, deadline), deps)
+                for name, deps in self.ENTITY_DEPENDENCIES.items()
+            }
+            report = DagScheduler(tasks, max_parallel=self.max_parallel_entities).run()
             
-            # External
-            results['jira_issues'] = self.sync_jira()
+            statuses = {result.get("status") for result in report["results"].values()}
+            if statuses - {"success", "partial"}:
+                status = "error"
+            elif "partial" in statuses:
+                # Stopped at the time budget, continues from its checkpoints next time
+                status = "partial"
+            else:
+                status = "success"
+            critical = report["critical_path"]
+            drift = self.bq_client.schema_drift()
+            if drift:
+                logger.warning(f"Fields without a BigQuery column (not stored): {drift}")
+            logger.info(f"Sync 'all' finished in {report['wall_time_s']}s; critical path "
+                        f"{' -> '.join(critical['tasks'])} ({critical['duration_s']}s)")
             
-            return {"status": "success", "detailed_results": results}
-        else:
+            # Post-sync stage: refresh what this sync touched in the dashboard tables
+            if self.materialize_after_sync:
+                try:
+                    materialized = self.materialize(full_refresh=full_refresh)
+                except Exception as e:
+                    logger.exception("Materialization failed")
+                    materialized = {"status": "error", "error": str(e)}
+            else:
+                materialized = {"status": "skipped", "reason": "SYNC_MATERIALIZE is off"}
+            if progress:
+                progress(self.MATERIALIZE, materialized)
+            return {
+                "status": status,
+                "detailed_results": report["results"],
+                "timings": report["timings"],
+                "critical_path": critical,
+                "wall_time_s": report["wall_time_s"],
+                "api_stats": self.tr_client.get_stats(),
+                "schema_drift": drift,
+                "materialize": materialized,
+            }
+        
+        return self._run_entity(entity, full_refresh, progress, deadline)
+
+    def _run_entity(self, entity, full_refresh=False, progress=None, deadline=None):
+        handlers = {
+            "projects": self._sync_projects,
+            "runs": self._sync_runs,
+            "plans": self._sync_plans,
+            "suites": self._sync_suites,
+            "cases": self._sync_cases,
+            # Long per-run syncs honour the time budget
+            "tests": lambda full_refresh: self._sync_tests(full_refresh, deadline),
+            "results": lambda full_refresh: self._sync_results(full_refresh, deadline),
+            "milestones": self._sync_milestones,
+            "statuses": self._sync_statuses,
+            "jira_issues": self.sync_jira,
+            "users": self._sync_users,
+        }
+        if entity not in handlers:
             raise ValueError(f"Unknown entity: {entity}")
+        
+        try:
+            with metrics.SyncSpan(entity) as span:
+                try:
+                    result = handlers[entity](full_refresh=full_refresh)
+                finally:
+                    # Commit this entity's buffered rows (one load job per table) and their watermarks
+                    self.bq_client.flush(self.ENTITY_TABLES[entity])
+                span.status = result.get("status")
+        except Exception as e:
+            if progress:
+                progress(entity, {"status": "error", "error": str(e), "metrics": span.to_dict()})
+            raise
+        # API calls, pages, bytes, retries, 429s and BigQuery rows/latency of this entity
+        result["metrics"] = span.to_dict()
+        if progress:
+            progress(entity, result)
+        return result
 
-    def _sync_projects(self):
-        projects = self.tr_client.get_projects()
-        self.bq_client.insert_rows("raw_projects", projects)
-        return {"status": "success", "count": len(projects)}
+    # Pseudo-entity for the post-sync transformation stage
+    MATERIALIZE = "materialize"
+
+    def materialize(self, full_refresh=False):
+        """
+        Materializes the sql/ models, refreshing only what the last syncs
+        touched (see Materializer). full_refresh rebuilds every table.
+        """
+        if self.materializer is None:
+            # Imported here: google.cloud.bigquery is slow to import and not needed until a sync runs
+            from materializer import Materializer
+            self.materializer = Materializer(self.bq_client)
+        with metrics.SyncSpan(self.MATERIALIZE) as span:
+            result = self.materializer.run(full_refresh=full_refresh)
+            span.status = result["status"]
+        result["metrics"] = span.to_dict()
+        return result
+
+    # Entities that can be split into (project, run range) shards
+    SHARDED_ENTITIES = ["tests", "results"]
+
+    def run_shard(self, entity, project_id, run_range, full_refresh=False, deadline=None, lost_lease=None):
+        """
+        Syncs one shard: the runs of project_id with IDs in run_range
+        (inclusive). Returns the entity result ("success" or "partial").
+        Once lost_lease (a threading.Event) is set, another worker owns the
+        shard: no new runs are started, nothing is checkpointed and the
+        status is "lost_lease".
+        """
+        handlers = {"tests": self._sync_tests, "results": self._sync_results}
+        if entity not in handlers:
+            raise ValueError(f"Entity {entity} cannot be sharded")
+        self._load_tuning()
+        with metrics.SyncSpan(entity) as span:
+            try:
+                result = handlers[entity](full_refresh=full_refresh, deadline=deadline,
+                                          project_ids=[project_id], run_range=run_range, lost_lease=lost_lease)
+            finally:
+                self.bq_client.flush(self.ENTITY_TABLES[entity])
+            span.status = result.get("status")
+        result["metrics"] = span.to_dict()
+        return result
+
+    def _get_watermark(self, entity, scope_id, full_refresh=False):
+        if full_refresh:
+            return 0
+        return self.bq_client.get_watermark(entity, scope_id=scope_id) or 0
+
+    @staticmethod
+    def _max_ts(rows, start):
+        """
+        Latest change timestamp (updated_on, completed_on or created_on) across rows, or start.
+        """
+        max_ts = start
+        for row in rows:
+            for field in ('updated_on', 'completed_on', 'created_on'):
+                ts = row.get(field)
+                if isinstance(ts, int) and ts > max_ts:
+                    max_ts = ts
+        return max_ts
+
+    @staticmethod
+    def _is_changed(row, watermark):
+        """
+        Whether a list-payload row may have changed since the watermark.
+        Rows without updated_on are treated as changed unless they were
+        completed before the watermark.
+        """
+        if not watermark:
+            return True
+        if row.get('updated_on'):
+            return row['updated_on'] > watermark
+        if row.get('is_completed') and row.get('completed_on'):
+            return row['completed_on'] > watermark
+        return True
+
+    def _fetch_details(self, fetch, items):
+        """
+        Fetches detail payloads for items in parallel. Returns {id: detail}.
+        """
+        details = {}
+        for item_id, detail in self._fan_out(fetch, [item['id'] for item in items]):
+            if detail:
+                details[item_id] = detail
+        return details
+
+    def _get_projects(self):
+        return self.metadata.get(("projects",), self.tr_client.get_projects)
+
+    def _get_suites(self, project_id):
+        return self.metadata.get(("suites", project_id), lambda: self.tr_client.get_suites(project_id))
+
+    @staticmethod
+    def _content_hash(row):
+        return hashlib.md5(json.dumps(row, sort_keys=True, default=str).encode()).hexdigest()
 
-    def _sync_runs(self):
+    def _insert_changed(self, table_name, rows, full_refresh=False, key_fields=("id",)):
+        """
+        Appends only the snapshot rows whose content changed since they were
+        last written (per the content_hashes index), each with its
+        _content_hash if the table has that column. The index is updated
+        once the rows are loaded. Returns the number of rows written.
+        """
+        known = {} if full_refresh else self.bq_client.get_content_hashes(table_name)
+        tagged = self.bq_client.has_column(table_name, "_content_hash")
+        changed, hashes = [], {}
+        for row in rows:
+            row_key = ":".join(str(row.get(field)) for field in key_fields)
+            content_hash = self._content_hash(row)
+            if known.get(row_key) != content_hash:
+                changed.append(dict(row, _content_hash=content_hash) if tagged else row)
+                hashes[row_key] = content_hash
+        if changed:
+            self.bq_client.insert_rows(table_name, changed)
+            self.bq_client.flush([table_name])
+            self.bq_client.record_content_hashes(table_name, hashes)
+            self.bq_client.flush(["content_hashes"])
+        logger.info(f"{table_name}: {len(changed)} of {len(rows)} rows new or changed")
+        return len(changed)
+
+    def _sync_projects(self, full_refresh=False):
         projects = self.tr_client.get_projects()
+        self.metadata.set(("projects",), projects)
+        written = self._insert_changed("raw_projects", projects, full_refresh)
+        return {"status": "success", "count": len(projects), "written": written}
+
+    def _sync_runs(self, full_refresh=False):
+        projects = self._get_projects()
         total_synced = 0
         
         for project in projects:
             project_id = project['id']
-            watermark = self.bq_client.get_watermark("runs", scope_id=project_id)
+            watermark = self._get_watermark("runs", project_id, full_refresh)
             runs = self.tr_client.get_runs(project_id=project_id, updated_after=watermark)
             
             if runs:
-                self.bq_client.insert_rows("raw_runs", runs)
-                max_ts = watermark
-                for run in runs:
-                    ts = run.get('updated_on', run.get('created_on'))
-                    if ts and ts > max_ts:
-                        max_ts = ts
+                self.bq_client.upsert_rows("raw_runs", runs, newer_wins="updated_on")
+                max_ts = self._max_ts(runs, watermark)
                 
-                self.bq_client.update_watermark("runs", max_ts, scope_id=project_id)
+                self.bq_client.update_watermark("runs", max_ts, scope_id=project_id, after_table="raw_runs")
                 total_synced += len(runs)
                 
         return {"status": "success", "count": total_synced}
 
-    def _sync_suites(self):
-        projects = self.tr_client.get_projects()
+    def _sync_suites(self, full_refresh=False):
+        projects = self._get_projects()
         total = 0
+        snapshot = []
         for project in projects:
             suites = self.tr_client.get_suites(project['id'])
+            self.metadata.set(("suites", project['id']), suites)
             if suites:
                 for s in suites:
                     s['project_id'] = project['id']
-                self.bq_client.insert_rows("raw_suites", suites)
+                snapshot.extend(suites)
                 total += len(suites)
-        return {"status": "success", "count": total}
+        written = self._insert_changed("raw_suites", snapshot, full_refresh)
+        return {"status": "success", "count": total, "written": written}
 
-    def _sync_cases(self):
-        projects = self.tr_client.get_projects()
+    def _sync_cases(self, full_refresh=False):
+        projects = self._get_projects()
         total = 0
         for project in projects:
+            project_id = project['id']
+            watermark = self._get_watermark("cases", project_id, full_refresh)
+            state = {"max_ts": watermark}
             try:
                 # Check suite mode
                 # 1: Single Suite, 2: Single Suite + Baselines, 3: Multiple Suites
                 suite_mode = project.get('suite_mode', 1)
                 
                 if suite_mode == 3:
-                    suites = self.tr_client.get_suites(project['id'])
-                    if suites:
-                        for suite in suites:
-                            cases = self.tr_client.get_cases(project['id'], suite_id=suite['id'])
-                            if cases:
-                                for c in cases:
-                                    c['project_id'] = project['id']
-                                    c['suite_id'] = suite['id']
-                                self.bq_client.insert_rows("raw_cases", cases)
-                                total += len(cases)
+                    suite_ids = [suite['id'] for suite in self._get_suites(project_id) or []]
                 else:
-                    cases = self.tr_client.get_cases(project['id'])
-                    if cases:
-                        for c in cases:
-                            c['project_id'] = project['id']
-                        self.bq_client.insert_rows("raw_cases", cases)
-                        total += len(cases)
+                    suite_ids = [None]
+                
+                def transform(suite_id, cases):
+                    for c in cases:
+                        c['project_id'] = project_id
+                        if suite_id:
+                            c['suite_id'] = suite_id
+                    state["max_ts"] = self._max_ts(cases, state["max_ts"])
+                    return self.bq_client.clean_rows("raw_cases", cases)
+                
+                # Next page downloads while the previous one is being written
+                pipeline = Pipeline(
+                    write=lambda suite_id, rows: self.bq_client.upsert_rows("raw_cases", rows, newer_wins="updated_on", cleaned=True),
+                    transform=transform,
+                )
+                total += pipeline.run(
+                    lambda suite_id: self.tr_client.iter_case_pages(project_id, suite_id=suite_id, updated_after=watermark),
+                    items=suite_ids,
+                    workers=self.max_workers,
+                )
             except Exception as e:
-                logger.error(f"Failed to sync cases for project {project['id']}: {e}")
+                logger.error(f"Failed to sync cases for project {project_id}: {e}")
                 continue
+            
+            if state["max_ts"] > watermark:
+                self.bq_client.update_watermark("cases", state["max_ts"], scope_id=project_id, after_table="raw_cases")
         return {"status": "success", "count": total}
 
-    def _sync_plans(self):
-        projects = self.tr_client.get_projects()
+    def _sync_plans(self, full_refresh=False):
+        import json
+        projects = self._get_projects()
         total_plans = 0
         total_runs = 0
         
         for project in projects:
             project_id = project['id']
-            plans = self.tr_client.get_plans(project_id)
+            watermark = self._get_watermark("plans", project_id, full_refresh)
+            plans = self.tr_client.get_plans(project_id, updated_after=watermark or None) or []
+            changed = [p for p in plans if self._is_changed(p, watermark)]
             
-            for plan in plans:
-                detailed_plan = self.tr_client.get_plan(plan['id'])
-                if detailed_plan:
-                    detailed_plan['project_id'] = project_id
-                    custom_fields = {k: v for k, v in detailed_plan.items() if k.startswith('custom_')}
-                    import json
-                    if custom_fields:
-                        detailed_plan['custom_fields'] = json.dumps(custom_fields)
-                    
-                    if 'entries' in detailed_plan:
-                        entries_data = detailed_plan['entries']
-                        detailed_plan['entries'] = json.dumps(entries_data)
-                    else:
-                        entries_data = []
-
-                    self.bq_client.insert_rows("raw_plans", [detailed_plan])
-                    total_plans += 1
-                    
-                    if entries_data:
-                        extracted_runs = []
-                        for entry in entries_data:
-                            if 'runs' in entry:
-                                for run in entry['runs']:
-                                    run['plan_id'] = detailed_plan['id']
-                                    run['project_id'] = project_id
-                                    extracted_runs.append(run)
-                        
-                        if extracted_runs:
-                            self.bq_client.insert_rows("raw_runs", extracted_runs)
-                            total_runs += len(extracted_runs)
+            # Only changed plans need get_plan (for their entries); fetched in parallel
+            details = self._fetch_details(self.tr_client.get_plan, changed)
+            
+            plan_rows = []
+            extracted_runs = []
+            for plan in changed:
+                detailed_plan = details.get(plan['id']) or plan
+                detailed_plan['project_id'] = project_id
+                # custom_* fields are collected into custom_fields by the raw_plans normalizer
+                if 'entries' in detailed_plan:
+                    entries_data = detailed_plan['entries']
+                    detailed_plan['entries'] = json.dumps(entries_data)
+                else:
+                    entries_data = []
+                plan_rows.append(detailed_plan)
+                
+                for entry in entries_data or []:
+                    if 'runs' in entry:
+                        for run in entry['runs']:
+                            run['plan_id'] = detailed_plan['id']
+                            run['project_id'] = project_id
+                            extracted_runs.append(run)
+            
+            # One batch per project instead of one insert per plan
+            if plan_rows:
+                self.bq_client.upsert_rows("raw_plans", plan_rows)
+                total_plans += len(plan_rows)
+            if extracted_runs:
+                self.bq_client.upsert_rows("raw_runs", extracted_runs, newer_wins="updated_on")
+                total_runs += len(extracted_runs)
+            
+            max_ts = self._max_ts(plans, watermark)
+            if max_ts > watermark:
+                self.bq_client.update_watermark("plans", max_ts, scope_id=project_id, after_table="raw_plans")
                             
         return {"status": "success", "plans_count": total_plans, "runs_extracted": total_runs}
 
-    def _sync_milestones(self):
-        projects = self.tr_client.get_projects()
+    def _sync_milestones(self, full_refresh=False):
+        projects = self._get_projects()
         total = 0
         for project in projects:
-            milestones = self.tr_client.get_milestones(project['id'])
+            watermark = self._get_watermark("milestones", project['id'], full_refresh)
+            # get_milestones has no server-side filter, so changes are picked client-side
+            milestones = self.tr_client.get_milestones(project['id']) or []
+            changed = [m for m in milestones if self._is_changed(m, watermark)]
+            details = self._fetch_details(self.tr_client.get_milestone, changed)
+            
             detailed_milestones = []
-            for m in milestones:
-                detail = self.tr_client.get_milestone(m['id'])
-                if detail:
-                    detail['project_id'] = project['id']
-                    custom_fields = {k: v for k, v in detail.items() if k.startswith('custom_')}
-                    import json
-                    if custom_fields:
-                        detail['custom_fields'] = json.dumps(custom_fields)
-                    detailed_milestones.append(detail)
+            for m in changed:
+                detail = details.get(m['id']) or m
+                detail['project_id'] = project['id']
+                detailed_milestones.append(detail)
             
             if detailed_milestones:
-                self.bq_client.insert_rows("raw_milestones", detailed_milestones)
+                self.bq_client.upsert_rows("raw_milestones", detailed_milestones)
                 total += len(detailed_milestones)
+            
+            max_ts = self._max_ts(milestones, watermark)
+            if max_ts > watermark:
+                self.bq_client.update_watermark("milestones", max_ts, scope_id=project['id'], after_table="raw_milestones")
         return {"status": "success", "count": total}
 
-    def _sync_statuses(self):
+    def _sync_statuses(self, full_refresh=False):
         statuses = self.tr_client.get_statuses()
-        if statuses:
-            self.bq_client.insert_rows("raw_statuses", statuses)
-        return {"status": "success", "count": len(statuses)}
+        written = self._insert_changed("raw_statuses", statuses or [], full_refresh)
+        return {"status": "success", "count": len(statuses), "written": written}
 
-    def _sync_users(self):
+    def _sync_users(self, full_refresh=False):
         users = self.tr_client.get_users()
-        if users:
-            self.bq_client.insert_rows("raw_users", users)
-        return {"status": "success", "count": len(users)}
+        written = self._insert_changed("raw_users", users or [], full_refresh)
+        return {"status": "success", "count": len(users), "written": written}
 
-    def _sync_tests(self):
-        # Optimized to only sync tests for Project 23 to avoid timeouts
-        projects = self.tr_client.get_projects()
+    def _fan_out(self, fn, items):
+        """
+        Calls fn(item) for every item on a bounded thread pool and yields
+        (item, result) pairs as they complete.
+        At most max_workers calls are in flight and only a small window of
+        work is queued ahead, so finished results never pile up faster than
+        the caller writes them. 429s are retried inside TestRailClient.
+        """
+        items = iter(items)
+        if self.max_workers <= 1:
+            for item in items:
+                yield item, fn(item)
+            return
+
+        # Counted against the calling entity's metrics span
+        fn = metrics.in_context(fn)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            pending = {}
+            for item in itertools.islice(items, self.max_workers * 2):
+                pending[executor.submit(fn, item)] = item
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    yield item, future.result()
+                    for next_item in itertools.islice(items, 1):
+                        pending[executor.submit(fn, next_item)] = next_item
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _sync_run_data(self, entity, table_name, fetch_pages, full_refresh=False, deadline=None,
+                       project_ids=None, run_range=None, lost_lease=None, async_fetch_pages=None, loop=None,
+                       workers=None):
+        """
+        Shared driver for per-run entities (tests, results).
+        Only runs whose fingerprint (is_completed, updated_on and the *_count
+        columns of raw_runs) changed since they were last captured for this
+        entity are fetched; runs captured after completion are never fetched
+        again. max_workers threads page through runs with
+        fetch_pages(run_id, since) and feed a Pipeline, so transform and
+        BigQuery writes overlap with downloads and memory stays bounded by the
+        pipeline queues rather than run or project size. since is the epoch
+        the run was last captured (minus an overlap), or None for a full fetch.
+
+        Progress is committed every checkpoint_every runs: the table is
+        flushed, then the fingerprints of the finished runs and a per-project
+        "<entity>_checkpoint" row in sync_state (the highest run ID up to
+        which every run is loaded) are written. A retried sync skips those
+        runs if the interrupted attempt captured them with their current
+        fingerprint. Past
+        the deadline no new runs are started; the sync checkpoints and
+        returns status "partial".
+        project_ids and run_range (first, last run ID) restrict the sync to
+        one shard of the work (see sharding.py); each shard keeps its own
+        checkpoint. When lost_lease is set the shard has been handed to another
+        worker: the sync stops like at the deadline but commits nothing.
+        In async mode async_fetch_pages(clients, run_id, since), an async
+        iterator of pages, is used instead, with async_concurrency runs in
+        flight on the clients' loop.
+        """
+        if async_fetch_pages and self._use_async_fetch():
+            with self._async_clients_in_use() as clients:
+                return self._sync_run_data(
+                    entity, table_name, lambda run_id, since: async_fetch_pages(clients, run_id, since),
+                    full_refresh=full_refresh, deadline=deadline, project_ids=project_ids, run_range=run_range,
+                    lost_lease=lost_lease, loop=clients.loop, workers=self.async_concurrency)
+        workers = workers or self.max_workers
+        if project_ids is not None:
+            projects = [{'id': project_id} for project_id in project_ids]
+        else:
+            projects = self._get_projects()
+        checkpoint_entity = f"{entity}_checkpoint"
+        # A full refresh deliberately starts over
+        checkpoints = {} if full_refresh else self.bq_client.get_checkpoints(checkpoint_entity)
         total = 0
         
-        for project in projects:
-            # Temporary Fix: Limit to Project 23 (Verification) and 12 (Production)
-            if project['id'] not in [12, 23, 4, 8]:
+        for index, project in enumerate(projects):
+            if deadline and time.monotonic() >= deadline:
+                remaining = [p['id'] for p in projects[index:]]
+                logger.warning(f"Time budget reached, {entity} stops before projects {remaining}")
+                return {"status": "partial", "count": total, "remaining_projects": remaining}
+            
+            project_id = project['id']
+            runs = self.bq_client.get_changed_runs(entity, project_id, include_unchanged=full_refresh)
+            scope = str(project_id)
+            if run_range:
+                runs = [run for run in runs if run_range[0] <= run['id'] <= run_range[1]]
+                scope = f"{project_id}:{run_range[0]}-{run_range[1]}"
+            if not runs:
                 continue
-
-            query = f"SELECT id FROM `{self.bq_dataset}.raw_runs` WHERE project_id = {project['id']}"
-            query_job = self.bq_client.client.query(query)
-            run_ids = [row.id for row in query_job]
+            # Runs not captured since fingerprints were introduced fall back to the old watermark
+            watermark = self._get_watermark(entity, project_id, full_refresh)
+            
+            # Runs covered by an earlier, interrupted attempt are skipped if
+            # that attempt captured them as they are now
+            started_at = int(time.time())
+            done_up_to, attempt_started = checkpoints.get(scope, (0, None))
+            if done_up_to:
+                started_at = attempt_started or started_at
+            pending = {run['id']: run for run in runs
+                       if not self._captured_since(run, started_at, done_up_to)}
+            resume = f", resuming after run {done_up_to}" if done_up_to else ""
+            logger.info(f"Syncing {entity} for Project {project_id} ({len(pending)} changed runs{resume})")
             
-            logger.info(f"Syncing tests for Project {project['id']} ({len(run_ids)} runs)")
+            tracker = _RunCheckpoint([run['id'] for run in runs], done_up_to, pending)
+            fetched_at = {}
             
-            for run_id in run_ids:
-                tests = self.tr_client.get_tests(run_id)
-                if tests:
-                    self.bq_client.insert_rows("raw_tests", tests)
-                    total += len(tests)
+            def fetch(run_id, pending=pending, fetched_at=fetched_at, watermark=watermark):
+                run = pending[run_id]
+                fetched_at[run_id] = int(time.time())
+                since = None
+                if not full_refresh:
+                    since = run['captured_at'] - CAPTURE_OVERLAP_SECONDS if run['captured_at'] else watermark
+                return fetch_pages(run_id, since or None)
+            
+            def commit(final=False, project_id=project_id, scope=scope, tracker=tracker, pending=pending,
+                       fetched_at=fetched_at, started_at=started_at, done_up_to=done_up_to):
+                if lost_lease is not None and lost_lease.is_set():
+                    # The new owner checkpoints this shard; ours could move it past runs it still needs
+                    return
+                # Data first, then what marks it as captured
+                self.bq_client.flush([table_name])
+                captured = [dict(pending[run_id], captured_at=fetched_at[run_id]) for run_id in tracker.recent]
+                if captured:
+                    self.bq_client.record_run_fingerprints(entity, project_id, captured)
+                    self.bq_client.flush(["run_fingerprints"])
+                if not final:
+                    self.bq_client.update_watermark(checkpoint_entity, tracker.done_up_to, scope_id=scope,
+                                                    status="IN_PROGRESS", synced_at=started_at)
+                elif done_up_to or tracker.commits:
+                    # Project finished: close its checkpoint
+                    self.bq_client.update_watermark(checkpoint_entity, 0, scope_id=scope)
+                tracker.committed()
+            
+            def on_run_done(run_id, tracker=tracker, commit=commit):
+                tracker.complete(run_id)
+                if len(tracker.recent) >= self.checkpoint_every:
+                    commit()
+            
+            pipeline = Pipeline(
+                write=lambda run_id, rows: self.bq_client.upsert_rows(table_name, rows, cleaned=True),
+                transform=lambda run_id, rows: self.bq_client.clean_rows(table_name, rows),
+                on_item_done=on_run_done,
+            )
+            total += pipeline.run(fetch, items=self._until(deadline, list(pending), lost_lease),
+                                  workers=workers, loop=loop)
+            
+            if lost_lease is not None and lost_lease.is_set():
+                logger.warning(f"Lost the lease on {entity} for Project {project_id} ({scope}), "
+                               f"stopped without checkpointing")
+                return {"status": "lost_lease", "count": total}
+            if not tracker.finished():
+                if tracker.recent:
+                    commit()
+                logger.warning(f"Time budget reached, {entity} for Project {project_id} "
+                               f"checkpointed at run {tracker.done_up_to}")
+                remaining = [p['id'] for p in projects[index:]]
+                return {"status": "partial", "count": total, "remaining_projects": remaining}
+            commit(final=True)
         
         return {"status": "success", "count": total}
 
-    def _sync_results(self):
-        projects = self.tr_client.get_projects()
-        total = 0
-        
-        for project in projects:
-            # Temporary Fix: Limit to Project 23 (Verification) and 12 (Production)
-            if project['id'] not in [12, 23, 4, 8]:
-                continue
+    @staticmethod
+    def _captured_since(run, started_at, done_up_to):
+        """
+        Whether a run up to done_up_to was captured at or after started_at
+        with the fingerprint it still has.
+        """
+        return (run['id'] <= done_up_to
+                and run['captured_at'] is not None and run['captured_at'] >= started_at
+                and run['captured_fingerprint'] == run['fingerprint'])
 
-            query = f"SELECT id FROM `{self.bq_dataset}.raw_runs` WHERE project_id = {project['id']}"
-            query_job = self.bq_client.client.query(query)
-            run_ids = [row.id for row in query_job]
-            
-            for run_id in run_ids:
-                results = self.tr_client.get_results(run_id)
-                if results:
-                    for result in results:
-                        custom_fields = {}
-                        for key, value in result.items():
-                            if key.startswith('custom_'):
-                                custom_fields[key] = value
-                        
-                        if custom_fields:
-                            import json
-                            result['custom_fields'] = json.dumps(custom_fields)
-                    
-                    self.bq_client.insert_rows("raw_results", results)
-                    total += len(results)
-                    
-        return {"status": "success", "count": total}
+    @staticmethod
+    def _until(deadline, items, stop=None):
+        """
+        Yields items until the deadline passes or the stop event is set
+        (all of them without either).
+        """
+        for item in items:
+            if deadline and time.monotonic() >= deadline:
+                return
+            if stop is not None and stop.is_set():
+                return
+            yield item
+
+    def _sync_tests(self, full_refresh=False, deadline=None, **shard):
+        return self._sync_run_data(
+            "tests", "raw_tests",
+            lambda run_id, since: self.tr_client.iter_test_pages(run_id),
+            full_refresh=full_refresh,
+            deadline=deadline,
+            async_fetch_pages=lambda clients, run_id, since: clients.testrail.iter_test_pages(run_id),
+            **shard
+        )
 
-    def sync_jira(self):
+    def _sync_results(self, full_refresh=False, deadline=None, **shard):
+        # custom_* fields are collected into custom_fields by the raw_results normalizer.
+        # Results are immutable, so on a changed run only the ones added since its last capture are needed
+        return self._sync_run_data(
+            "results", "raw_results",
+            lambda run_id, since: self.tr_client.iter_result_pages(run_id, created_after=since),
+            full_refresh=full_refresh,
+            deadline=deadline,
+            async_fetch_pages=lambda clients, run_id, since: clients.testrail.iter_result_pages(
+                run_id, created_after=since),
+            **shard
+        )
+
+    def _jira_windows(self, base_jql, now):
         """
-        Sync Jira issues for Project CM.
+        Splits a Jira backfill into disjoint "updated" windows that can be
+        fetched concurrently. Bounds are relative JQL offsets ("-Nm"), which
+        Jira resolves against its own clock, so the user's timezone setting
+        cannot shift them. The first window is open towards the past and the
+        last one towards the present, so together they cover everything.
         """
-        jql = "project = CM ORDER BY updated DESC"
-        batch_size = 100
-        batch = []
-        total_synced = 0
+        start = datetime.strptime(os.environ.get("JIRA_BACKFILL_START", "2020-01-01"), "%Y-%m-%d")
+        window_minutes = int(os.environ.get("JIRA_BACKFILL_WINDOW_DAYS", "90")) * 24 * 60
+        oldest = max(0, int((now - start.timestamp()) // 60))
+        
+        bounds = list(range(oldest, 0, -window_minutes))
+        if len(bounds) < 2:
+            return [base_jql]
+        
+        windows = [f"{base_jql} AND updated < -{bounds[1]}m"]
+        for upper, lower in zip(bounds[1:], bounds[2:]):
+            windows.append(f"{base_jql} AND updated >= -{upper}m AND updated < -{lower}m")
+        windows.append(f"{base_jql} AND updated >= -{bounds[-1]}m")
+        return windows
+
+    def sync_jira(self, full_refresh=False):
+        """
+        Sync Jira issues for the projects in JIRA_PROJECTS (default CM).
+        Steady state only asks for issues updated since the last sync;
+        a first sync or full_refresh backfills in parallel date windows.
+        JIRA_JQL adds an extra clause to every query (e.g. "issuetype = Bug").
+        """
+        project_keys = [k.strip() for k in os.environ.get("JIRA_PROJECTS", "CM").split(",") if k.strip()]
+        extra_jql = os.environ.get("JIRA_JQL")
+        # Covers clock skew and Jira's minute-level precision
+        overlap_minutes = int(os.environ.get("JIRA_WATERMARK_OVERLAP_MINUTES", "10"))
+        workers = int(os.environ.get("JIRA_MAX_WORKERS", "4"))
         
         logger.info("Starting Jira sync...")
         
+        progress = {"total": 0}
+        
+        def write(_, rows):
+            self.bq_client.upsert_rows('raw_jira_issues', rows, newer_wins='updated', cleaned=True)
+            progress["total"] += len(rows)
+            logger.info(f"Synced {progress['total']} Jira issues so far...")
+        
         try:
-            for issue in self.jira_client.get_all_issues(jql):
-                batch.append(issue)
-                
-                if len(batch) >= batch_size:
-                    self.bq_client.insert_rows('raw_jira_issues', batch)
-                    total_synced += len(batch)
-                    batch = []
-                    logger.info(f"Synced {total_synced} Jira issues so far...")
+            pipeline = Pipeline(write=write, transform=lambda _, rows: self.bq_client.clean_rows('raw_jira_issues', rows))
+            total_synced = 0
             
-            # Insert remaining
-            if batch:
-                self.bq_client.insert_rows('raw_jira_issues', batch)
-                total_synced += len(batch)
+            for project_key in project_keys:
+                base_jql = f'project = "{project_key}"'
+                if extra_jql:
+                    base_jql += f" AND ({extra_jql})"
+                
+                started_at = int(time.time())
+                watermark = self._get_watermark("jira_issues", project_key, full_refresh)
+                if watermark:
+                    minutes = (started_at - watermark) // 60 + overlap_minutes
+                    queries = [f"{base_jql} AND updated >= -{minutes}m"]
+                else:
+                    queries = self._jira_windows(base_jql, started_at)
+                
+                logger.info(f"Jira project {project_key}: {len(queries)} quer{'y' if len(queries) == 1 else 'ies'}")
+                if self._use_async_fetch():
+                    with self._async_clients_in_use() as clients:
+                        total_synced += pipeline.run(
+                            lambda jql: clients.jira.iter_issue_pages(f"{jql} ORDER BY updated DESC"),
+                            items=queries,
+                            workers=workers,
+                            loop=clients.loop,
+                        )
+                else:
+                    total_synced += pipeline.run(
+                        lambda jql: self.jira_client.iter_issue_pages(f"{jql} ORDER BY updated DESC"),
+                        items=queries,
+                        workers=workers,
+                    )
+                self.bq_client.update_watermark("jira_issues", started_at, scope_id=project_key, after_table="raw_jira_issues")
                 
             logger.info(f"Jira sync complete. Total issues: {total_synced}")
             return {"status": "success", "count": total_synced}
@@ -315,3 +932,36 @@ class SyncEngine:
         except Exception as e:
             logger.error(f"Jira sync failed: {e}")
             return {"status": "error", "error": str(e)}
+
+
+class _RunCheckpoint:
+    """
+    Tracks which runs of a project are done and the highest run ID below
+    which all of them are (runs finish out of order across workers).
+    """
+    def __init__(self, run_ids, done_up_to, pending):
+        self.run_ids = sorted(run_ids)
+        self.done = set(self.run_ids) - set(pending)
+        self.position = 0
+        self.done_up_to = done_up_to
+        # Runs finished since the last commit
+        self.recent = []
+        self.commits = 0
+        self._advance()
+
+    def _advance(self):
+        while self.position < len(self.run_ids) and self.run_ids[self.position] in self.done:
+            self.done_up_to = max(self.done_up_to, self.run_ids[self.position])
+            self.position += 1
+
+    def complete(self, run_id):
+        self.done.add(run_id)
+        self.recent.append(run_id)
+        self._advance()
+
+    def committed(self):
+        self.recent = []
+        self.commits += 1
+
+    def finished(self):
+        return self.position == len(self.run_ids)
@@ -2,32 +2,70 @@ import os
 import time
 import requests
 import logging
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type
+from http_session import RateLimitedSession, wait_retry_after
+from autotune import AdaptiveController, autotune_enabled
 
 logger = logging.getLogger(__name__)
 
+
+def _count_retry(retry_state):
+    client, endpoint = retry_state.args[0], retry_state.args[1]
+    client.session.stats.record_retry(endpoint)
+
+
 class TestRailClient:
+    # Endpoints paged with offset/limit
+    PAGED_ENDPOINTS = ("get_cases", "get_tests", "get_results_for_run")
+
     def __init__(self, base_url, user, api_key):
         self.base_url = base_url.rstrip('/') + '/index.php?/api/v2'
         self.auth = (user, api_key)
         self.headers = {'Content-Type': 'application/json'}
+        pool_size = int(os.environ.get("TESTRAIL_POOL_SIZE", "16"))
+        # TestRail returns at most 250 per page; autotuning only shrinks pages that are slow or heavy
+        self.page_limit = int(os.environ.get("TESTRAIL_PAGE_SIZE", "250"))
+        self.tuner = None
+        if autotune_enabled():
+            self.tuner = AdaptiveController(
+                "testrail",
+                max_concurrency=int(os.environ.get("TESTRAIL_MAX_CONCURRENCY", str(pool_size))),
+                page_sizes={endpoint: (self.page_limit, self.page_limit) for endpoint in self.PAGED_ENDPOINTS},
+            )
+        # One pooled session shared by every worker thread.
+        # TESTRAIL_MAX_RPS=0 disables client-side throttling.
+        self.session = RateLimitedSession(
+            rate_per_sec=float(os.environ.get("TESTRAIL_MAX_RPS", "3")),
+            burst=int(os.environ.get("TESTRAIL_BURST", "10")),
+            pool_size=pool_size,
+            auth=self.auth,
+            headers=self.headers,
+            name="testrail",
+            tuner=self.tuner,
+        )
 
     @retry(
         stop=stop_after_attempt(5),
-        wait=wait_exponential(multiplier=1, min=4, max=60),
-        retry=retry_if_exception_type(requests.exceptions.RequestException)
+        # Jittered so threads rate-limited together do not retry together
+        wait=wait_retry_after(wait_random_exponential(multiplier=1, min=4, max=60)),
+        retry=retry_if_exception_type(requests.exceptions.RequestException),
+        before_sleep=_count_retry
     )
-    def _get(self, endpoint, params=None):
+    def _request(self, endpoint, params=None):
         url = f"{self.base_url}/{endpoint}"
-        response = requests.get(url, auth=self.auth, headers=self.headers, params=params)
-        
-        if response.status_code == 429:
-            logger.warning("Rate limit hit. Retrying...")
-            # Tenacity will handle the retry, but we could add explicit sleep here if needed
-            raise requests.exceptions.RequestException("Rate limit hit")
-            
+        # Raises RateLimitError on 429 after pausing the shared rate limiter
+        response = self.session.get(url, endpoint, params=params)
         response.raise_for_status()
-        return response.json()
+        return response
+
+    def _get(self, endpoint, params=None):
+        return self._request(endpoint, params=params).json()
+
+    def get_stats(self):
+        """
+        Per-endpoint call counts, latency and retry/429 counters since startup.
+        """
+        return self.session.stats.snapshot()
 
     def get_projects(self):
         data = self._get("get_projects")
@@ -58,12 +96,6 @@ class TestRailClient:
             return data['runs']
         return data
 
-    def get_plans(self, project_id, created_after=None, updated_after=None):
-        params = {}
-        if created_after:
-            params['created_after'] = created_after
-        if updated_after:
-            params['updated_after'] = updated_after
     def get_plans(self, project_id, created_after=None, updated_after=None):
         params = {}
         if created_after:
@@ -78,26 +110,55 @@ class TestRailClient:
                 return data['plans']
         return data
 
-    def get_results(self, run_id):
-        # get_results_for_run/:run_id
-        # This is often paginated.
-        results = []
+    def _iter_pages(self, endpoint, key, params=None, limit=None):
+        """
+        Yields one page (list) at a time from an offset/limit paginated endpoint,
+        so callers can write each page before the next one is held in memory.
+        Handles both the wrapped response ({"offset", "limit", "size", "_links", key: [...]})
+        and the older bare-list response. Unless limit is given, the page
+        size is the tuner's current one for the endpoint.
+        """
+        key_endpoint = self.session.stats.endpoint_key(endpoint)
+        tuned = limit is None and self.tuner is not None and key_endpoint in self.tuner.page_bounds
         offset = 0
-        limit = 250
         while True:
-            params = {'offset': offset, 'limit': limit}
-            data = self._get(f"get_results_for_run/{run_id}", params=params)
+            page_limit = self.tuner.page_size(key_endpoint) if tuned else limit or self.page_limit
+            page_params = dict(params or {})
+            page_params['offset'] = offset
+            page_params['limit'] = page_limit
+            response = self._request(endpoint, params=page_params)
+            data = response.json()
             
-            # Handle wrapped response
-            if isinstance(data, dict) and 'results' in data:
-                data = data['results']
-                
-            if not data:
+            batch = []
+            if isinstance(data, dict):
+                batch = data.get(key) or []
+            elif isinstance(data, list):
+                batch = data
+            
+            if tuned:
+                self.tuner.record_page(key_endpoint, page_limit, len(batch),
+                                       response.elapsed.total_seconds(), len(response.content))
+            if not batch:
                 break
-            results.extend(data)
-            if len(data) < limit:
+            
+            yield batch
+            
+            # A bare list longer than the page size means the server ignored offset/limit
+            if len(batch) < page_limit or (isinstance(data, list) and len(batch) > page_limit):
                 break
-            offset += limit
+            offset += page_limit
+
+    def iter_result_pages(self, run_id, created_after=None):
+        # get_results_for_run/:run_id
+        params = {}
+        if created_after:
+            params['created_after'] = created_after
+        return self._iter_pages(f"get_results_for_run/{run_id}", 'results', params)
+
+    def get_results(self, run_id, created_after=None):
+        results = []
+        for page in self.iter_result_pages(run_id, created_after=created_after):
+            results.extend(page)
         return results
 
     def get_milestones(self, project_id):
@@ -115,48 +176,30 @@ class TestRailClient:
                 return data['suites']
         return data
 
-    def get_cases(self, project_id, suite_id=None):
+    def iter_case_pages(self, project_id, suite_id=None, updated_after=None):
+        # API docs: "If the project is operating in strict mode (option 'suite_mode' = 3), ... returns cases for specific suite."
+        params = {}
+        if suite_id:
+            params['suite_id'] = suite_id
+        if updated_after:
+            params['updated_after'] = updated_after
+        return self._iter_pages(f"get_cases/{project_id}", 'cases', params)
+
+    def get_cases(self, project_id, suite_id=None, updated_after=None):
         cases = []
-        offset = 0
-        limit = 250
-        while True:
-            params = {'offset': offset, 'limit': limit}
-            if suite_id:
-                params['suite_id'] = suite_id
-            
-            data = self._get(f"get_cases/{project_id}", params=params)
-            
-            # Handle wrapped response if any (V2 usually returns object with 'cases', 'offset', 'size', '_links' etc. for large projects)
-            # Or just list? 
-            # API docs: "If the project is operating in strict mode (option 'suite_mode' = 3), ... returns cases for specific suite."
-            # The response struct: { "offset": 0, "limit": 250, "size": 10, "_links": ..., "cases": [...] }
-            
-            batch = []
-            if isinstance(data, dict):
-                if 'cases' in data:
-                    batch = data['cases']
-            elif isinstance(data, list):
-                # Older API or small count might return list directly?
-                # Safer to handle both.
-                batch = data
-            
-            if not batch:
-                break
-                
-            cases.extend(batch)
-            
-            if len(batch) < limit:
-                break
-                
-            offset += limit
-            
+        for page in self.iter_case_pages(project_id, suite_id=suite_id, updated_after=updated_after):
+            cases.extend(page)
         return cases
 
+    def iter_test_pages(self, run_id):
+        # get_tests is paginated (250 per page) on TestRail 6.7+
+        return self._iter_pages(f"get_tests/{run_id}", 'tests')
+
     def get_tests(self, run_id):
-        data = self._get(f"get_tests/{run_id}")
-        if isinstance(data, dict) and 'tests' in data:
-            return data['tests']
-        return data
+        tests = []
+        for page in self.iter_test_pages(run_id):
+            tests.extend(page)
+        return tests
 
     def get_statuses(self):
         return self._get("get_statuses")
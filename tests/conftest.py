@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+# The service modules import each other by their flat names (as in the image)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "service"))
+
+from fake_services import InMemoryBigQueryClient  # noqa: E402
+from sync_engine import SyncEngine  # noqa: E402
+
+
+class FakeTestRail:
+    """
+    Just enough of TestRailClient for the tests/results syncs: one project,
+    one page of rows per run. Records every run fetched; on_fetch(run_id)
+    is called before a run's page is returned.
+    """
+    def __init__(self, project_id=1):
+        self.project_id = project_id
+        self.fetched = []
+        self.on_fetch = None
+
+    def get_projects(self):
+        return [{"id": self.project_id}]
+
+    def _pages(self, run_id, row):
+        self.fetched.append(run_id)
+        if self.on_fetch:
+            self.on_fetch(run_id)
+        yield [row]
+
+    def iter_test_pages(self, run_id):
+        return self._pages(run_id, {"id": run_id * 1000, "run_id": run_id, "status_id": 1})
+
+    def iter_result_pages(self, run_id, created_after=None):
+        return self._pages(run_id, {"id": run_id * 1000, "test_id": run_id * 1000, "status_id": 1})
+
+
+def add_runs(bq, run_ids, project_id=1, **fields):
+    for run_id in run_ids:
+        run = {"id": run_id, "project_id": project_id, "is_completed": False,
+               "updated_on": "2024-01-01T00:00:00", "passed_count": 0}
+        run.update(fields)
+        bq.tables["raw_runs"][run_id] = run
+
+
+@pytest.fixture
+def testrail():
+    return FakeTestRail()
+
+
+@pytest.fixture
+def bq():
+    return InMemoryBigQueryClient()
+
+
+@pytest.fixture
+def engine(monkeypatch, testrail, bq):
+    """
+    SyncEngine on the fakes, one run at a time and a checkpoint every 2 runs.
+    """
+    monkeypatch.setenv("SYNC_MAX_WORKERS", "1")
+    monkeypatch.setenv("SYNC_CHECKPOINT_EVERY", "2")
+    monkeypatch.setenv("SYNC_ASYNC_FETCH", "false")
+    return SyncEngine(tr_client=testrail, bq_client=bq, jira_client=object())
@@ -0,0 +1,104 @@
+import pytest
+
+from autotune import AdaptiveController
+from http_session import EndpointStats
+
+
+@pytest.fixture
+def tuner():
+    return AdaptiveController("test", max_concurrency=32, initial_concurrency=8,
+                              page_sizes={"get_tests": (100, 250)}, target_latency=5, max_page_bytes=1000)
+
+
+def healthy(tuner, count, latency=0.1):
+    for _ in range(count):
+        tuner.observe("get_tests", latency, 200)
+
+
+def test_healthy_responses_raise_the_limit_by_about_one_per_window(tuner):
+    healthy(tuner, 8)
+
+    assert 8.9 < tuner.limit < 9.0
+
+
+def test_limit_never_exceeds_the_maximum(tuner):
+    healthy(tuner, 5000)
+
+    assert tuner.limit == 32
+
+
+def test_429_halves_the_limit(tuner):
+    healthy(tuner, 8)
+    before = tuner.limit
+
+    tuner.observe("get_tests", 0.1, 429)
+
+    assert tuner.limit == pytest.approx(before / 2)
+
+
+def test_burst_of_429s_decreases_once_per_window(tuner):
+    healthy(tuner, 8)
+    tuner.observe("get_tests", 0.1, 429)
+    halved = tuner.limit
+
+    for _ in range(3):
+        tuner.observe("get_tests", 0.1, 429)
+    assert tuner.limit == halved
+
+    healthy(tuner, 4)
+    tuner.observe("get_tests", 0.1, 429)
+    assert tuner.limit < halved
+
+
+def test_failures_and_slow_responses_trim_by_ten_percent(tuner):
+    healthy(tuner, 8)
+    before = tuner.limit
+
+    tuner.observe("get_tests", 0.1, 503)
+    assert tuner.limit == pytest.approx(before * 0.9)
+
+    healthy(tuner, 10)
+    before = tuner.limit
+    tuner.observe("get_tests", 0.5, 200)
+    assert tuner.limit == pytest.approx(before * 0.9)
+
+
+def test_limit_stays_at_one_or_more(tuner):
+    for _ in range(200):
+        tuner.observe("get_tests", 0.1, 429)
+
+    assert tuner.limit == 1
+
+
+def test_page_size_grows_on_fast_full_pages_and_halves_on_slow_ones(tuner):
+    tuner.record_page("get_tests", 100, 100, latency=0.1, size=100)
+    assert tuner.page_size("get_tests") == 125
+
+    tuner.record_page("get_tests", 125, 125, latency=10, size=100)
+    assert tuner.page_size("get_tests") == 62
+
+
+def test_page_size_is_capped_by_what_the_server_serves(tuner):
+    tuner.cap_page_size("get_tests", 110)
+    for _ in range(10):
+        tuner.record_page("get_tests", 110, 110, latency=0.1, size=100)
+
+    assert tuner.page_size("get_tests") == 110
+
+
+def test_state_round_trips_and_is_clamped(tuner):
+    tuner.load({"concurrency": 100, "page_size:get_tests": 180, "page_size:unknown": 5})
+
+    assert tuner.state() == {"concurrency": 32, "page_size:get_tests": 180}
+    assert tuner.changes() == {}
+
+    healthy(tuner, 1)
+    tuner.observe("get_tests", 0.1, 429)
+    assert tuner.changes() == {"concurrency": 16}
+
+
+def test_tuner_and_session_key_endpoints_alike():
+    assert EndpointStats.endpoint_key("get_tests/42") == "get_tests"
+    assert EndpointStats.endpoint_key("get_results_for_run/7") == "get_results_for_run"
+    # Jira's page size and concurrency feedback share one key
+    assert EndpointStats.endpoint_key("search/jql") == "search/jql"
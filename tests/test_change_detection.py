@@ -0,0 +1,61 @@
+from conftest import add_runs
+
+
+def resync(engine, testrail, **kwargs):
+    testrail.fetched = []
+    engine._sync_tests(**kwargs)
+    return testrail.fetched
+
+
+def test_unchanged_runs_are_not_fetched_again(engine, testrail, bq):
+    add_runs(bq, [1, 2, 3])
+
+    assert resync(engine, testrail) == [1, 2, 3]
+    assert resync(engine, testrail) == []
+
+
+def test_open_run_with_a_new_fingerprint_is_fetched_again(engine, testrail, bq):
+    add_runs(bq, [1, 2, 3])
+    resync(engine, testrail)
+
+    add_runs(bq, [2], passed_count=5)
+
+    assert resync(engine, testrail) == [2]
+
+
+def test_run_captured_after_completion_is_never_fetched_again(engine, testrail, bq):
+    add_runs(bq, [1, 2], is_completed=True, completed_on="2024-01-02T00:00:00")
+    resync(engine, testrail)
+
+    # Even when raw_runs reports it changed afterwards
+    add_runs(bq, [1, 2], is_completed=True, completed_on="2024-01-02T00:00:00",
+             updated_on="2024-02-01T00:00:00", passed_count=7)
+
+    assert resync(engine, testrail) == []
+
+
+def test_run_completed_since_its_capture_is_fetched_once_more(engine, testrail, bq):
+    add_runs(bq, [1])
+    resync(engine, testrail)
+
+    add_runs(bq, [1], is_completed=True, completed_on="2024-01-02T00:00:00")
+
+    assert resync(engine, testrail) == [1]
+    assert resync(engine, testrail) == []
+
+
+def test_fingerprints_are_kept_per_entity(engine, testrail, bq):
+    add_runs(bq, [1, 2])
+    resync(engine, testrail)
+
+    testrail.fetched = []
+    engine._sync_results()
+
+    assert testrail.fetched == [1, 2]
+
+
+def test_full_refresh_fetches_every_run(engine, testrail, bq):
+    add_runs(bq, [1, 2], is_completed=True)
+    resync(engine, testrail)
+
+    assert resync(engine, testrail, full_refresh=True) == [1, 2]
@@ -0,0 +1,97 @@
+import time
+
+import pytest
+
+import sync_engine
+from conftest import add_runs
+
+
+class Clock:
+    """
+    Stands in for the time module in sync_engine: monotonic() only moves
+    when a test says so, time() is the real one.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return time.time()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sync_engine, "time", clock)
+    return clock
+
+
+def run_out_of_time_at(testrail, clock, last_run):
+    def on_fetch(run_id):
+        if run_id == last_run:
+            clock.now += 3600
+    testrail.on_fetch = on_fetch
+
+
+def test_deadline_checkpoints_and_returns_partial(engine, testrail, bq, clock):
+    add_runs(bq, range(1, 11))
+    run_out_of_time_at(testrail, clock, 5)
+
+    result = engine._sync_tests(deadline=clock.now + 60)
+
+    assert result["status"] == "partial"
+    assert result["remaining_projects"] == [1]
+    assert testrail.fetched == [1, 2, 3, 4, 5]
+    done_up_to, _ = bq.get_checkpoints("tests_checkpoint")["1"]
+    assert done_up_to == 5
+
+
+def test_resume_fetches_only_runs_after_the_checkpoint(engine, testrail, bq, clock):
+    add_runs(bq, range(1, 11))
+    run_out_of_time_at(testrail, clock, 5)
+    engine._sync_tests(deadline=clock.now + 60)
+
+    testrail.fetched, testrail.on_fetch = [], None
+    result = engine._sync_tests(deadline=clock.now + 60)
+
+    assert result["status"] == "success"
+    assert testrail.fetched == [6, 7, 8, 9, 10]
+    # A finished project closes its checkpoint
+    assert bq.get_checkpoints("tests_checkpoint") == {}
+
+
+def test_run_changed_after_the_interrupted_attempt_is_fetched_again(engine, testrail, bq, clock):
+    add_runs(bq, range(1, 11))
+    run_out_of_time_at(testrail, clock, 5)
+    engine._sync_tests(deadline=clock.now + 60)
+
+    # New results on an already checkpointed run; TestRail runs carry no updated_on to tell
+    add_runs(bq, [2], updated_on=None, created_on="2024-01-01T00:00:00", passed_count=3)
+    testrail.fetched, testrail.on_fetch = [], None
+    engine._sync_tests(deadline=clock.now + 60)
+
+    assert testrail.fetched == [2, 6, 7, 8, 9, 10]
+
+
+@pytest.mark.parametrize("run, skipped", [
+    ({"id": 3, "captured_at": 200, "captured_fingerprint": "a", "fingerprint": "a"}, True),
+    ({"id": 3, "captured_at": 200, "captured_fingerprint": "a", "fingerprint": "b"}, False),
+    ({"id": 3, "captured_at": 50, "captured_fingerprint": "a", "fingerprint": "a"}, False),
+    ({"id": 3, "captured_at": None, "captured_fingerprint": None, "fingerprint": "a"}, False),
+    ({"id": 9, "captured_at": 200, "captured_fingerprint": "a", "fingerprint": "a"}, False),
+])
+def test_resume_skips_only_runs_captured_unchanged_by_the_attempt(run, skipped):
+    assert sync_engine.SyncEngine._captured_since(run, started_at=100, done_up_to=5) is skipped
+
+
+def test_full_refresh_ignores_the_checkpoint(engine, testrail, bq, clock):
+    add_runs(bq, range(1, 11))
+    run_out_of_time_at(testrail, clock, 5)
+    engine._sync_tests(deadline=clock.now + 60)
+
+    testrail.fetched, testrail.on_fetch = [], None
+    engine._sync_tests(full_refresh=True, deadline=clock.now + 60)
+
+    assert testrail.fetched == list(range(1, 11))
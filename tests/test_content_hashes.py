@@ -0,0 +1,44 @@
+import pytest
+
+
+@pytest.fixture
+def written(bq, monkeypatch):
+    """
+    {table_name: [rows]} passed to insert_rows.
+    """
+    written = {}
+    insert_rows = bq.insert_rows
+
+    def record(table_name, rows, cleaned=False):
+        written.setdefault(table_name, []).extend(rows)
+        insert_rows(table_name, rows, cleaned=cleaned)
+    monkeypatch.setattr(bq, "insert_rows", record)
+    return written
+
+
+PROJECTS = [{"id": 1, "name": "A"}, {"id": 2, "name": "B"}]
+
+
+def test_only_new_or_changed_rows_are_written(engine, bq, written):
+    assert engine._insert_changed("raw_projects", PROJECTS) == 2
+    assert engine._insert_changed("raw_projects", PROJECTS) == 0
+
+    changed = [PROJECTS[0], dict(PROJECTS[1], name="B2")]
+    assert engine._insert_changed("raw_projects", changed) == 1
+    assert [row["name"] for row in written["raw_projects"]] == ["A", "B", "B2"]
+
+
+def test_full_refresh_rewrites_every_row(engine, bq, written):
+    engine._insert_changed("raw_projects", PROJECTS)
+
+    assert engine._insert_changed("raw_projects", PROJECTS, full_refresh=True) == 2
+
+
+def test_rows_are_tagged_only_where_the_table_has_the_column(engine, bq, written):
+    engine._insert_changed("raw_projects", PROJECTS)
+    engine._insert_changed("raw_users", [{"id": 7, "name": "U"}])
+
+    assert all(row["_content_hash"] for row in written["raw_projects"])
+    assert "_content_hash" not in written["raw_users"][0]
+    # Still deduplicated through the index
+    assert engine._insert_changed("raw_users", [{"id": 7, "name": "U"}]) == 0
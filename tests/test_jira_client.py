@@ -0,0 +1,64 @@
+import logging
+
+import pytest
+import requests
+from tenacity import wait_none
+
+from jira_client import JiraClient
+
+
+def response(status_code, body=b"{}"):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp._content = body
+    resp.url = "https://jira.example/rest/api/3/search/jql"
+    return resp
+
+
+@pytest.fixture
+def jira(monkeypatch):
+    monkeypatch.setattr(JiraClient.get_issues.retry, "wait", wait_none())
+    client = JiraClient()
+    client.calls = 0
+    return client
+
+
+def serve(jira, monkeypatch, *responses):
+    def post(url, endpoint, json=None):
+        jira.calls += 1
+        return responses[min(jira.calls, len(responses)) - 1]
+    monkeypatch.setattr(jira.session, "post", post)
+
+
+def levels(caplog, text):
+    return [record.levelno for record in caplog.records if text in record.getMessage()]
+
+
+def test_retried_5xx_is_a_warning_until_retries_run_out(jira, monkeypatch, caplog):
+    serve(jira, monkeypatch, response(503, b"down"))
+
+    with caplog.at_level(logging.WARNING), pytest.raises(requests.exceptions.HTTPError):
+        jira.get_issues("project = X")
+
+    assert jira.calls == 5
+    assert levels(caplog, "Jira API Error") == [logging.WARNING] * 5
+    assert levels(caplog, "failed after 5 attempts") == [logging.ERROR]
+
+
+def test_recovered_5xx_logs_no_error(jira, monkeypatch, caplog):
+    serve(jira, monkeypatch, response(502), response(200, b'{"issues": []}'))
+
+    with caplog.at_level(logging.WARNING):
+        assert jira.get_issues("project = X", max_results=10) == {"issues": []}
+
+    assert [record.levelno for record in caplog.records] == [logging.WARNING]
+
+
+def test_4xx_fails_fast_as_an_error(jira, monkeypatch, caplog):
+    serve(jira, monkeypatch, response(400, b"bad jql"))
+
+    with caplog.at_level(logging.WARNING), pytest.raises(requests.exceptions.HTTPError):
+        jira.get_issues("project = ")
+
+    assert jira.calls == 1
+    assert levels(caplog, "Jira API Error") == [logging.ERROR]
@@ -0,0 +1,125 @@
+import threading
+import time
+from contextlib import closing
+
+import pytest
+
+from conftest import add_runs
+from sharding import SqliteLeaseStore, ShardWorker, plan_units
+
+UNIT = {"unit_id": "c1:tests:1:0", "cycle": "c1", "entity": "tests", "project_id": 1, "run_from": 0, "run_to": 99}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SqliteLeaseStore(str(tmp_path / "leases.db"))
+
+
+def take_over(store, unit_id, worker_id="other", lease_seconds=3600):
+    """
+    What another worker's claim does to the row.
+    """
+    with closing(store._connect()) as conn:
+        conn.execute("UPDATE sync_leases SET worker_id = ?, lease_token = ?, lease_until = ? WHERE unit_id = ?",
+                     (worker_id, f"{worker_id}-token", time.time() + lease_seconds, unit_id))
+
+
+def test_live_lease_cannot_be_claimed(store):
+    store.plan([UNIT])
+
+    assert store.claim("c1", "tests", "a", lease_seconds=60)["worker_id"] == "a"
+    assert store.claim("c1", "tests", "b", lease_seconds=60) is None
+
+
+def test_expired_lease_is_reclaimed(store):
+    store.plan([UNIT])
+    first = store.claim("c1", "tests", "a", lease_seconds=-1)
+
+    second = store.claim("c1", "tests", "b", lease_seconds=60)
+
+    assert second["unit_id"] == first["unit_id"]
+    assert second["worker_id"] == "b"
+    assert second["attempts"] == 2
+    # The first worker can neither renew nor finish it any more
+    assert store.renew(first, 60) is False
+    assert store.finish(first, "done") is False
+    assert store.finish(second, "done") is True
+    assert store.summary("c1", "tests") == {"done": 1}
+
+
+def test_unit_whose_workers_keep_dying_is_failed(store):
+    store.plan([UNIT])
+    for worker_id in ("a", "b", "c"):
+        assert store.claim("c1", "tests", worker_id, lease_seconds=-1) is not None
+
+    assert store.claim("c1", "tests", "d", lease_seconds=60) is None
+    assert store.summary("c1", "tests") == {"failed": 1}
+    with closing(store._connect()) as conn:
+        assert "lease expired" in conn.execute("SELECT error FROM sync_leases").fetchone()["error"]
+
+
+def test_plan_is_idempotent(store):
+    store.plan([UNIT])
+    store.claim("c1", "tests", "a", lease_seconds=60)
+
+    store.plan([UNIT])
+
+    assert store.summary("c1", "tests") == {"leased": 1}
+
+
+def test_full_refresh_plans_unchanged_runs(engine, testrail, bq):
+    add_runs(bq, [1, 2, 700])
+    engine._sync_tests()
+
+    assert plan_units(engine, "tests", "c1", 500) == []
+    units = plan_units(engine, "tests", "c1", 500, full_refresh=True)
+    assert [(unit["run_from"], unit["run_to"]) for unit in units] == [(0, 499), (500, 999)]
+
+
+def test_lost_lease_stops_the_shard_without_checkpointing(engine, testrail, bq):
+    add_runs(bq, range(1, 11))
+    lost = threading.Event()
+
+    def on_fetch(run_id):
+        if run_id == 3:
+            lost.set()
+    testrail.on_fetch = on_fetch
+
+    result = engine.run_shard("tests", 1, (0, 99), lost_lease=lost)
+
+    assert result["status"] == "lost_lease"
+    assert testrail.fetched == [1, 2, 3]
+    # At most the commit due after run 2 (every 2 runs), if the writer got to it before run 3 was fetched
+    done_up_to, _ = bq.get_checkpoints("tests_checkpoint").get("1:0-99", (0, None))
+    assert done_up_to <= 2
+    assert "tests:3" not in bq.tables["run_fingerprints"]
+
+
+def test_worker_leaves_a_unit_taken_over_to_its_new_owner(engine, testrail, bq, store):
+    add_runs(bq, range(1, 11))
+    worker = ShardWorker(engine, store, worker_id="a", lease_seconds=0.3, run_span=100)
+
+    def on_fetch(run_id):
+        if run_id == 3:
+            take_over(store, "c1:tests:1:0")
+            # Give the heartbeat time to notice
+            time.sleep(0.5)
+    testrail.on_fetch = on_fetch
+
+    result = worker.run("tests", cycle="c1")
+
+    assert result["units"] == []
+    assert testrail.fetched == [1, 2, 3]
+    assert result["summary"] == {"leased": 1}
+    with closing(store._connect()) as conn:
+        assert conn.execute("SELECT worker_id FROM sync_leases").fetchone()["worker_id"] == "other"
+
+
+def test_worker_notifies_the_sync_listeners(engine, testrail, bq, store):
+    add_runs(bq, [1, 2])
+    calls = []
+    engine.sync_listeners.append(lambda entity, result: calls.append((entity, result["count"])))
+
+    ShardWorker(engine, store, worker_id="a", run_span=100).run("tests", cycle="c1")
+
+    assert calls == [("tests", 2)]
@@ -0,0 +1,114 @@
+import threading
+
+import pytest
+
+import bigquery_client
+import bq_writer
+from bigquery_client import BigQueryClient
+
+
+class FakeBigQuery:
+    """
+    google.cloud.bigquery.Client stand-in that records sync_state updates.
+    """
+    def __init__(self):
+        self.watermarks = []
+
+    def get_table(self, table_id):
+        raise LookupError(table_id)
+
+    def query(self, query, job_config=None):
+        if "sync_state" in query:
+            params = {p.name: p.value for p in job_config.query_parameters}
+            self.watermarks.append((params["entity_type"], params["watermark"]))
+        return self
+
+    def result(self):
+        return []
+
+
+class BlockingMerge:
+    """
+    staged_merge replacement: waits until released, then succeeds or fails.
+    """
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.fail = False
+
+    def __call__(self, client, table_id, path, *merge, **kwargs):
+        self.started.set()
+        assert self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("MERGE failed")
+
+
+@pytest.fixture
+def merge(monkeypatch):
+    merge = BlockingMerge()
+    monkeypatch.setattr(bq_writer, "staged_merge", merge)
+    return merge
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setenv("BQ_WRITE_MODE", "load")
+    monkeypatch.setenv("BQ_STAGING_FORMAT", "ndjson")
+    monkeypatch.setenv("BQ_STAGING_DIR", str(tmp_path))
+    monkeypatch.setattr(bigquery_client.bigquery, "Client", lambda project: FakeBigQuery())
+    return BigQueryClient("p", "d")
+
+
+def flush_in_background(client, table_names):
+    """
+    Starts client.flush(table_names) on another thread, like a parallel entity.
+    """
+    errors = []
+
+    def run():
+        try:
+            client.flush(table_names)
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, errors
+
+
+def test_watermark_waits_for_another_threads_load(client, merge):
+    client.upsert_rows("raw_runs", [{"id": 1}], cleaned=True)
+    plans, errors = flush_in_background(client, ["raw_plans", "raw_runs"])
+    assert merge.started.wait(5)
+
+    # The runs sync finishes while plans is still merging the shared raw_runs buffer
+    client.update_watermark("runs", 100, scope_id=1, after_table="raw_runs")
+    client.flush(["raw_runs"])
+    assert client.client.watermarks == []
+
+    merge.release.set()
+    plans.join()
+    assert errors == []
+    assert client.client.watermarks == [("runs", 100)]
+
+
+def test_watermark_is_dropped_when_another_threads_load_fails(client, merge):
+    merge.fail = True
+    client.upsert_rows("raw_runs", [{"id": 1}], cleaned=True)
+    plans, errors = flush_in_background(client, ["raw_plans", "raw_runs"])
+    assert merge.started.wait(5)
+
+    client.update_watermark("runs", 100, scope_id=1, after_table="raw_runs")
+    merge.release.set()
+    plans.join()
+    assert len(errors) == 1
+
+    # Not applied by a later flush either: the rows behind it were lost
+    client.flush(["raw_runs"])
+    assert client.client.watermarks == []
+    assert client._pending_watermarks == []
+
+
+def test_watermark_without_pending_rows_is_written_at_once(client, merge):
+    client.update_watermark("runs", 100, scope_id=1, after_table="raw_runs")
+
+    assert client.client.watermarks == [("runs", 100)]
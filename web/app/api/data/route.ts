@@ -21,6 +21,31 @@ export async function GET(request: NextRequest) {
     };
     const table = validTypes.includes(type) ? tableMap[type] : 'dashboard_mart';
 
+    // Served from the sync service's KPI cache when configured (no BigQuery query per page load)
+    const serviceUrl = process.env.KPI_SERVICE_URL;
+    if (serviceUrl) {
+        const params = new URLSearchParams({ page_size: searchParams.get('page_size') || '1000' });
+        for (const name of ['project_id', 'month', 'page']) {
+            const value = searchParams.get(name);
+            if (value) params.set(name, value);
+        }
+        if (process.env.SYNC_TOKEN) params.set('token', process.env.SYNC_TOKEN);
+
+        const headers: Record<string, string> = {};
+        const ifNoneMatch = request.headers.get('if-none-match');
+        if (ifNoneMatch) headers['If-None-Match'] = ifNoneMatch;
+
+        const response = await fetch(`${serviceUrl}/kpis/${table}?${params}`, { headers, cache: 'no-store' });
+        if (response.status === 304) {
+            return new NextResponse(null, { status: 304, headers: { ETag: response.headers.get('etag') || '' } });
+        }
+        const body = await response.json();
+        return NextResponse.json(body, {
+            status: response.status,
+            headers: { ETag: response.headers.get('etag') || '', 'Cache-Control': 'no-cache' },
+        });
+    }
+
     const query = `
     SELECT * 
     FROM \`testrail_kpis.${table}\`